@@ -1,38 +1,289 @@
-from flask import request, url_for
+import json
+from math import ceil
+from itertools import islice
+from flask import request, url_for, current_app, jsonify, stream_with_context
+from flask.json import dumps as json_dumps
+from itsdangerous import URLSafeSerializer, BadSignature
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Load
 from fhirclient.models.bundle import BundleLink, BundleEntry, BundleEntrySearch, Bundle
 from fhirclient.models.fhirabstractbase import FHIRAbstractBase
+from app.api_v1.errors.exceptions import ValidationError
+from app.api_v1.utils.requests import fhir_requested_elements
+from app.extensions import db
+from app.utils.general import json_serial
 
 
-def paginate_query(query):
-    page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('_count', 10, type=int)
-    return query.paginate(page=page, per_page=per_page), per_page
+##################################################################################################
+# BUNDLE TOTALS
+##################################################################################################
+
+def get_total_mode(default='accurate'):
+    """
+    Read the FHIR _total search parameter.
+    :return:
+        One of 'none', 'estimate' or 'accurate'.  Returns default if the parameter is absent.
+    """
+    total = request.args.get('_total')
+    if total is None:
+        return default
+    if total not in ['none', 'estimate', 'accurate']:
+        raise ValidationError('The value for _total ({}) must be one of none, estimate or accurate'.format(total))
+    return total
+
+
+def count_query(query):
+    """Return an accurate count of the rows matched by query with a SELECT count(*), without loading any rows"""
+    return query.order_by(None).count()
+
+
+def explain_query(query, analyze=False, format='TEXT'):
+    """
+    Run EXPLAIN for an un-executed query with its bound parameters.
+    :param analyze:
+        Execute the query and include actual row counts and timings (EXPLAIN ANALYZE)
+    :param format:
+        PostgreSQL EXPLAIN output format: TEXT or JSON
+    :return:
+        List of the EXPLAIN output rows (lines of the plan for TEXT, one parsed plan for JSON)
+    """
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    options = 'ANALYZE, FORMAT {}'.format(format) if analyze else 'FORMAT {}'.format(format)
+    rows = db.session.connection().execute('EXPLAIN ({}) {}'.format(options, compiled), compiled.params)
+    return [json.loads(row[0]) if isinstance(row[0], str) and format == 'JSON' else row[0] for row in rows]
+
+
+def estimate_query_count(query):
+    """
+    Return the PostgreSQL planner's row estimate for query from EXPLAIN (FORMAT JSON).  No rows are read, so this is
+    cheap even for very large result sets, but it is only as accurate as the table statistics.
+    """
+    plan = explain_query(query.order_by(None), format='JSON')[0]
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def query_total(query, mode):
+    """Return the total for a searchset bundle according to the _total mode, or None for 'none'"""
+    if mode == 'accurate':
+        return count_query(query)
+    if mode == 'estimate':
+        return estimate_query_count(query)
+    return None
+
+
+##################################################################################################
+# OFFSET PAGINATION
+##################################################################################################
+
+class OffsetPage(object):
+    """
+    One page of an offset paginated query.  Same attributes as a Flask-SQLAlchemy Pagination object, but total and
+    pages are only known when a count was requested.  Whether a next page exists is found by fetching one row more
+    than per_page.
+    """
+
+    def __init__(self, items, page, per_page, has_next, total=None):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.has_next = has_next
+        self.total = total
+
+    @property
+    def pages(self):
+        if self.total is None:
+            return None
+        if self.per_page == 0:
+            return 0
+        return int(ceil(self.total / float(self.per_page)))
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+    @property
+    def prev_num(self):
+        return self.page - 1 if self.has_prev else None
+
+    @property
+    def next_num(self):
+        return self.page + 1 if self.has_next else None
+
+
+def get_page_size(default=10):
+    """
+    Return the _count requested for a searchset page.
+    Raises ValidationError if _count is not a positive integer.
+    """
+    per_page = request.args.get('_count', default, type=int)
+    if per_page < 1:
+        raise ValidationError('The _count parameter must be a positive integer')
+    return per_page
+
+
+def paginate_query(query, total='accurate'):
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = get_page_size()
+    records = query.limit(per_page + 1).offset((page - 1) * per_page).all()
+    p = OffsetPage(items=records[:per_page], page=page, per_page=per_page, has_next=len(records) > per_page,
+                   total=query_total(query, total))
+    return p, per_page
+
+
+##################################################################################################
+# KEYSET PAGINATION
+##################################################################################################
+
+class KeysetPage(object):
+    """
+    One page of a keyset (seek) paginated query.  Instead of an OFFSET, each page continues from the sort value and
+    id of the last row of the previous page, which the client passes back as an opaque _page_token.  No COUNT(*) is
+    run, so the cost of a page does not depend on how deep into the result set it is.
+    """
+
+    def __init__(self, items, has_next, next_token=None, token=None):
+        self.items = items
+        self.has_next = has_next
+        self.next_token = next_token
+        self.token = token
+
+
+def page_token_serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='fhir-page-token')
+
+
+def sort_key_name(sort):
+    """Return a string identifying the _sort spec, stored in page tokens so they can't be reused across sorts"""
+    if not sort:
+        return ''
+    return '{}{}.{}'.format('-' if sort.get('op') == 'desc' else '', sort['model'].__name__, sort['column'][0])
+
+
+def encode_page_token(sort, last_record):
+    """Build the opaque continuation token pointing after last_record"""
+    value = None
+    if sort:
+        value = getattr(last_record, sort['column'][0])
+        if value is not None:
+            value = json_serial(value) if hasattr(value, 'isoformat') else value
+    return page_token_serializer().dumps({'s': sort_key_name(sort), 'v': value, 'i': last_record.id})
+
+
+def decode_page_token(token, sort):
+    """
+    Validate a continuation token against the current _sort spec.
+    :return:
+        Tuple of (sort value, id) of the last row of the previous page
+    Raises ValidationError if the token was tampered with or was issued for a different sort.
+    """
+    try:
+        data = page_token_serializer().loads(token)
+    except BadSignature:
+        raise ValidationError('The _page_token supplied is not valid')
+    if not isinstance(data, dict) or data.get('s') != sort_key_name(sort) or 'i' not in data:
+        raise ValidationError('The _page_token supplied does not match the _sort for this search')
+    return data.get('v'), data.get('i')
+
+
+def keyset_supported(base, sort=None):
+    """Keyset pagination needs a base model with an id and a sort (if any) on a column of the base model"""
+    if base is None or request.args.get('page') is not None:
+        return False
+    return not sort or (sort.get('model') == base and isinstance(sort.get('column'), (list, tuple)))
+
+
+def keyset_query(query, base, sort=None):
+    """
+    Order a query for keyset pagination and apply the seek predicate for the _page_token, if any.  Results are
+    ordered by the _sort column (if any) with the base model id as a tie-breaker, using the PostgreSQL default null
+    ordering for each direction (NULLS LAST ascending, NULLS FIRST descending).  The seek predicate follows the same
+    null ordering.
+    :param query:
+        Un-executed SQLAlchemy query over base
+    :param base:
+        The SQLAlchemy ORM model to which the FHIR Resource endpoint relates
+    :param sort:
+        The '_sort' dict of the fhir_search_spec, or None
+    :return:
+        Tuple of (un-executed query, per_page, page token)
+    """
+    per_page = get_page_size()
+    token = request.args.get('_page_token')
+    descending = bool(sort) and sort.get('op') == 'desc'
+    column = getattr(base, sort['column'][0]) if sort else None
+    id_column = base.id
+
+    if column is not None:
+        order = [column.desc().nullsfirst(), id_column.desc()] if descending else \
+            [column.asc().nullslast(), id_column.asc()]
+    else:
+        order = [id_column.asc()]
+    query = query.order_by(None).order_by(*order)
+
+    if token:
+        value, last_id = decode_page_token(token=token, sort=sort)
+        if column is None:
+            query = query.filter(id_column > last_id)
+        elif descending:
+            if value is None:
+                query = query.filter(or_(and_(column.is_(None), id_column < last_id), column.isnot(None)))
+            else:
+                query = query.filter(or_(column < value, and_(column == value, id_column < last_id)))
+        else:
+            if value is None:
+                query = query.filter(and_(column.is_(None), id_column > last_id))
+            else:
+                query = query.filter(or_(column > value, and_(column == value, id_column > last_id),
+                                         column.is_(None)))
+    return query, per_page, token
+
+
+def keyset_paginate_query(query, base, sort=None):
+    """
+    Apply keyset pagination to a query, see keyset_query().
+    :param query:
+        Un-executed SQLAlchemy query over base
+    :param base:
+        The SQLAlchemy ORM model to which the FHIR Resource endpoint relates
+    :param sort:
+        The '_sort' dict of the fhir_search_spec, or None
+    :return:
+        Tuple of (KeysetPage, per_page)
+    """
+    query, per_page, token = keyset_query(query=query, base=base, sort=sort)
+
+    # Fetch one extra row to find out whether there is a next page without counting
+    records = query.limit(per_page + 1).all()
+    has_next = len(records) > per_page
+    records = records[:per_page]
+    next_token = encode_page_token(sort=sort, last_record=records[-1]) if has_next else None
+    return KeysetPage(items=records, has_next=has_next, next_token=next_token, token=token), per_page
 
 
 def set_bundle_page_links(bundle, pagination, per_page):
     addtnl_args = request.args.to_dict(flat=False)
-    for x in ['page', '_count']:
+    for x in ['page', '_count', '_page_token']:
         try:
             del addtnl_args[x]
         except KeyError:
             pass
     link_self = BundleLink()
     link_self.relation = 'self'
-    if not pagination.has_prev:
-        page = 1
-    else:
-        page = pagination.next_num - 1
-    link_self.url = url_for(request.endpoint, page=page, _count=per_page, _external=True, **addtnl_args)
+    link_self.url = url_for(request.endpoint, page=pagination.page, _count=per_page, _external=True, **addtnl_args)
 
     link_first = BundleLink()
     link_first.relation = 'first'
     link_first.url = url_for(request.endpoint, page=1, _count=per_page, _external=True, **addtnl_args)
 
-    link_last = BundleLink()
-    link_last.relation = 'last'
-    link_last.url = url_for(request.endpoint, page=pagination.pages, _count=per_page, _external=True, **addtnl_args)
+    bundle.link = [link_self, link_first]
 
-    bundle.link = [link_self, link_first, link_last]
+    # The last page is only known when the total was counted
+    if pagination.pages is not None:
+        link_last = BundleLink()
+        link_last.relation = 'last'
+        link_last.url = url_for(request.endpoint, page=max(pagination.pages, 1), _count=per_page, _external=True,
+                                **addtnl_args)
+        bundle.link.append(link_last)
 
     if pagination.has_prev:
         link_prev = BundleLink()
@@ -51,8 +302,76 @@ def set_bundle_page_links(bundle, pagination, per_page):
     return bundle
 
 
-def create_bundle_search_entry(obj):
+def set_bundle_keyset_links(bundle, page, per_page):
+    """Set the self, first and next links of a searchset bundle paginated with a KeysetPage"""
+    addtnl_args = request.args.to_dict(flat=False)
+    for x in ['page', '_count', '_page_token']:
+        try:
+            del addtnl_args[x]
+        except KeyError:
+            pass
+    link_self = BundleLink()
+    link_self.relation = 'self'
+    if page.token:
+        link_self.url = url_for(request.endpoint, _page_token=page.token, _count=per_page, _external=True,
+                                **addtnl_args)
+    else:
+        link_self.url = url_for(request.endpoint, _count=per_page, _external=True, **addtnl_args)
+
+    link_first = BundleLink()
+    link_first.relation = 'first'
+    link_first.url = url_for(request.endpoint, _count=per_page, _external=True, **addtnl_args)
+
+    bundle.link = [link_self, link_first]
+
+    if page.has_next:
+        link_next = BundleLink()
+        link_next.relation = 'next'
+        link_next.url = url_for(request.endpoint, _page_token=page.next_token, _count=per_page, _external=True,
+                                **addtnl_args)
+        bundle.link.append(link_next)
+
+    return bundle
+
+
+class SearchsetBundle(Bundle):
+    """
+    fhirclient Bundle that also holds entries already serialized to FHIR JSON dicts in entry_json.  These are
+    appended to the output of as_json(), so entries built with a model's fhir_json method never become fhirclient
+    objects.
+    """
+
+    def __init__(self, jsondict=None, strict=True):
+        self.entry_json = []
+        super(SearchsetBundle, self).__init__(jsondict=jsondict, strict=strict)
+
+    def as_json(self):
+        js = super(SearchsetBundle, self).as_json()
+        if self.entry_json:
+            js['entry'] = js.get('entry', []) + self.entry_json
+        return js
+
+
+def create_bundle_search_entry_json(obj, elements=None):
+    """
+    Build a searchset Bundle entry JSON dict for a record whose model has a fhir_json method
+    :param obj:
+        SQLAlchemy ORM object
+    :param elements:
+        Optional set of top-level FHIR elements to build
+    :return:
+        dict
+    """
+    resource = obj.fhir_json(elements=elements)
+    # TODO: Allow modified certainty code of 0 to 1
+    return {'fullUrl': resource['id'], 'resource': resource, 'search': {'mode': 'match', 'score': 1}}
+
+
+def create_bundle_search_entry(obj, elements=None):
     try:
+        if elements is not None:
+            # Build only the elements requested with _summary / _elements
+            obj.create_fhir_object(elements=elements)
         fhir_obj = obj.fhir
         if not isinstance(fhir_obj, FHIRAbstractBase):
             raise TypeError
@@ -70,35 +389,113 @@ def create_bundle_search_entry(obj):
         raise TypeError('Object did not have an attribute FHIR that generates an FHIR object')
 
 
-def create_bundle(query, paginate=True):
+def preload_bundle_records(records, relations=None):
+    """
+    Fetch the related records needed to build FHIR objects for a page of results with a constant number of
+    queries.  Records are grouped by model and passed to the model's bulk_preload_fhir_relations method, if defined.
+    :param relations:
+        Optional list of the relationships to fetch, defaults to all
+    """
+    models = []
+    for r in records:
+        if type(r) not in models:
+            models.append(type(r))
+    for model in models:
+        if hasattr(model, 'bulk_preload_fhir_relations'):
+            model.bulk_preload_fhir_relations([r for r in records if type(r) == model], relations=relations)
+
+
+def apply_fhir_load_plan(query, base, sort=None):
+    """
+    Resolve the _summary and _elements parameters for the base model and limit the columns loaded by the query to
+    those the requested elements are built from.
+    :param query:
+        Un-executed SQLAlchemy query over base
+    :param base:
+        The SQLAlchemy ORM model to which the FHIR Resource endpoint relates
+    :param sort:
+        The '_sort' dict of the fhir_search_spec, or None
+    :return:
+        Tuple of (query, set of requested elements or None, list of relationships to preload or None for all)
+    """
+    elements = fhir_requested_elements(base)
+    relations = None
+    if elements is not None:
+        columns, relations = base.fhir_load_plan(elements)
+        if columns is not None:
+            if sort and sort.get('model') is base and sort['column'][0] not in columns:
+                # Read from the last row to build the next page token
+                columns = columns + [sort['column'][0]]
+            query = query.options(Load(base).load_only(*columns))
+    return query, elements, relations
+
+
+def create_bundle(query, paginate=True, base=None, sort=None):
+    """
+    Execute a search query and build a FHIR searchset Bundle from the results.
+    :param query:
+        Un-executed SQLAlchemy query
+    :param paginate:
+        Whether to paginate the results.  When base is given and no 'page' arg was requested, results are paginated
+        with keyset pagination and _page_token continuation links.  Otherwise offset pagination is used.
+    :param base:
+        The SQLAlchemy ORM model to which the FHIR Resource endpoint relates
+    :param sort:
+        The '_sort' dict of the fhir_search_spec used to build the query, if any
+    :return:
+        fhirclient Bundle
+
+    The _total search parameter controls Bundle.total: 'none' skips counting, 'estimate' uses the planner's row
+    estimate and 'accurate' runs a SELECT count(*).  Offset pagination defaults to 'accurate' and keyset pagination
+    defaults to 'none'.
+
+    _summary=true|text|data and _elements select the FHIR elements built for each entry.  Only the columns and
+    relationships those elements are built from are loaded, see the base model's fhir_load_plan.
+    """
     # Initialize searchset bundle
-    b = Bundle()
+    b = SearchsetBundle()
     b.type = 'searchset'
 
-    # Handle _summary arg
-    # TODO: Refactor into separate function or decorator
-    summary = request.args.get('_summary')
-    if summary:
-        if summary == 'count':
-            b.total = len(query.all())
-            return b
-    # TODO: Handle summary = True and summary = Text and summary = Data
+    # Handle _summary=count
+    if request.args.get('_summary') == 'count':
+        total = get_total_mode()
+        b.total = query_total(query, 'estimate' if total == 'estimate' else 'accurate')
+        return b
+
+    # Other _summary values and _elements limit the columns and relationships loaded for each entry
+    query, elements, relations = apply_fhir_load_plan(query=query, base=base, sort=sort)
+
     # Apply pagination if desired and set links
-    if paginate:
-        p, per_page = paginate_query(query=query)
+    if paginate and keyset_supported(base=base, sort=sort):
+        total = query_total(query, get_total_mode(default='none'))
+        p, per_page = keyset_paginate_query(query=query, base=base, sort=sort)
+        b = set_bundle_keyset_links(bundle=b, page=p, per_page=per_page)
+        records = p.items
+        if total is not None:
+            b.total = total
+    elif paginate:
+        p, per_page = paginate_query(query=query, total=get_total_mode())
         b = set_bundle_page_links(bundle=b, pagination=p, per_page=per_page)
         records = p.items
-        b.total = p.total
+        if p.total is not None:
+            b.total = p.total
     # Otherwise, execute query as-is
     else:
         records = query.all()
         b.total = len(records)
 
+    # Bulk-load related records for the whole page so entries are built from memory
+    preload_bundle_records(records, relations=relations)
+
     # Loop through results to generate bundle entries
     for r in records:
+        if hasattr(r, 'fhir_elements'):
+            # Resource models declaring fhir_elements serialize straight to JSON with fhir_json
+            b.entry_json.append(create_bundle_search_entry_json(obj=r, elements=elements))
+            continue
         try:
             # Try creating a search entry for the bundle
-            e = create_bundle_search_entry(obj=r)
+            e = create_bundle_search_entry(obj=r, elements=elements)
             # If entry can be made (e.g. if object has working fhir attribute) append to bundle
             try:
                 b.entry.append(e)
@@ -111,3 +508,97 @@ def create_bundle(query, paginate=True):
 
     # TODO: Add OperationOutcome to bundle attribute
     return b
+
+
+##################################################################################################
+# STREAMED BUNDLES
+##################################################################################################
+
+def bundle_should_stream(paginate=True, base=None, sort=None):
+    """
+    Whether a searchset bundle should be streamed rather than built in memory: unpaginated bundles, and keyset pages
+    with a _count above BUNDLE_STREAM_THRESHOLD.  Only base models that serialize with fhir_json are streamed.
+    """
+    if base is None or not hasattr(base, 'fhir_elements') or request.args.get('_summary') == 'count':
+        return False
+    if not paginate:
+        return True
+    threshold = current_app.config.get('BUNDLE_STREAM_THRESHOLD')
+    if threshold is None or not keyset_supported(base=base, sort=sort):
+        return False
+    return request.args.get('_count', 10, type=int) > threshold
+
+
+def stream_bundle(query, paginate=True, base=None, sort=None):
+    """
+    Return a streamed response of a searchset Bundle.  The bundle envelope is written first and each entry is
+    written as soon as it is serialized.  Rows are read from a server-side cursor (yield_per) in batches of
+    BUNDLE_STREAM_BATCH_SIZE, and related records are preloaded per batch, so memory use does not grow with the
+    number of entries.  Links and total are written after the entries, once it is known whether there is a next page.
+    :param query:
+        Un-executed SQLAlchemy query over base
+    :param paginate:
+        Whether to return one keyset page (see keyset_query) or every result
+    :param base:
+        The SQLAlchemy ORM model to which the FHIR Resource endpoint relates.  Must declare fhir_elements.
+    :param sort:
+        The '_sort' dict of the fhir_search_spec used to build the query, if any
+    :return:
+        Flask response with a generator body
+    """
+    query, elements, relations = apply_fhir_load_plan(query=query, base=base, sort=sort)
+    total = query_total(query, get_total_mode(default='none'))
+    per_page = token = None
+    if paginate:
+        query, per_page, token = keyset_query(query=query, base=base, sort=sort)
+        # Fetch one extra row to find out whether there is a next page without counting
+        query = query.limit(per_page + 1)
+    batch_size = current_app.config.get('BUNDLE_STREAM_BATCH_SIZE', 100)
+
+    def generate():
+        yield '{"resourceType": "Bundle", "type": "searchset"'
+        count = 0
+        last_record = None
+        has_next = False
+        results = iter(query.yield_per(batch_size))
+        while not has_next:
+            batch = list(islice(results, batch_size))
+            if not batch:
+                break
+            if per_page is not None and count + len(batch) > per_page:
+                has_next = True
+                batch = batch[:per_page - count]
+            preload_bundle_records(batch, relations=relations)
+            for r in batch:
+                yield (', "entry": [' if count == 0 else ', ') + \
+                      json_dumps(create_bundle_search_entry_json(obj=r, elements=elements))
+                count += 1
+                last_record = r
+        if count:
+            yield ']'
+
+        if paginate:
+            next_token = encode_page_token(sort=sort, last_record=last_record) if has_next else None
+            page = KeysetPage(items=[], has_next=has_next, next_token=next_token, token=token)
+            links = set_bundle_keyset_links(bundle=Bundle(), page=page, per_page=per_page).link
+            yield ', "link": ' + json_dumps([link.as_json() for link in links])
+            bundle_total = total
+        else:
+            bundle_total = count
+        if bundle_total is not None:
+            yield ', "total": ' + json_dumps(bundle_total)
+        yield '}'
+
+    return current_app.response_class(stream_with_context(generate()),
+                                      mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+def create_bundle_response(query, paginate=True, base=None, sort=None):
+    """
+    Execute a search query and return a response with the searchset Bundle, streamed when bundle_should_stream()
+    and otherwise built with create_bundle().  Takes the same parameters as create_bundle.
+    """
+    if bundle_should_stream(paginate=paginate, base=base, sort=sort):
+        return stream_bundle(query=query, paginate=paginate, base=base, sort=sort)
+    bundle = create_bundle(query=query, paginate=paginate, base=base, sort=sort)
+    return jsonify(bundle.as_json())
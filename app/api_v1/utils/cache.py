@@ -0,0 +1,76 @@
+import threading
+from collections import OrderedDict
+from flask import current_app
+from redis.exceptions import RedisError
+from app.extensions import redis
+
+
+class ResourceCache(object):
+    """
+    Cache of serialized FHIR resources (response bytes), keyed by a string that identifies the exact state of the
+    resource, e.g. Patient.fhir_cache_key().  Because the key changes whenever the resource changes, entries never
+    need to be invalidated, only evicted.
+
+    Entries are kept in an in-process LRU of RESOURCE_CACHE_SIZE entries.  If RESOURCE_CACHE_REDIS is set they are
+    also shared through the Redis server in app.extensions, with a RESOURCE_CACHE_TTL expiry.  Redis errors are
+    ignored so that a Redis outage only costs cache misses.
+    """
+    key_prefix = 'fhir-resource:'
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):  # pragma: no cover
+        return '<ResourceCache {} entries, {} hits, {} misses>'.format(len(self._entries), self.hits, self.misses)
+
+    def stats(self):
+        """Return a dict of the hit / miss counters and the number of in-process entries"""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+    def get(self, key):
+        """Return the cached bytes for key, or None"""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+        if current_app.config.get('RESOURCE_CACHE_REDIS'):
+            try:
+                data = redis.get(self.key_prefix + key)
+            except RedisError:
+                data = None
+            if data is not None:
+                self._store(key, data)
+                self.hits += 1
+                return data
+        self.misses += 1
+        return None
+
+    def set(self, key, data):
+        """Cache the serialized bytes for key"""
+        self._store(key, data)
+        if current_app.config.get('RESOURCE_CACHE_REDIS'):
+            try:
+                redis.setex(name=self.key_prefix + key, value=data,
+                            time=current_app.config.get('RESOURCE_CACHE_TTL', 3600))
+            except RedisError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _store(self, key, data):
+        max_entries = current_app.config.get('RESOURCE_CACHE_SIZE', 1024)
+        with self._lock:
+            self._entries[key] = data
+            self._entries.move_to_end(key)
+            while len(self._entries) > max_entries:
+                self._entries.popitem(last=False)
+
+
+resource_cache = ResourceCache()
@@ -1,6 +1,7 @@
 import functools
 import hashlib
 from flask import request, make_response
+from werkzeug.http import http_date, parse_date
 from app.api_v1.errors.exceptions import NotModifiedError, PreconditionFailedError
 
 
@@ -14,6 +15,9 @@ def etag(f):
             '@etag is only supported for GET requests'
         rv = f(*args, **kwargs)
         rv = make_response(rv)
+        if rv.is_streamed:
+            # Hashing the body would buffer the whole streamed response
+            return rv
         etag = '"' + hashlib.md5(rv.get_data()).hexdigest() + '"'
         rv.headers['Cache-Control'] = 'max-age=86400'
         rv.headers['ETag'] = etag
@@ -30,3 +34,85 @@ def etag(f):
         return rv
 
     return wrapped
+
+
+def versioned_etag(metadata_func):
+    """
+    This decorator adds a version-aware weak ETag and a Last-Modified header to the response of a FHIR read.
+    The validators come from a cheap version metadata query, so If-Match, If-None-Match and If-Modified-Since
+    are evaluated before the view runs and a 304 never builds or serializes the resource.
+    :param metadata_func:
+        Callable accepting the view keyword arguments and returning a dict with version_number, transaction_id
+        and last_modified, or None if the resource does not exist (the view is then left to respond)
+    """
+
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            # only for HEAD and GET requests
+            assert request.method in ['HEAD', 'GET'], \
+                '@versioned_etag is only supported for GET requests'
+            metadata = metadata_func(**kwargs)
+            if metadata is None:
+                return f(*args, **kwargs)
+            etag = version_etag(version_number=metadata['version_number'],
+                                transaction_id=metadata['transaction_id'])
+            last_modified = metadata['last_modified']
+            if_match = request.headers.get('If-Match')
+            if_none_match = request.headers.get('If-None-Match')
+            if_modified_since = parse_date(request.headers.get('If-Modified-Since'))
+            if if_match:
+                if not etag_matches(etag, if_match):
+                    raise PreconditionFailedError
+            elif if_none_match:
+                if etag_matches(etag, if_none_match):
+                    raise NotModifiedError
+            elif if_modified_since and last_modified:
+                # HTTP dates have one second resolution
+                if last_modified.replace(microsecond=0) <= if_modified_since.replace(tzinfo=None):
+                    raise NotModifiedError
+            rv = make_response(f(*args, **kwargs))
+            # Cached copies are revalidated with the cheap conditional request on every use
+            rv.headers['Cache-Control'] = 'no-cache'
+            rv.headers['ETag'] = etag
+            if last_modified:
+                rv.headers['Last-Modified'] = http_date(last_modified)
+            return rv
+
+        return wrapped
+
+    return decorator
+
+
+def version_etag(version_number, transaction_id=None):
+    """
+    Build the weak ETag of a versioned resource in the FHIR W/"<versionId>" form.  When edits to child rows do not
+    create a new resource version, the id of the latest versioning transaction is appended so they still change
+    the ETag.
+    :param version_number:
+        The resource versionId
+    :param transaction_id:
+        Id of the latest versioning transaction touching the resource or its children
+    :return:
+        Weak ETag string
+    """
+    if transaction_id is None:
+        return 'W/"{}"'.format(version_number)
+    return 'W/"{}.{}"'.format(version_number, transaction_id)
+
+
+def etag_matches(etag, header):
+    """
+    Weak comparison of an ETag against an If-Match or If-None-Match header value.
+    :param etag:
+        The current ETag of the resource
+    :param header:
+        Comma separated list of entity tags or *
+    :return:
+        True if the header lists the ETag or *
+    """
+    etag_list = [tag.strip() for tag in header.split(',')]
+    if '*' in etag_list:
+        return True
+    weak = [tag[2:] if tag.startswith('W/') else tag for tag in etag_list]
+    return etag[2:] in weak
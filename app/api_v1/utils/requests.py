@@ -1,6 +1,7 @@
 import functools
 from flask import request, jsonify, current_app
 from app.api_v1.utils.operation_outcome import create_operation_outcome
+from app.api_v1.errors.exceptions import ValidationError
 
 
 def enforce_fhir_mimetype_charset(f):
@@ -81,3 +82,37 @@ def enforce_fhir_mimetype_charset(f):
         return f(*args, **kwargs)
 
     return wrapped
+
+
+def fhir_requested_elements(model, args=None):
+    """
+    Resolve the _summary and _elements parameters to the top-level FHIR elements of a resource to load and build.
+    _summary=true returns the model's summary elements, text only the narrative and data everything but the
+    narrative.  _elements lists elements by name, unknown names are ignored.
+    :param model:
+        SQLAlchemy model declaring fhir_elements and fhir_summary_elements
+    :param args:
+        Request args, defaults to flask.request.args
+    :return:
+        Set of element names, or None for the whole resource
+    Raises ValidationError for an unsupported _summary value.
+    """
+    if args is None:
+        args = request.args
+    summary = args.get('_summary')
+    if summary and summary not in ['true', 'text', 'data', 'count', 'false']:
+        raise ValidationError('The _summary value {} is not supported.  Use true, text, data, count or '
+                              'false.'.format(summary))
+    if not hasattr(model, 'fhir_elements'):
+        return None
+    if summary == 'true':
+        return set(model.fhir_summary_elements)
+    if summary == 'text':
+        return {'text'}
+    elements = args.get('_elements')
+    if elements is not None:
+        requested = [element.strip() for element in elements.split(',')]
+        return set(element for element in requested if element in model.fhir_elements)
+    if summary == 'data':
+        return set(model.fhir_elements) - {'text'}
+    return None
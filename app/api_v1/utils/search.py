@@ -1,8 +1,14 @@
 from flask import request
-import unidecode
+import threading, uuid
+from collections import OrderedDict
+from types import MappingProxyType
 from app.api_v1.errors.exceptions import *
 from app.utils.type_validation import *
-from sqlalchemy import and_, or_
+from app.extensions import db
+from app.models.extensions import fold_search_text
+from sqlalchemy import func, inspect
+from sqlalchemy import and_, or_, bindparam
+from sqlalchemy.dialects import postgresql
 
 # Dict of valid FHIR STU 3 ordered search value prefixes and their SQLAlchemy column operator equivalent
 fhir_prefixes = {'eq': '__eq__',  # equal
@@ -73,7 +79,24 @@ def search_support_is_valid(support):
     return True
 
 
-def parse_fhir_search(args, base, model_support=None):
+def default_search_support(base):
+    """Search parameters supported by every FHIR resource endpoint"""
+    return {'_id': {'modifier': ['exact', 'not'],
+                    'prefix': [],
+                    'model': base,
+                    'column': ['id'],
+                    'type': 'int',
+                    'validation': []},
+            '_lastUpdated': {'modifier': [],
+                             'prefix': ['gt', 'ge', 'lt', 'le', 'eq', 'ne'],
+                             'model': base,
+                             'column': ['updated_at'],
+                             'type': 'datetime',
+                             'validation': []}
+            }
+
+
+def parse_fhir_search(args, base, model_support=None, support=None):
     """
     Function parse_fhir_search()
         Handles request URL parameters from a FHIR search endpoint and noramlizes / parses values to a fhir_search_spec
@@ -141,6 +164,10 @@ def parse_fhir_search(args, base, model_support=None):
                 }
         }
 
+    :param support:
+        Optional, already validated and merged support mapping (e.g. SearchRegistry.support).  When supplied,
+        model_support is ignored and no validation is repeated.
+
     :return:
         A dictionary which is  the translation of the FHIR Search parameters supplied via the request
         into a data structure that can be dynamically applied to an un-executed SQLAlchemy query.  Each
@@ -159,23 +186,11 @@ def parse_fhir_search(args, base, model_support=None):
     ##############################################################
     # FHIR Search Support Compilation
     ##############################################################
-    default_support = {'_id': {'modifier': ['exact', 'not'],
-                               'prefix': [],
-                               'model': base,
-                               'column': ['id'],
-                               'type': 'int',
-                               'validation': []},
-                       '_lastUpdated': {'modifier': [],
-                                        'prefix': ['gt', 'ge', 'lt', 'le', 'eq', 'ne'],
-                                        'model': base,
-                                        'column': ['updated_at'],
-                                        'type': 'datetime',
-                                        'validation': []}
-                       }
     # Build one search support dictionary by combining the default and model support dicts
-    if model_support and not search_support_is_valid(support=model_support):
-        raise ValueError('Invalid model search support')
-    support = {**default_support, **model_support}
+    if support is None:
+        if model_support and not search_support_is_valid(support=model_support):
+            raise ValueError('Invalid model search support')
+        support = {**default_search_support(base), **(model_support or {})}
 
     # Initialize the dict that will be generated as output
     fhir_search_spec = {}
@@ -186,6 +201,7 @@ def parse_fhir_search(args, base, model_support=None):
         op = None
         value = None
         column = None
+        fold = False  # Whether the value is matched against the folded *_search columns
         value_forced_by_operator = False  # This is to track whether the operator determines the value
 
         arg_split = arg.split(':')  # Attempt to split args to determine if modifier exists
@@ -193,7 +209,7 @@ def parse_fhir_search(args, base, model_support=None):
         input_value = request.args.get(arg)  # Get the raw value for the parameter
 
         # Ignore parameters handled elsewhere with bundle and pagination decorators
-        if search_key in ['page', '_count', '_format', '_summary']:
+        if search_key in ['page', '_count', '_format', '_summary', '_elements', '_page_token', '_total']:
             continue
 
         ##############################################################
@@ -328,12 +344,16 @@ def parse_fhir_search(args, base, model_support=None):
                 # FHIR String Value Handling
                 ##############################################################
                 elif param_type == 'string':  # Deal with case comparison
-                    input_value = unidecode.unidecode(input_value)  # Handle accents per FHIR
-                    if op == 'ilike':  # Handles the :contains modifier for string parameters
-                        value = '%' + str(input_value) + '%'
-                    if not op:  # If no modifier is defined for string parameters a case-insensitive starts_with comp
-                        op = 'ilike'
-                        value = str(input_value) + '%'
+                    # Default and :contains searches are case and accent insensitive per FHIR.  The value is folded
+                    # the same way as the *_search columns are at write time, so a plain LIKE can use their indexes
+                    if not op or op == 'ilike':
+                        folded_value = fold_search_text(input_value)
+                        if op == 'ilike':  # Handles the :contains modifier for string parameters
+                            value = '%' + folded_value + '%'
+                        else:  # If no modifier is defined for string parameters a starts_with comparison
+                            value = folded_value + '%'
+                        op = 'like'
+                        fold = True
 
                 ##############################################################
                 # FHIR Token / Code Value Handling
@@ -377,6 +397,11 @@ def parse_fhir_search(args, base, model_support=None):
                 # Assign the column if it hasn't been set yet
                 if not column:
                     column = support[search_key].get('column')
+                    # A token without a system is matched against the columns of every supported system that can
+                    # hold the value
+                    if hasattr(column, 'values'):
+                        column = token_columns(model=support[search_key].get('model'), columns=column.values(),
+                                               value=value, op=op)
 
             # Assign the default operator '__eq__'
             if not op:
@@ -386,12 +411,49 @@ def parse_fhir_search(args, base, model_support=None):
             fhir_search_spec[search_key] = {'op': op,
                                             'value': value,
                                             'model': support[search_key].get('model'),
-                                            'column': column}
+                                            'column': column,
+                                            'fold': fold}
         else:
             raise ValidationError('An unknown parameter ({}) was passed to the search query'.format(search_key))
     return fhir_search_spec
 
 
+def token_columns(model, columns, value, op=None):
+    """
+    Return the columns a token value without a system is compared against.  UUID columns are only compared when the
+    value is a UUID and the operator is an equality test, since PostgreSQL rejects any other comparison with a uuid.
+    Ex: identifier=123-45-6789 is matched against the ssn column only.
+    :raises ValidationError:
+        If the value cannot be compared against any of the columns
+    """
+    result = []
+    for name in columns:
+        if isinstance(getattr(model, name).type, postgresql.UUID):
+            if op not in [None, '__eq__', '__ne__']:
+                continue
+            try:
+                uuid.UUID(str(value))
+            except ValueError:
+                continue
+        result.append(name)
+    if not result:
+        raise ValidationError('The value ({}) is not valid for any system of the search parameter'.format(value))
+    return result
+
+
+def search_column(model, column, spec):
+    """
+    Return the column a fhir_search_spec entry is compared against.  Folded string searches use the model's
+    *_search column (see Model.search_columns), or upper(column) for a column without one.
+    """
+    if spec.get('fold'):
+        search_column_name = getattr(model, 'search_columns', {}).get(column)
+        if search_column_name:
+            return getattr(model, search_column_name)
+        return func.upper(getattr(model, column))
+    return getattr(model, column)
+
+
 def fhir_apply_search_to_query(fhir_search_spec, base, query=None):
     """
     Take an un-executed SQLAlchemy query instance, a specification output from parse_fhir_search and a base
@@ -404,7 +466,8 @@ def fhir_apply_search_to_query(fhir_search_spec, base, query=None):
             {'op': '__eq__',        # SQLAlchemy column operator
             'value': value,         # Value to be filtered / sorted on
             'model': model,         # SQLAlchemy ORM model to apply the search to
-            'column': column}       # Name of column within ORM model on which to apply value and operator
+            'column': column,       # Name of column within ORM model on which to apply value and operator
+            'fold': False}          # Match the value against the folded *_search column
         }
 
     :param query:
@@ -424,44 +487,210 @@ def fhir_apply_search_to_query(fhir_search_spec, base, query=None):
     ##############################################################
     # Loop through query search specification dicts
     ##############################################################
-    executed_joins = []  # Keep track of models that have been joined already so you don't join twice
     for key in fhir_search_spec.keys():
-        column_spec = fhir_search_spec[key]['column']
-        model = fhir_search_spec[key]['model']
-
-        # Execute a join if model does not match base model
-        if model != base and model not in executed_joins:
-            query = query.join(model)
-            executed_joins.append(model)
-
         # Handle sort operations
         if key == '_sort':
-            column = getattr(model, column_spec[0])
-            op = fhir_search_spec[key]['op']
-            query = query.order_by(getattr(column, op)())
+            query = query.order_by(search_order(base=base, spec=fhir_search_spec[key]))
             continue
 
-        # Handle most common situation where only one model attribute must be considered for filtering
-        if len(column_spec) == 1:
-            column = getattr(model, column_spec[0])  # Get the column on the model
-            op = fhir_search_spec[key]['op']  # Get the operator for the column
-            value = fhir_search_spec[key]['value']  # Get the value from the dict
-            query = query.filter(getattr(column, op)(value))  # Dynamically construct the query
+        query = query.filter(search_criterion(base=base, spec=fhir_search_spec[key],
+                                              value=fhir_search_spec[key]['value']))
+
+    return query
+
+
+def child_relationship(base, model):
+    """
+    Return the relationship on the base model that targets a child model, e.g. Patient.addresses for Address
+    Raises ValueError if the base model has no relationship to the model.
+    """
+    for relationship in inspect(base).relationships:
+        if relationship.mapper.class_ is model:
+            return relationship
+    raise ValueError('{} has no relationship to {}'.format(base.__name__, model.__name__))
+
+
+def search_criterion(base, spec, value=None, column_values=None):
+    """
+    Build the filter criterion for one fhir_search_spec entry.
+    When more than one column is listed, the operator and value will be applied to each column with OR logic
+    between them.  Ex:  column1 = value or column2 = value or column3 = value
+    Parameters on a child model (e.g. Address) are compiled to an EXISTS subquery correlated on the base model,
+    so a patient with several matching addresses is still returned once and no join is needed.
+    :param value:
+        The value or bind parameter to compare against
+    :param column_values:
+        Optional list of values or bind parameters, one per column, used instead of value
+    """
+    model = spec['model']
+    op = spec['op']
+    values = column_values if column_values is not None else [value] * len(spec['column'])
+    filter_list = [getattr(search_column(model, col, spec), op)(col_value)
+                   for col, col_value in zip(spec['column'], values)]
+    criterion = filter_list[0] if len(filter_list) == 1 else or_(*filter_list)
+    if model != base:
+        criterion = getattr(base, child_relationship(base, model).key).any(criterion)
+    return criterion
+
+
+def search_order(base, spec):
+    """
+    Build the ORDER BY clause for the '_sort' fhir_search_spec entry.  Sorting on a child model column orders by
+    a correlated min() (ascending) or max() (descending) of that column over the base record's children, so each
+    base record still appears once.
+    """
+    model = spec['model']
+    column = getattr(model, spec['column'][0])
+    if model != base:
+        aggregate = func.max(column) if spec['op'] == 'desc' else func.min(column)
+        column = db.session.query(aggregate).filter(child_relationship(base, model).primaryjoin) \
+            .correlate(base).as_scalar()
+    return getattr(column, spec['op'])()
+
 
-        # Handle situations where >1 attribute must be considered in the operation
-        # In this case, the operator and value will be applied to each attribute with OR logic
-        # between them.  Ex:  column1 = value or column2 = value or column3 = value
+##################################################################################################
+# COMPILED SEARCH REGISTRY AND CACHED SEARCH PLANS
+##################################################################################################
+
+class SearchPlan(object):
+    """
+    The filter criteria and ordering for one search shape, built with bind parameters in place of search values.
+    A plan is compiled once per shape and applied to each request's query with that request's values, so the SQL
+    text is identical for every request of the same shape.
+    """
+
+    def __init__(self, criteria, order_by, binds):
+        self.criteria = tuple(criteria)
+        self.order_by = tuple(order_by)
+        # Dict of {bind parameter name: search parameter key}
+        self.binds = MappingProxyType(binds)
+
+    def bind_values(self, fhir_search_spec):
+        return {name: fhir_search_spec[key]['value'] for name, key in self.binds.items()}
+
+    def apply(self, query, fhir_search_spec):
+        """Apply the plan to an un-executed query, binding the values from fhir_search_spec"""
+        if self.criteria:
+            query = query.filter(*self.criteria)
+        if self.order_by:
+            query = query.order_by(*self.order_by)
+        if self.binds:
+            query = query.params(**self.bind_values(fhir_search_spec))
+        return query
+
+
+def search_shape(fhir_search_spec):
+    """
+    Return a hashable key describing the structure of a fhir_search_spec, ignoring bound values: the parameters,
+    operators, models and columns.  Values that are not bound as parameters (None and is / is not comparisons) are
+    part of the shape.
+    """
+    shape = []
+    for key in sorted(fhir_search_spec):
+        spec = fhir_search_spec[key]
+        value = spec.get('value')
+        shape.append((key, spec['op'], spec['model'].__name__, tuple(spec['column']), bool(spec.get('fold')),
+                      None if search_value_is_bound(spec) else value))
+    return tuple(shape)
+
+
+def search_value_is_bound(spec):
+    """Whether the value of a fhir_search_spec entry is passed as a bind parameter"""
+    return spec.get('value') is not None and spec['op'] not in ['is_', 'isnot']
+
+
+def compile_search_plan(fhir_search_spec, base):
+    """
+    Build a SearchPlan from a fhir_search_spec.  Applies the same filters and ordering as
+    fhir_apply_search_to_query, with each search value replaced by a bind parameter.
+    """
+    criteria = []
+    order_by = []
+    binds = {}
+    for index, key in enumerate(sorted(fhir_search_spec)):
+        spec = fhir_search_spec[key]
+
+        if key == '_sort':
+            order_by.append(search_order(base=base, spec=spec))
+            continue
+
+        if search_value_is_bound(spec):
+            # One bind parameter per column, typed from that column
+            params = [bindparam('search_{}_{}'.format(index, position), type_=getattr(spec['model'], column).type,
+                                expanding=spec['op'] in ['in_', 'notin_'])
+                      for position, column in enumerate(spec['column'])]
+            for param in params:
+                binds[param.key] = key
+            criteria.append(search_criterion(base=base, spec=spec, column_values=params))
         else:
-            filter_list = []  # Initialize a list of filter statements that will be applied
-            op = fhir_search_spec[key]['op']
-            value = fhir_search_spec[key]['value']
-            for col in column_spec:
-                column = getattr(model, col)
-                filt = getattr(column, op)(value)
-                filter_list.append(filt)
-            query = query.filter(or_(*filter_list))
+            criteria.append(search_criterion(base=base, spec=spec, value=spec['value']))
 
-    return query
+    return SearchPlan(criteria=criteria, order_by=order_by, binds=binds)
+
+
+def freeze_search_support(support):
+    """Return a read-only copy of a search support dict, with column lists converted to tuples"""
+    frozen = {}
+    for key, param in support.items():
+        param = dict(param)
+        for attr in ['modifier', 'prefix', 'column']:
+            if isinstance(param.get(attr), dict):
+                param[attr] = MappingProxyType(dict(param[attr]))
+            elif isinstance(param.get(attr), list):
+                param[attr] = tuple(param[attr])
+        frozen[key] = MappingProxyType(param)
+    return MappingProxyType(frozen)
+
+
+class SearchRegistry(object):
+    """
+    Search parameters supported by one FHIR resource.  The model_support dict is validated and merged with the
+    default parameters once, when the registry is created, into a read-only mapping.  Search plans are compiled
+    per search shape (see search_shape) and kept in a bounded LRU cache.
+    """
+
+    def __init__(self, base, model_support=None, max_plans=256):
+        if model_support and not search_support_is_valid(support=model_support):
+            raise ValueError('Invalid model search support')
+        self.base = base
+        self.support = freeze_search_support({**default_search_support(base), **(model_support or {})})
+        self.max_plans = max_plans
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):  # pragma: no cover
+        return '<SearchRegistry {}: {} parameters, {} plans>'.format(self.base.__name__, len(self.support),
+                                                                    len(self._plans))
+
+    def parse(self, args):
+        """Parse request args into a fhir_search_spec using the registry's support mapping"""
+        return parse_fhir_search(args=args, base=self.base, support=self.support)
+
+    def get_plan(self, fhir_search_spec):
+        """Return the cached SearchPlan for the shape of fhir_search_spec, compiling it on first use"""
+        shape = search_shape(fhir_search_spec)
+        with self._lock:
+            plan = self._plans.get(shape)
+            if plan is not None:
+                self._plans.move_to_end(shape)
+                return plan
+        plan = compile_search_plan(fhir_search_spec=fhir_search_spec, base=self.base)
+        with self._lock:
+            self._plans[shape] = plan
+            while len(self._plans) > self.max_plans:
+                self._plans.popitem(last=False)
+        return plan
+
+    def search(self, args, query=None):
+        """
+        Parse the request args and apply the cached plan for their shape to the query.
+        :return:
+            Tuple of (un-executed query, fhir_search_spec)
+        """
+        if not query:
+            query = self.base.query
+        fhir_search_spec = self.parse(args)
+        return self.get_plan(fhir_search_spec).apply(query=query, fhir_search_spec=fhir_search_spec), fhir_search_spec
 
 
 def fhir_search(args, model_support, base, query):
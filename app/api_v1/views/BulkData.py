@@ -0,0 +1,168 @@
+import shutil
+from dateutil import parser as dateparser, tz
+from flask import request, url_for, current_app, g, abort, send_from_directory
+
+from app.api_v1.authentication import token_auth
+from app.api_v1.errors.user_errors import *
+from app.api_v1.errors.fhir_errors import fhir_error_response
+from app.api_v1.utils.rate_limit import rate_limit
+from app.api_v1.utils.requests import enforce_fhir_mimetype_charset
+from app.api_v1.utils.operation_outcome import create_operation_outcome
+from app.extensions import db
+from app.models.bulk_export import BulkExportJob
+from app.utils.bulk_export import export_models, export_directory, start_export_job, fail_stale_export_jobs
+from app.utils.bulk_import import PatientBulkLoader, iter_fhir_ndjson, iter_fhir_resource
+
+
+##############################################################
+# FHIR BULK DATA EXPORT
+##############################################################
+
+@api_bp.route('/fhir/Patient/$export', methods=['GET'])
+@token_auth.login_required
+@enforce_fhir_mimetype_charset
+@rate_limit(limit=5, period=15)
+def patient_export():
+    """
+    FHIR Bulk Data kick-off request.  Creates an export job, runs it in the background and returns 202 Accepted
+    with the status polling url in Content-Location.
+    """
+    if 'respond-async' not in request.headers.get('Prefer', ''):
+        raise ValidationError('Bulk data export requires the header Prefer: respond-async')
+
+    output_format = request.args.get('_outputFormat')
+    if output_format and output_format not in ['application/fhir+ndjson', 'application/ndjson', 'ndjson']:
+        raise ValidationError('The _outputFormat {} is not supported.  Use application/fhir+ndjson.'.format(
+            output_format))
+
+    resource_types = [t.strip() for t in request.args.get('_type', 'Patient').split(',') if t.strip()]
+    for resource_type in resource_types:
+        if resource_type not in export_models:
+            raise ValidationError('The _type {} is not supported for export.'.format(resource_type))
+
+    since = request.args.get('_since')
+    if since:
+        try:
+            # Stored datetimes are naive UTC
+            since = dateparser.parse(since)
+            if since.tzinfo is not None:
+                since = since.astimezone(tz.tzutc()).replace(tzinfo=None)
+        except ValueError:
+            raise ValidationError('The _since value {} is not a valid FHIR instant.'.format(since))
+
+    job = BulkExportJob(request_url=request.url, base_url=request.host_url, resource_types=resource_types,
+                        since=since or None, user_id=g.current_user.id)
+    db.session.add(job)
+    db.session.commit()
+    start_export_job(app=current_app._get_current_object(), job_id=job.id)
+
+    response = current_app.response_class(status=202)
+    response.headers['Content-Location'] = url_for('api_v1.export_status', job_uuid=job.uuid, _external=True)
+    return response
+
+
+def get_export_job(job_uuid):
+    """
+    Return the export job with the uuid if it was requested by the current user and has not been deleted, or abort
+    with a 404
+    """
+    job = BulkExportJob.query.filter(BulkExportJob.uuid == str(job_uuid)).first()
+    if job is None or job.user_id != g.current_user.id or job.status == 'deleted':
+        abort(404)
+    return job
+
+
+@api_bp.route('/fhir/$export-poll-status/<uuid:job_uuid>', methods=['GET'])
+@token_auth.login_required
+@rate_limit(limit=5, period=15)
+def export_status(job_uuid):
+    """
+    Bulk Data status request.  202 with an X-Progress header while the export runs, the output manifest once it has
+    completed and an OperationOutcome if it failed.  Jobs lost to a restart are reported as failed.
+    """
+    fail_stale_export_jobs(current_app)
+    job = get_export_job(job_uuid)
+    if job.status in ['accepted', 'in-progress']:
+        response = current_app.response_class(status=202)
+        response.headers['X-Progress'] = job.status
+        response.headers['Retry-After'] = str(current_app.config.get('EXPORT_RETRY_AFTER', 10))
+        return response
+    if job.status != 'completed':
+        return fhir_error_response(status_code=500, outcome_list=[
+            {'severity': 'error', 'type': 'exception', 'diagnostics': job.error or 'The export failed',
+             'details': 'Bulk data export {}'.format(job.status)}])
+
+    manifest = {'transactionTime': job.transaction_time.isoformat() + 'Z',
+                'request': job.request_url,
+                'requiresAccessToken': True,
+                'output': [{'type': o['type'], 'count': o['count'],
+                            'url': url_for('api_v1.export_file', job_uuid=job.uuid, filename=o['file'],
+                                           _external=True)} for o in job.output or []],
+                'error': []}
+    response = jsonify(manifest)
+    response.status_code = 200
+    return response
+
+
+@api_bp.route('/fhir/$export-poll-status/<uuid:job_uuid>', methods=['DELETE'])
+@token_auth.login_required
+@rate_limit(limit=5, period=15)
+def export_delete(job_uuid):
+    """
+    Delete an export: a running export is stopped and the files of a finished one are removed.  Later status and
+    file requests for the job return 404.
+    """
+    job = get_export_job(job_uuid)
+    job.status = 'deleted'
+    db.session.commit()
+    # A running export removes the files it writes after this itself, see run_export_job()
+    shutil.rmtree(export_directory(current_app, job), ignore_errors=True)
+    response = current_app.response_class(status=202)
+    return response
+
+
+@api_bp.route('/fhir/$export-file/<uuid:job_uuid>/<filename>', methods=['GET'])
+@token_auth.login_required
+@rate_limit(limit=5, period=15)
+def export_file(job_uuid, filename):
+    """Download one NDJSON file of a completed export"""
+    job = get_export_job(job_uuid)
+    if job.status != 'completed' or filename not in [o['file'] for o in job.output or []]:
+        abort(404)
+    return send_from_directory(export_directory(current_app, job), filename, mimetype='application/fhir+ndjson')
+
+
+##############################################################
+# FHIR BULK DATA IMPORT
+##############################################################
+
+@api_bp.route('/fhir/$import', methods=['POST'])
+@token_auth.login_required
+@rate_limit(limit=5, period=15)
+def bulk_import():
+    """
+    Load the Patient resources in the request body: NDJSON (application/fhir+ndjson), read a line at a time from
+    the request stream, or a Bundle or single resource as JSON.  Patients are inserted in batches of
+    IMPORT_BATCH_SIZE and an OperationOutcome reports the counts and throughput.
+    """
+    loader = PatientBulkLoader(batch_size=current_app.config.get('IMPORT_BATCH_SIZE', 500),
+                               user_id=g.current_user.id)
+    try:
+        if request.mimetype in ['application/fhir+ndjson', 'application/ndjson']:
+            loader.load(iter_fhir_ndjson(request.stream))
+        else:
+            body = request.get_json(force=True, silent=True)
+            if not isinstance(body, dict):
+                raise ValidationError('The request body is not a FHIR resource, Bundle or NDJSON')
+            loader.load(iter_fhir_resource(body))
+    except ValueError as e:
+        # Batches already committed are kept
+        raise ValidationError('Invalid NDJSON in the request body after {} patients: {}'.format(loader.loaded, e))
+
+    outcome_list = [{'severity': 'information', 'type': 'informational', 'diagnostics': loader.summary(),
+                     'details': 'Bulk data import'}]
+    outcome_list.extend({'severity': 'warning', 'type': 'invalid', 'diagnostics': error,
+                         'details': 'Resource not imported'} for error in loader.errors)
+    response = jsonify(create_operation_outcome(outcome_list=outcome_list).as_json())
+    response.status_code = 200
+    return response
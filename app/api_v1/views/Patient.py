@@ -1,30 +1,140 @@
-from flask import request, url_for
+from flask import request, url_for, abort, current_app
 
 from app.api_v1.authentication import token_auth
 from app.api_v1.errors.user_errors import *
 from app.api_v1.utils.rate_limit import rate_limit
-from app.api_v1.utils.etag import etag
-from app.api_v1.utils.bundle import create_bundle
-from app.api_v1.utils.search import fhir_search
-from app.api_v1.utils.requests import enforce_fhir_mimetype_charset
+from app.api_v1.utils.etag import etag, versioned_etag
+from app.api_v1.utils.bundle import create_bundle_response
+from app.api_v1.utils.cache import resource_cache
+from app.api_v1.utils.search import SearchRegistry
+from app.api_v1.utils.requests import enforce_fhir_mimetype_charset, fhir_requested_elements
 from app.models.fhir.patient import Patient
 from app.models.fhir.address import Address
 from app.models.fhir.email_address import EmailAddress
 from app.models.fhir.phone_number import PhoneNumber
 
 
+##############################################################
+# Declare FHIR Search Parameters Supported
+##############################################################
+patient_search_support = {'active': {'modifier': ['not'],
+                                     'prefix': [],
+                                     'model': Patient,
+                                     'column': ['active'],
+                                     'type': 'bool'},
+                          'deceased': {'modifier': ['not'],
+                                       'prefix': [],
+                                       'model': Patient,
+                                       'column': ['deceased'],
+                                       'type': 'bool'},
+                          'birthdate': {'modifier': [],
+                                        'prefix': ['gt', 'ge', 'lt', 'le', 'eq', 'ne'],
+                                        'model': Patient,
+                                        'column': ['dob'],
+                                        'type': 'date'},
+                          'death-date': {'modifier': [],
+                                         'prefix': ['gt', 'ge', 'lt', 'le', 'eq', 'ne'],
+                                         'model': Patient,
+                                         'column': ['deceased_date'],
+                                         'type': 'date'},
+                          'given': {'modifier': ['exact', 'contains', 'missing'],
+                                    'prefix': [],
+                                    'model': Patient,
+                                    'column': ['first_name', 'middle_name'],  # Will search both with or condition
+                                    'type': 'string'},
+                          'family': {'modifier': ['exact', 'contains', 'missing'],
+                                     'prefix': [],
+                                     'model': Patient,
+                                     'column': ['last_name'],
+                                     'type': 'string'},
+                          'name': {'modifier': ['exact', 'contains', 'missing'],
+                                   'prefix': [],
+                                   'model': Patient,
+                                   'column': ['last_name', 'first_name', 'middle_name', 'suffix', 'prefix'],
+                                   'type': 'string'},
+                          'gender': {'modifier': ['exact', 'contains', 'missing'],
+                                     'prefix': [],
+                                     'model': Patient,
+                                     'column': ['sex'],
+                                     'type': 'string'},
+                          'address-city': {'modifier': ['exact', 'contains', 'missing'],
+                                           'prefix': [],
+                                           'model': Address,
+                                           'column': ['city'],
+                                           'type': 'string'},
+                          'address-state': {'modifier': ['exact', 'contains', 'missing'],
+                                            'prefix': [],
+                                            'model': Address,
+                                            'column': ['state'],
+                                            'type': 'string'},
+                          'address-postalcode': {'modifier': ['exact', 'contains', 'missing'],
+                                                 'prefix': [],
+                                                 'model': Address,
+                                                 'column': ['zipcode'],
+                                                 'type': 'string'},
+                          'address-country': {'modifier': ['exact', 'contains', 'missing'],
+                                              'prefix': [],
+                                              'model': Address,
+                                              'column': ['country'],
+                                              'type': 'string'},
+                          'address': {'modifier': ['exact', 'contains', 'missing'],
+                                      'prefix': [],
+                                      'model': Address,
+                                      'column': ['address1', 'address2', 'city', 'state', 'zipcode', 'country'],
+                                      'type': 'string'},
+                          'email': {'modifier': ['exact', 'contains', 'missing'],
+                                    'prefix': [],
+                                    'model': EmailAddress,
+                                    'column': ['email'],
+                                    'type': 'string'},  # TODO validate email address w/ exact
+                          'phone': {'modifier': ['exact', 'contains', 'missing'],
+                                    'prefix': [],
+                                    'model': PhoneNumber,
+                                    'column': ['number'],
+                                    'type': 'string'},  # TODO validate phone w/ exact
+                          'language': {'modifier': ['exact', 'contains', 'missing'],
+                                       'prefix': [],
+                                       'model': Patient,
+                                       'column': ['preferred_language'],
+                                       'type': 'string'},
+                          'identifier': {'modifier': ['exact', 'contains'],  # TODO: Support missing
+                                         'prefix': [],
+                                         'model': Patient,
+                                         'column': {'http://unkani.com': 'uuid',
+                                                    'http://hl7.org/fhir/sid/us-ssn': 'ssn'},
+                                         'type': 'token'}  # TODO:  Validate SSN - match without hyphens
+                          }
+
+# Compiled once: validated, read-only search parameter registry with cached search plans
+patient_search_registry = SearchRegistry(base=Patient, model_support=patient_search_support)
+
+
 @api_bp.route('/fhir/Patient/<patientid>', methods=['GET'])
 @token_auth.login_required
 @enforce_fhir_mimetype_charset
 @rate_limit(limit=5, period=15)
-@etag
+@versioned_etag(Patient.get_fhir_version_metadata)
 def patient_read(patientid):
     """
     Return a FHIR STU 3.0 Patient resource as JSON.
+    Conditional requests are answered from the patient version metadata before the resource is loaded.
     """
-    pt = Patient.query.get_or_404(ident=patientid)
-    data = pt.dump_fhir_json()
-    response = jsonify(data)
+    # _summary and _elements limit what is loaded and built
+    elements = fhir_requested_elements(Patient)
+    pt = Patient.get_fhir_read(patientid=patientid, elements=elements)
+    if pt is None:
+        abort(404)
+    if elements is None:
+        # Serve the serialized resource from cache when the patient, its children and codesets are unchanged.
+        # Resource ids are absolute urls, so the host is part of the key.
+        cache_key = '{}|{}'.format(pt.fhir_cache_key(), request.host_url)
+        data = resource_cache.get(cache_key)
+        if data is None:
+            data = jsonify(pt.fhir_json()).get_data()
+            resource_cache.set(cache_key, data)
+    else:
+        data = jsonify(pt.fhir_json(elements=elements)).get_data()
+    response = current_app.response_class(data, mimetype=current_app.config['JSONIFY_MIMETYPE'])
     response.headers['Location'] = url_for('api_v1.patient_read', patientid=pt.id)
     response.headers['Content-Type'] = 'application/fhir+json'
     response.status_code = 200
@@ -78,102 +188,10 @@ def patient_search():
     # Initialize a query that will be added to dynamically according to url params
     query = Patient.query
 
-    ##############################################################
-    # Declare FHIR Search Parameters Supported
-    ##############################################################
-    model_support = {'active': {'modifier': ['not'],
-                                'prefix': [],
-                                'model': Patient,
-                                'column': ['active'],
-                                'type': 'bool'},
-                     'deceased': {'modifier': ['not'],
-                                  'prefix': [],
-                                  'model': Patient,
-                                  'column': ['deceased'],
-                                  'type': 'bool'},
-                     'birthdate': {'modifier': [],
-                                   'prefix': ['gt', 'ge', 'lt', 'le', 'eq', 'ne'],
-                                   'model': Patient,
-                                   'column': ['dob'],
-                                   'type': 'date'},
-                     'death-date': {'modifier': [],
-                                    'prefix': ['gt', 'ge', 'lt', 'le', 'eq', 'ne'],
-                                    'model': Patient,
-                                    'column': ['deceased_date'],
-                                    'type': 'date'},
-                     'given': {'modifier': ['exact', 'contains', 'missing'],
-                               'prefix': [],
-                               'model': Patient,
-                               'column': ['first_name', 'middle_name'],  # Will search both with or condition
-                               'type': 'string'},
-                     'family': {'modifier': ['exact', 'contains', 'missing'],
-                                'prefix': [],
-                                'model': Patient,
-                                'column': ['last_name'],
-                                'type': 'string'},
-                     'name': {'modifier': ['exact', 'contains', 'missing'],
-                              'prefix': [],
-                              'model': Patient,
-                              'column': ['last_name', 'first_name', 'middle_name', 'suffix', 'prefix'],
-                              'type': 'string'},
-                     'gender': {'modifier': ['exact', 'contains', 'missing'],
-                                'prefix': [],
-                                'model': Patient,
-                                'column': ['sex'],
-                                'type': 'string'},
-                     'address-city': {'modifier': ['exact', 'contains', 'missing'],
-                                      'prefix': [],
-                                      'model': Address,
-                                      'column': ['city'],
-                                      'type': 'string'},
-                     'address-state': {'modifier': ['exact', 'contains', 'missing'],
-                                       'prefix': [],
-                                       'model': Address,
-                                       'column': ['state'],
-                                       'type': 'string'},
-                     'address-postalcode': {'modifier': ['exact', 'contains', 'missing'],
-                                            'prefix': [],
-                                            'model': Address,
-                                            'column': ['zipcode'],
-                                            'type': 'string'},
-                     'address-country': {'modifier': ['exact', 'contains', 'missing'],
-                                         'prefix': [],
-                                         'model': Address,
-                                         'column': ['country'],
-                                         'type': 'string'},
-                     'address': {'modifier': ['exact', 'contains', 'missing'],
-                                 'prefix': [],
-                                 'model': Address,
-                                 'column': ['address1', 'address2', 'city', 'state', 'zipcode', 'country'],
-                                 'type': 'string'},
-                     'email': {'modifier': ['exact', 'contains', 'missing'],
-                               'prefix': [],
-                               'model': EmailAddress,
-                               'column': ['email'],
-                               'type': 'string'},  # TODO validate email address w/ exact
-                     'phone': {'modifier': ['exact', 'contains', 'missing'],
-                               'prefix': [],
-                               'model': PhoneNumber,
-                               'column': ['number'],
-                               'type': 'string'},  # TODO validate phone w/ exact
-                     'language': {'modifier': ['exact', 'contains', 'missing'],
-                                  'prefix': [],
-                                  'model': Patient,
-                                  'column': ['preferred_language'],
-                                  'type': 'string'},
-                     'identifier': {'modifier': ['exact', 'contains'],  # TODO: Support missing
-                                    'prefix': [],
-                                    'model': Patient,
-                                    'column': {'http://unkani.com': 'uuid', 'http://hl7.org/fhir/sid/us-ssn': 'ssn'},
-                                    'type': 'token'}  # TODO:  Validate SSN - match without hyphens
-                     }
-    # Parse the request args and execute the search.  Return un-executed query
-    query = fhir_search(args=request.args, model_support=model_support, base=Patient, query=query)
-    # Pass the query to be executed to bundle/pagination utility
-    bundle = create_bundle(query=query, paginate=True)
-
-    # Create the response from bundle JSON
-    response = jsonify(bundle.as_json())
+    # Parse the request args and apply the cached search plan for their shape.  Return un-executed query
+    query, fhir_search_spec = patient_search_registry.search(args=request.args, query=query)
+    # Pass the query to be executed to bundle/pagination utility.  Large pages are streamed.
+    response = create_bundle_response(query=query, paginate=True, base=Patient, sort=fhir_search_spec.get('_sort'))
     response.status_code = 200
     return response
 
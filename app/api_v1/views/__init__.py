@@ -1 +1 @@
-from . import CodeSystem, Patient, User, ValueSet
+from . import BulkData, CodeSystem, Patient, User, ValueSet
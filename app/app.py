@@ -18,7 +18,7 @@ from app.models.app_group import AppGroup, user_app_group
 from app.models.fhir.phone_number import PhoneNumber, PhoneNumberAPI
 from app.models.fhir.organization import Organization
 from app.models.source_data import SourceData
-from app.models.fhir.codesets import CodeSystem, ValueSet
+from app.models.fhir.codesets import CodeSystem, ValueSet, Concept
 
 
 def create_app(config_name=None):
@@ -61,7 +61,7 @@ def register_shell_context(app):
                     Patient=Patient, Address=Address, EmailAddress=EmailAddress, AppGroup=AppGroup, UserAPI=UserAPI,
                     user_app_group=user_app_group, EmailAddressAPI=EmailAddressAPI, PhoneNumberAPI=PhoneNumberAPI,
                     role_app_permission=role_app_permission, AddressAPI=AddressAPI, Organization=Organization,
-                    SourceData=SourceData, CodeSystem=CodeSystem, ValueSet=ValueSet,
+                    SourceData=SourceData, CodeSystem=CodeSystem, ValueSet=ValueSet, Concept=Concept,
                     or_=or_, and_=and_, any_=any_)
 
     app.shell_context_processor(shell_context)
@@ -76,6 +76,12 @@ def register_commands(app):
     app.cli.add_command(commands.gunicorn)
     app.cli.add_command(commands.patients)
     app.cli.add_command(commands.synthea)
+    app.cli.add_command(commands.index_concepts)
+    app.cli.add_command(commands.explain_search)
+    app.cli.add_command(commands.patient_narratives)
+    app.cli.add_command(commands.benchmark_serializers)
+    app.cli.add_command(commands.import_fhir)
+    app.cli.add_command(commands.load_seed)
     return None
 
 
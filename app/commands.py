@@ -1,16 +1,19 @@
 import os, subprocess, sys, time, click, unittest
-from flask import current_app
+from flask import current_app, request
 from flask.cli import with_appcontext
 from app.extensions import db
 from app.utils.demographics import random_demographics
-from app.utils.synthea import run_synthea
-from app.models.fhir.codesets import process_fhir_codeset, get_fhir_codeset
+from app.utils.synthea import run_synthea, run_synthea_pipeline
+from app.utils.bulk_import import PatientBulkLoader, SeedLoader, iter_fhir_paths, bulk_create_random_patients
+from app.models.fhir.codesets import process_fhir_codeset, get_fhir_codeset, CodeSystem, ValueSet, terminology_cache
 from app.models.user import User
 from app.models.role import Role
 from app.models.fhir.patient import Patient
 from app.models.app_permission import AppPermission
 from app.models.app_group import AppGroup
 from app.models.source_data import SourceData
+from app.api_v1.utils.bundle import explain_query
+from app.api_v1.views.Patient import patient_search_registry
 
 
 @click.command()
@@ -131,26 +134,174 @@ def gunicorn():
 
 
 @click.command()
+@click.option('--number', '-n', default=None, type=int, help='Number of patients, prompted for if not given')
+@click.option('--bulk', is_flag=True, default=False,
+              help='Insert with multi-row INSERTs and commit per chunk instead of adding ORM objects')
+@click.option('--chunk-size', '-c', default=1000, type=int, help='Patients generated and committed per chunk')
 @with_appcontext
-def patients():
+def patients(number, bulk, chunk_size):
     """Create randomly generated patients"""
-    if click.confirm('Create randomly generated patients?', default=True, show_default=True):
-        patient_create_number = click.prompt(text="How many random patients do you want to create?: ", default=100,
-                                             type=int)
-        remaining = int(patient_create_number)
-        print("Creating " + str(patient_create_number) + " random patient(s)...")
-        t1 = time.clock()
-        demo_list = random_demographics(number=remaining)
-        for demo in demo_list:
-            Patient.create_random_patient(demo_dict=demo)
-        db.session.commit()
-        t2 = time.clock()
-        print("{} total patients created in {} seconds".format(patient_create_number, str(round(t2 - t1, 3))))
-        print("Patient create time was {} seconds".format(round((t2 - t1) / patient_create_number, 3)))
+    if number is None:
+        if not click.confirm('Create randomly generated patients?', default=True, show_default=True):
+            return
+        number = click.prompt(text="How many random patients do you want to create?: ", default=100, type=int)
+    patient_create_number = int(number)
+    print("Creating " + str(patient_create_number) + " random patient(s)...")
+    if bulk:
+        t1 = time.time()
+
+        def report(created, rows):
+            seconds = max(time.time() - t1, 1e-9)
+            print("{} patients, {} rows in {} seconds ({} rows/sec)".format(created, rows, round(seconds, 3),
+                                                                            round(rows / seconds, 1)))
+
+        bulk_create_random_patients(number=patient_create_number, chunk_size=chunk_size, progress=report)
+        print("Narratives are rendered on read; run `flask patient_narratives` to precompute them")
+        return
+    t1 = time.clock()
+    demo_list = random_demographics(number=patient_create_number)
+    for demo in demo_list:
+        Patient.create_random_patient(demo_dict=demo)
+    db.session.commit()
+    t2 = time.clock()
+    print("{} total patients created in {} seconds".format(patient_create_number, str(round(t2 - t1, 3))))
+    print("Patient create time was {} seconds".format(round((t2 - t1) / patient_create_number, 3)))
+
+
+@click.command()
+@with_appcontext
+def index_concepts():
+    """Rebuild the flattened concept index for all CodeSystems and ValueSets"""
+    t1 = time.time()
+    codesystems = CodeSystem.query.all()
+    for cs in codesystems:
+        cs.index_concepts()
+    valuesets = ValueSet.query.all()
+    for vs in valuesets:
+        vs.index_concepts()
+    db.session.commit()
+    terminology_cache.refresh()
+    print("Indexed {} CodeSystems and {} ValueSets in {} seconds".format(len(codesystems), len(valuesets),
+                                                                        round(time.time() - t1, 3)))
+
+
+@click.command()
+@click.option('--batch-size', '-b', default=500, type=int, help='Patients rendered per transaction')
+@click.option('--force', is_flag=True, default=False, help='Re-render narratives that are already current')
+@with_appcontext
+def patient_narratives(batch_size, force):
+    """Render and store the precomputed narrative of every Patient whose narrative is out of date"""
+    t1 = time.time()
+    ids = [row[0] for row in db.session.query(Patient.id).order_by(Patient.id).all()]
+    updated = 0
+    # Resource urls are absolute, so narratives are built inside a request context
+    with current_app.test_request_context():
+        for start in range(0, len(ids), batch_size):
+            updated += Patient.refresh_narratives(ids[start:start + batch_size], force=force)
+            db.session.commit()
+            db.session.expunge_all()
+    print("Rendered {} of {} patient narratives in {} seconds".format(updated, len(ids),
+                                                                     round(time.time() - t1, 3)))
+
+
+@click.command()
+@click.option('--number', '-n', default=100, type=int, help='Number of patients to serialize')
+@click.option('--repeat', '-r', default=5, type=int, help='Timed passes over the patients per serializer')
+@with_appcontext
+def benchmark_serializers(number, repeat):
+    """Compare Patient serialization through fhirclient objects with the direct fhir_json serializer"""
+    patients = Patient.query.order_by(Patient.id).limit(number).all()
+    if not patients:
+        print("No patients to serialize")
+        return
+    Patient.bulk_preload_fhir_relations(patients)
+    with current_app.test_request_context():
+        # Warm the narrative and terminology caches so both serializers are timed on the same work
+        mismatches = [pt.id for pt in patients if pt.dump_fhir_json() != pt.fhir_json()]
+        results = {}
+        for name in ['dump_fhir_json', 'fhir_json']:
+            t1 = time.time()
+            for x in range(repeat):
+                for pt in patients:
+                    getattr(pt, name)()
+            results[name] = time.time() - t1
+    total = len(patients) * repeat
+    for name, seconds in results.items():
+        print("{}: {} seconds for {} resources ({} ms per resource)".format(
+            name, round(seconds, 3), total, round(seconds * 1000 / total, 3)))
+    print("fhir_json speedup: {}x".format(round(results['dump_fhir_json'] / max(results['fhir_json'], 1e-9), 1)))
+    if mismatches:
+        print("Output differs for patient ids: {}".format(mismatches))
+
+
+@click.command()
+@click.argument('query_string')
+@click.option('--analyze', is_flag=True, default=False, help='Execute the search and report actual timings')
+@with_appcontext
+def explain_search(query_string, analyze):
+    """
+    Print the PostgreSQL query plan for a FHIR Patient search, to check which indexes the planner uses.
+    Example: flask explain_search "name:contains=ann&address-city=madi"
+    """
+    with current_app.test_request_context('/?{}'.format(query_string)):
+        query, fhir_search_spec = patient_search_registry.search(args=request.args)
+        t1 = time.time()
+        plan = explain_query(query, analyze=analyze)
+        t2 = time.time()
+    print(query.statement.compile(dialect=db.engine.dialect))
+    print()
+    for line in plan:
+        print(line)
+    print()
+    print("EXPLAIN completed in {} seconds".format(round(t2 - t1, 3)))
+
+
+@click.command(name='import-fhir')
+@click.argument('paths', nargs=-1, type=click.Path(exists=True))
+@click.option('--batch-size', '-b', default=500, type=int, help='Patients inserted per multi-row INSERT and commit')
+@with_appcontext
+def import_fhir(paths, batch_size):
+    """Load Patient resources from FHIR Bundle JSON and NDJSON files or directories (default seed/patients/fhir)"""
+    if not paths:
+        paths = [os.path.join(os.path.dirname(current_app.root_path), 'seed', 'patients', 'fhir')]
+    loader = PatientBulkLoader(batch_size=batch_size).load(iter_fhir_paths(paths))
+    for error in loader.errors[:10]:
+        print(error)
+    print(loader.summary())
+
+
+@click.command()
+@click.argument('path', required=False, type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', '-b', default=1000, type=int, help='Rows validated together and patients per commit')
+@click.option('--workers', '-w', default=None, type=int, help='Validation processes, 1 to validate in process')
+@click.option('--rejects', '-r', default=None, type=click.Path(dir_okay=False),
+              help='File rejected rows are written to (default PATH.rejects)')
+@with_appcontext
+def load_seed(path, batch_size, workers, rejects):
+    """Load patients from a pipe-delimited demographic seed file (default demographic_seed.txt)"""
+    if not path:
+        path = os.path.join(os.path.dirname(current_app.root_path), 'demographic_seed.txt')
+    rejects = rejects or path + '.rejects'
+    loader = SeedLoader(batch_size=batch_size, workers=workers, rejects_path=rejects).load(path)
+    print(loader.summary())
+    if loader.rejected:
+        print("Rejected rows were written to {}".format(rejects))
 
 
 @click.command()
 @click.option('--population', '-p', default=100, type=int)
-def synthea(population):
-    """Create synthetic patient records using Synthea"""
-    run_synthea(total_population=population)
+@click.option('--workers', '-w', default=None, type=int, help='Geography slices generated concurrently')
+@click.option('--batch-size', '-b', default=500, type=int, help='Patients inserted per multi-row INSERT and commit')
+@click.option('--output-dir', '-o', default=None, type=click.Path(), help='Keep the generated bundles here')
+@click.option('--generate-only', is_flag=True, default=False, help='Run Synthea serially without loading patients')
+@with_appcontext
+def synthea(population, workers, batch_size, output_dir, generate_only):
+    """Create synthetic patient records using Synthea and load them as they are generated"""
+    if generate_only:
+        run_synthea(total_population=population)
+        return
+    loader = run_synthea_pipeline(total_population=population, workers=workers, batch_size=batch_size,
+                                  output_dir=output_dir)
+    for error in loader.errors[:10]:
+        print(error)
+    print(loader.summary())
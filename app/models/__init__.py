@@ -14,7 +14,7 @@ def fetch_current_user_id():
 
 make_versioned(plugins=[FlaskPlugin(current_user_id_factory=fetch_current_user_id), PropertyModTrackerPlugin()])
 
-from . import user, role, app_permission, app_group, source_data
+from . import user, role, app_permission, app_group, source_data, bulk_export
 from .fhir import address, codesets, email_address, organization, patient, phone_number
 
 configure_mappers()
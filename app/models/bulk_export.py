@@ -0,0 +1,48 @@
+import uuid
+from datetime import datetime
+from app.extensions import db
+from app.models.extensions import BaseExtension
+from sqlalchemy.dialects import postgresql
+
+
+class BulkExportJob(db.Model):
+    """
+    A FHIR Bulk Data $export request.  The job is run in the background by app.utils.bulk_export, which writes
+    NDJSON files to a directory named after the job's uuid and records them in output.
+    """
+    __tablename__ = 'bulk_export_job'
+    __mapper_args__ = {
+        'extension': BaseExtension(),
+    }
+
+    id = db.Column(db.Integer, primary_key=True)
+    uuid = db.Column(postgresql.UUID(as_uuid=True), unique=True, nullable=False, default=uuid.uuid4)
+    # accepted, in-progress, completed, error or deleted
+    status = db.Column(db.Text, nullable=False, default='accepted', index=True)
+    request_url = db.Column(db.Text)
+    base_url = db.Column(db.Text)
+    resource_types = db.Column(postgresql.ARRAY(db.Text))
+    since = db.Column(db.DateTime)
+    # List of {'type': resource type, 'file': file name, 'count': number of resources}
+    output = db.Column(postgresql.JSONB)
+    error = db.Column(db.Text)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    transaction_time = db.Column(db.DateTime)
+    completed_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow())
+    updated_at = db.Column(db.DateTime)
+
+    def __repr__(self):  # pragma: no cover
+        return '<BulkExportJob {}:{}>'.format(self.uuid, self.status)
+
+    @property
+    def finished(self):
+        return self.status in ['completed', 'error', 'deleted']
+
+    def before_insert(self):
+        if not self.transaction_time:
+            self.transaction_time = datetime.utcnow()
+
+    def before_update(self):
+        if self.finished and not self.completed_at:
+            self.completed_at = datetime.utcnow()
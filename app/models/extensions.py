@@ -1,5 +1,7 @@
 from app.extensions import db
 from datetime import datetime
+from sqlalchemy import DDL, event, inspect
+import unidecode
 
 
 class BaseExtension(db.MapperExtension):
@@ -15,3 +17,80 @@ class BaseExtension(db.MapperExtension):
         now = datetime.utcnow()
         target.updated_at = now
         target.before_update()
+
+
+##################################################################################################
+# ROW HASHES
+##################################################################################################
+
+def row_hash_changed(target):
+    """
+    Return True if any attribute a model instance's row_hash is built from has pending changes.  Models list the
+    attributes in a row_hash_columns tuple.  Read from SQLAlchemy attribute history, so unloaded attributes are not
+    loaded.  Instances that are not yet persistent always need a hash.
+    """
+    state = inspect(target)
+    if not state.persistent:
+        return True
+    return any(state.attrs[key].history.has_changes() for key in target.row_hash_columns)
+
+
+def refresh_row_hashes(instances, force=False):
+    """
+    Recompute the row hashes of a batch of model instances, e.g. before db.session.bulk_save_objects(), which does not
+    run before_update.  Instances whose row_hash_columns are unchanged are skipped.
+    :param instances:
+        Iterable of model instances with row_hash_columns and refresh_row_hash()
+    :param force:
+        Recompute every hash, e.g. after the hashed attributes changed
+    :return:
+        Number of hashes recomputed
+    """
+    refreshed = 0
+    for target in instances:
+        if force or row_hash_changed(target):
+            target.refresh_row_hash()
+            refreshed += 1
+    return refreshed
+
+
+##################################################################################################
+# FOLDED SEARCH COLUMNS AND INDEXES
+##################################################################################################
+
+# gin_trgm_ops is provided by the pg_trgm extension.  Created with db.create_all(), before the indexes that use it.
+event.listen(db.metadata, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+
+
+def fold_search_text(value):
+    """Fold a string for search comparisons: transliterate accented characters to ASCII and uppercase"""
+    if value is None:
+        return None
+    return unidecode.unidecode(str(value)).upper().strip()
+
+
+def set_search_columns(target):
+    """
+    Populate the folded *_search columns of a model instance from their source columns.  Models list the columns in
+    a search_columns dict of {source column: search column} and call this from before_insert and before_update.
+    """
+    for column, search_column in target.search_columns.items():
+        setattr(target, search_column, fold_search_text(getattr(target, column)))
+
+
+def search_indexes(attribute):
+    """
+    Create the indexes for a folded search column:
+    a btree text_pattern_ops index for equality and prefix (LIKE 'VALUE%') matches, and a GIN trigram index for
+    substring (LIKE '%VALUE%') matches.
+    :param attribute:
+        Mapped column attribute, e.g. Patient.last_name_search
+    :return:
+        Tuple of the two sqlalchemy.Index objects, attached to the model's table
+    """
+    column = attribute.property.columns[0]
+    name = '{}_{}'.format(column.table.name, column.name)
+    return (db.Index('ix_{}_pattern'.format(name), column, postgresql_ops={column.name: 'text_pattern_ops'}),
+            db.Index('ix_{}_trgm'.format(name), column, postgresql_using='gin',
+                     postgresql_ops={column.name: 'gin_trgm_ops'}))
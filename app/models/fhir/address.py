@@ -5,7 +5,8 @@ import hashlib, json
 
 from app.utils.demographics import *
 from app.utils.general import json_serial
-from app.models.extensions import BaseExtension
+from app.utils.fhir_utils import fhir_period_date_json
+from app.models.extensions import BaseExtension, set_search_columns, search_indexes, row_hash_changed
 from fhirclient.models import address as fhir_address
 from fhirclient.models import period, fhirdate
 from fhirclient.models.fhirabstractbase import FHIRValidationError
@@ -24,8 +25,15 @@ class Address(db.Model):
     """
     # TODO: Add county and country to model, api and FHIR output
     _tablename__ = 'address'
-    __versioned__ = {}
+    __versioned__ = {'exclude': ['address1_search', 'address2_search', 'city_search', 'state_search',
+                                 'zipcode_search', 'country_search']}
     __mapper_args__ = {'extension': BaseExtension()}
+    # Source columns and the folded (unaccented, uppercase) columns that string search parameters are matched on
+    search_columns = {'address1': 'address1_search', 'address2': 'address2_search', 'city': 'city_search',
+                      'state': 'state_search', 'zipcode': 'zipcode_search', 'country': 'country_search'}
+    # Attributes row_hash is built from.  They include everything address_hash and the search columns are built from.
+    row_hash_columns = ('address1', 'address2', 'city', 'state', 'zipcode', 'patient_id', 'user_id', 'is_postal',
+                        'is_physical', 'use', 'start_date', 'end_date', 'district', 'country')
     id = db.Column(db.Integer, primary_key=True)
     address1 = db.Column("address1", db.Text)
     address2 = db.Column("address2", db.Text)
@@ -48,6 +56,12 @@ class Address(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow())
     updated_at = db.Column(db.DateTime)
     address_hash = db.Column(db.Text)
+    address1_search = db.Column(db.Text)
+    address2_search = db.Column(db.Text)
+    city_search = db.Column(db.Text)
+    state_search = db.Column(db.Text)
+    zipcode_search = db.Column(db.Text)
+    country_search = db.Column(db.Text)
     row_hash = db.Column(db.Text)
 
     def __init__(self, address1=None, address2=None, city=None, state=None, zipcode=None, active=True, primary=False,
@@ -191,6 +205,63 @@ class Address(db.Model):
 
         self.fhir = fa
 
+    def fhir_json(self):
+        """
+        Serialize the Address straight to the FHIR STU 3.0 Address JSON dict that create_fhir_object() and
+        fhirclient as_json() produce, without building fhirclient objects
+        :return:
+            dict
+        """
+        fa = {}
+
+        if self.address1:
+            fa['line'] = [self.address1]
+
+            if self.address2:
+                fa['line'].append(self.address2)
+
+        if self.city:
+            fa['city'] = self.city
+
+        if self.state:
+            fa['state'] = self.state
+
+        if self.zipcode:
+            fa['postalCode'] = self.zipcode
+
+        fa['text'] = self.formatted_address()
+
+        if isinstance(self.start_date, date) or isinstance(self.end_date, date):
+            p = {}
+
+            if self.start_date:
+                p['start'] = fhir_period_date_json(self.start_date)
+
+            if self.end_date:
+                p['end'] = fhir_period_date_json(self.end_date)
+
+            fa['period'] = p
+
+        if self.use:
+            fa['use'] = self.use.lower()
+
+        if self.is_postal and self.is_physical:
+            fa['type'] = 'both'
+
+        elif self.is_postal:
+            fa['type'] = 'postal'
+
+        elif self.is_physical:
+            fa['type'] = 'physical'
+
+        if self.district:
+            fa['district'] = self.district
+
+        if self.country:
+            fa['country'] = self.country
+
+        return fa
+
     def dump_fhir_json(self, parent=False):
         """
         Method to dump valid FHIR STU 3.0 JSON representation of the Address ORM object
@@ -218,11 +289,7 @@ class Address(db.Model):
         :return:
             A SHA-1 hash of JSON object containing an ordered dictionary of the Address object's attributes
         """
-        data = {"address1": self.address1, "address2": self.address2, "city": self.city,
-                "state": self.state, "zipcode": self.zipcode,
-                "patient_id": self.patient_id, "user_id": self.user_id, "is_postal": self.is_postal,
-                "is_physical": self.is_physical, "use": self.use, "start_date": self.start_date,
-                "end_date": self.end_date, "district": self.district, "country": self.country}
+        data = {key: getattr(self, key) for key in self.row_hash_columns}
         data_str = json.dumps(data, sort_keys=True, default=json_serial)
         data_hash = hashlib.sha1(data_str.encode('utf-8')).hexdigest()
         return data_hash
@@ -255,23 +322,40 @@ class Address(db.Model):
         data_hash = hashlib.sha1(data_str.encode('utf-8')).hexdigest()
         return data_hash
 
-    def before_insert(self):
+    def refresh_row_hash(self):
         """
-        Method to run operations before object is inserted into database table
+        Method to recompute row_hash, address_hash and the folded search columns
         :return:
             No return
         """
         self.row_hash = self.generate_row_hash()
         self.address_hash = self.generate_address_hash()
+        set_search_columns(self)
+
+    def before_insert(self):
+        """
+        Method to run operations before object is inserted into database table
+        :return:
+            No return
+        """
+        self.refresh_row_hash()
 
     def before_update(self):
         """
-        Method to run operations before object's record in the database table is updated
+        Method to run operations before object's record in the database table is updated.  Hashes are only
+        recomputed when a hashed attribute has changed.
         :return:
             No return
         """
-        self.row_hash = self.generate_row_hash()
-        self.address_hash = self.generate_address_hash()
+        if row_hash_changed(self):
+            self.refresh_row_hash()
+
+
+# Prefix and trigram indexes for string search parameters
+search_indexes(Address.address1_search)
+search_indexes(Address.address2_search)
+search_indexes(Address.city_search)
+search_indexes(Address.zipcode_search)
 
 
 class AddressSchema(ma.Schema):
@@ -1,15 +1,19 @@
 from datetime import datetime
-import json, hashlib
+import json, hashlib, logging, threading, time
+from flask import current_app
 from app.utils.general import json_serial
 from requests import request
 from requests.exceptions import RequestException
 from app.extensions import db
 from app.models.extensions import BaseExtension
 from app.models.source_data import SourceData
+from sqlalchemy import literal
 from sqlalchemy.dialects import postgresql
 from fhirclient.models import valueset, codesystem
 from fhirclient.models.fhirabstractbase import FHIRValidationError
 
+logger = logging.getLogger(__name__)
+
 ##################################################################################################
 # SOURCE_DATA -> CODESYSTEM ASSOCIATION TABLE
 ##################################################################################################
@@ -152,38 +156,63 @@ class CodeSystem(db.Model):
 
     @property
     def code_set(self):
-        codes = set()
-        concepts = self.fhir.concept
-
-        while concepts:
-            additional_concepts = []
-            for concept in concepts:
-                code, nested_concepts = self.unpack_concept(concept)
-                codes.add(code)
-                if nested_concepts:
-                    additional_concepts.extend(nested_concepts)
-            concepts = additional_concepts
-
-        return codes
+        """The set of codes defined by the CodeSystem, read from the flattened concept table"""
+        return {code for (code,) in db.session.query(Concept.code).filter(Concept.codesystem_id == self.id)}
 
     def get_concept(self, code):
-        concepts = self.fhir.concept
-        found_concept = None
+        """
+        Look up a code defined by the CodeSystem.
+        :return:
+            The matching Concept row (code, display, parent_code) or None
+        """
+        return Concept.query.filter(Concept.system == self.url, Concept.code == code,
+                                    Concept.codesystem_id == self.id).first()
+
+    def display_index(self):
+        """Return a dict of {code: display} for every concept of the CodeSystem"""
+        q = db.session.query(Concept.code, Concept.display).filter(Concept.codesystem_id == self.id)
+        return {code: display for code, display in q}
 
-        while not found_concept and concepts:
+    def iter_concepts(self):
+        """
+        Walk the nested concept tree of the CodeSystem breadth-first, directly over the JSON data.
+        :return:
+            Generator of (code, display, parent_code) tuples.  parent_code is None for top level concepts.
+        """
+        concepts = [(concept, None) for concept in (self.data or {}).get('concept') or []]
+        while concepts:
             nested_concepts = []
-            for concept in concepts:
-                if concept.code == code:
-                    found_concept = concept
-                else:
-                    try:
-                        if concept.concept:
-                            nested_concepts.extend(concept.concept)
-                    except AttributeError:
-                        pass
+            for concept, parent_code in concepts:
+                yield concept.get('code'), concept.get('display'), parent_code
+                nested_concepts.extend((x, concept.get('code')) for x in concept.get('concept') or [])
             concepts = nested_concepts
 
-        return found_concept
+    def index_concepts(self):
+        """
+        Write the flattened concept tree of the CodeSystem to the concept table in a single upsert and remove
+        concepts that are no longer part of it.  ValueSets including this system are re-indexed afterwards so their
+        membership stays current.  The CodeSystem must have been flushed so that self.id is set.
+        """
+        rows = {}
+        for code, display, parent_code in self.iter_concepts():
+            if code and code not in rows:
+                rows[code] = dict(system=self.url, code=code, display=display, parent_code=parent_code,
+                                  codesystem_id=self.id)
+        concept_table = Concept.__table__
+        if rows:
+            stmt = postgresql.insert(concept_table).values(list(rows.values()))
+            stmt = stmt.on_conflict_do_update(constraint='uq_concept_system_code',
+                                              set_=dict(display=stmt.excluded.display,
+                                                        parent_code=stmt.excluded.parent_code,
+                                                        codesystem_id=stmt.excluded.codesystem_id))
+            db.session.execute(stmt)
+        stale = concept_table.delete().where(concept_table.c.codesystem_id == self.id)
+        if rows:
+            stale = stale.where(~concept_table.c.code.in_(list(rows)))
+        db.session.execute(stale)
+
+        for vs in ValueSet.query.filter(ValueSet.data['compose']['include'].contains([{'system': self.url}])):
+            vs.index_concepts()
 
     def dump_fhir_json(self):
         return self.data  # same as self.fhir.as_json()
@@ -301,38 +330,100 @@ class ValueSet(db.Model):
 
     @property
     def code_set(self):
-        code_set = set()
-        for inc in self.fhir.compose.include:
-            if hasattr(inc, 'system') and inc.system:
-                if hasattr(inc, 'concept') and inc.concept:
-                    for x in inc.concept:
-                        code_set.add(x.code)
-                else:
-                    cs = CodeSystem.query.filter(CodeSystem.url == inc.system).first()
-                    if cs:
-                        code_set = code_set | cs.code_set
-            if hasattr(inc, 'valueset') and inc.valueset:
-                code_set = code_set | inc.valueset.code_set
-        return code_set
+        """The set of codes included in the ValueSet, read from the flattened concept index"""
+        q = db.session.query(Concept.code).join(valueset_concept, valueset_concept.c.concept_id == Concept.id) \
+            .filter(valueset_concept.c.valueset_id == self.id)
+        return {code for (code,) in q}
 
     def get_concept(self, code):
-        for inc in self.fhir.compose.include:
-            if hasattr(inc, 'system') and inc.system:
-                if hasattr(inc, 'concept') and inc.concept:
-                    for x in inc.concept:
-                        if x.code == code:
-                            return x
-                else:
-                    cs = CodeSystem.query.filter(CodeSystem.url == inc.system).first()
-                    if cs:
-                        x = cs.get_concept(code)
-                        if x:
-                            return x
-            if hasattr(inc, 'valueset') and inc.valueset:
-                x = inc.valueset.get_concept()
-                if x:
-                    return x
-        return None
+        """
+        Look up a code included in the ValueSet.
+        :return:
+            The matching Concept row (code, display, parent_code) or None
+        """
+        return Concept.query.join(valueset_concept, valueset_concept.c.concept_id == Concept.id) \
+            .filter(valueset_concept.c.valueset_id == self.id, Concept.code == code).order_by(Concept.id).first()
+
+    def display_index(self):
+        """
+        Return a dict of {code: display} for every concept included in the ValueSet.  A display given inline in
+        the ValueSet include takes precedence over the CodeSystem display.
+        """
+        q = db.session.query(Concept.code, db.func.coalesce(valueset_concept.c.display, Concept.display)) \
+            .join(valueset_concept, valueset_concept.c.concept_id == Concept.id) \
+            .filter(valueset_concept.c.valueset_id == self.id).order_by(Concept.id)
+        index = {}
+        for code, display in q:
+            index.setdefault(code, display)
+        return index
+
+    @property
+    def codeset_hashes(self):
+        """
+        Dict of {(resource type, url): data_hash} for this ValueSet and every CodeSystem it includes in full.
+        Used to detect when a display_index() built from them has gone stale.
+        """
+        hashes = {('ValueSet', self.url): self.data_hash}
+        compose = (self.data or {}).get('compose') or {}
+        systems = [inc.get('system') for inc in compose.get('include') or []
+                   if inc.get('system') and not inc.get('concept')]
+        for system in systems:
+            hashes[('CodeSystem', system)] = None
+        if systems:
+            for url, data_hash in db.session.query(CodeSystem.url, CodeSystem.data_hash) \
+                    .filter(CodeSystem.url.in_(systems)):
+                hashes[('CodeSystem', url)] = data_hash
+        return hashes
+
+    def index_concepts(self):
+        """
+        Rebuild the valueset_concept membership rows of the ValueSet.  Inline include concepts are added to the
+        concept table if their system has not been indexed, and includes of a whole system are copied from the
+        concept rows of that system with a single INSERT ... SELECT.  The ValueSet must have been flushed so that
+        self.id is set.
+        Includes that reference other ValueSets, and compose.exclude, are not supported and are logged and skipped.
+        Include filters are not evaluated: the whole system is included, with a logged warning.
+        """
+        concept_table = Concept.__table__
+        db.session.execute(valueset_concept.delete().where(valueset_concept.c.valueset_id == self.id))
+        compose = (self.data or {}).get('compose') or {}
+        if compose.get('exclude'):
+            logger.warning('ValueSet %s: compose.exclude is not supported and was ignored', self.url)
+        for inc in compose.get('include') or []:
+            system = inc.get('system')
+            if inc.get('valueSet'):
+                logger.warning('ValueSet %s: include of ValueSet %s is not supported and was skipped', self.url,
+                               ', '.join(inc.get('valueSet')))
+                continue
+            if not system:
+                continue
+            if inc.get('filter') and not inc.get('concept'):
+                # As in the lookups before the concept index, the filter is not evaluated
+                logger.warning('ValueSet %s: include filters are not supported, every concept of %s was included',
+                               self.url, system)
+            if inc.get('concept'):
+                inline = {}
+                for concept in inc.get('concept'):
+                    if concept.get('code'):
+                        inline.setdefault(concept.get('code'), concept.get('display'))
+                if not inline:
+                    continue
+                db.session.execute(postgresql.insert(concept_table).values(
+                    [dict(system=system, code=code, display=display) for code, display in inline.items()])
+                                   .on_conflict_do_nothing(constraint='uq_concept_system_code'))
+                q = db.session.query(Concept.id, Concept.code).filter(Concept.system == system,
+                                                                      Concept.code.in_(list(inline)))
+                members = [dict(valueset_id=self.id, concept_id=concept_id, display=inline.get(code))
+                           for concept_id, code in q]
+                if members:
+                    db.session.execute(postgresql.insert(valueset_concept).values(members)
+                                       .on_conflict_do_nothing())
+            else:
+                members = db.select([literal(self.id, type_=db.Integer), concept_table.c.id]) \
+                    .where(concept_table.c.system == system)
+                db.session.execute(postgresql.insert(valueset_concept)
+                                   .from_select(['valueset_id', 'concept_id'], members)
+                                   .on_conflict_do_nothing())
 
     @staticmethod
     def get_valueset_concept(url, code):
@@ -341,6 +432,14 @@ class ValueSet(db.Model):
             return vs.get_concept(code)
         return None
 
+    @staticmethod
+    def get_valueset_display(url, code):
+        """
+        Return the display text for a code in the ValueSet (or CodeSystem) with the given url.
+        Served from the in-process terminology_cache, which only queries the database on a miss.
+        """
+        return terminology_cache.get_display(url=url, code=code)
+
     def dump_fhir_json(self):
         return self.data  # same as self.fhir.as_json()
 
@@ -353,6 +452,175 @@ class ValueSet(db.Model):
         self.data_hash = hashlib.sha1(json_data.encode('utf-8')).hexdigest()
 
 
+##################################################################################################
+# VALUESET -> CONCEPT ASSOCIATION TABLE
+##################################################################################################
+
+valueset_concept = db.Table('valueset_concept',
+                            db.Column('valueset_id', db.Integer, db.ForeignKey('valueset.id', ondelete='CASCADE'),
+                                      primary_key=True),
+                            db.Column('concept_id', db.Integer, db.ForeignKey('concept.id', ondelete='CASCADE'),
+                                      primary_key=True, index=True),
+                            db.Column('display', db.Text))
+
+
+##################################################################################################
+# CONCEPT MODEL
+##################################################################################################
+
+class Concept(db.Model):
+    """A single code of a CodeSystem, flattened out of the nested FHIR concept tree so that code validation and
+    display lookups are indexed queries rather than walks over the JSONB resource.  Concepts listed inline in a
+    ValueSet whose CodeSystem has not been imported are stored with no codesystem_id.
+    ValueSet membership is recorded in the valueset_concept association table."""
+    __tablename__ = 'concept'
+    __table_args__ = (db.UniqueConstraint('system', 'code', name='uq_concept_system_code'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    system = db.Column(db.Text, nullable=False)
+    code = db.Column(db.Text, nullable=False)
+    display = db.Column(db.Text)
+    parent_code = db.Column(db.Text)
+    codesystem_id = db.Column(db.Integer, db.ForeignKey('codesystem.id', ondelete='CASCADE'), index=True)
+
+    def __repr__(self):  # pragma: no cover
+        return '<Concept {}|{}>'.format(self.system, self.code)
+
+
+##################################################################################################
+# IN-PROCESS TERMINOLOGY CACHE
+##################################################################################################
+
+class TerminologyCache(object):
+    """
+    In-process cache of concept displays keyed by (url, code).
+
+    The first lookup for a url loads a {code: display} index for the ValueSet (or CodeSystem) with that url from the
+    concept table.  Later lookups for any code in that url are dictionary hits.  Each index remembers the data_hash
+    of every resource it was built from.  At most once per TERMINOLOGY_CACHE_TTL seconds the cache compares those
+    hashes with the database and drops stale indexes, so codesets updated by other processes are picked up.
+    process_fhir_codeset() refreshes the cache directly in the process that imported the codeset.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._concepts = {}
+        self._dependencies = {}
+        self._checked_at = time.time()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):  # pragma: no cover
+        return '<TerminologyCache {} urls, {} hits, {} misses>'.format(len(self._concepts), self.hits, self.misses)
+
+    def stats(self):
+        """Return a dict of the hit / miss counters and the number of indexed urls"""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._concepts)}
+
+    def get_display(self, url, code):
+        """
+        Look up the display text of a code within the ValueSet or CodeSystem identified by url.
+        :return:
+            The display text or None if the url or the code is unknown
+        """
+        if not url or not code:
+            return None
+        self.revalidate()
+        with self._lock:
+            index = self._concepts.get(url)
+            if index is not None:
+                self.hits += 1
+                return index.get(code)
+            self.misses += 1
+        return self.load(url).get(code)
+
+    def load(self, url):
+        """Build and store the flattened index for a url.  Returns the {code: display} index."""
+        vs = ValueSet.query.filter(ValueSet.url == url).first()
+        if vs:
+            index, dependencies = vs.display_index(), vs.codeset_hashes
+        else:
+            cs = CodeSystem.query.filter(CodeSystem.url == url).first()
+            if cs:
+                index, dependencies = cs.display_index(), {('CodeSystem', url): cs.data_hash}
+            else:
+                # Remember unknown urls too, so they are not queried on every lookup
+                index, dependencies = {}, {('ValueSet', url): None, ('CodeSystem', url): None}
+        with self._lock:
+            self._concepts[url] = index
+            self._dependencies[url] = dependencies
+        return index
+
+    def version(self, urls):
+        """
+        Hash of the data_hash of every ValueSet and CodeSystem the indexes of the given urls are built from.
+        It changes when one of those resources changes, so it can be part of the cache key of content that is
+        rendered with their displays.
+        :param urls:
+            Iterable of ValueSet or CodeSystem urls
+        :return:
+            SHA1 hex digest
+        """
+        self.revalidate()
+        parts = []
+        for url in sorted(urls):
+            with self._lock:
+                dependencies = self._dependencies.get(url)
+            if dependencies is None:
+                self.load(url)
+                with self._lock:
+                    dependencies = self._dependencies.get(url, {})
+            for key in sorted(dependencies):
+                parts.append('{}:{}:{}'.format(key[0], key[1], dependencies[key]))
+        return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def current_hashes():
+        """Return a dict of {(resource type, url): data_hash} for all ValueSets and CodeSystems"""
+        hashes = {}
+        for model, resource_type in ((ValueSet, 'ValueSet'), (CodeSystem, 'CodeSystem')):
+            for url, data_hash in db.session.query(model.url, model.data_hash):
+                hashes[(resource_type, url)] = data_hash
+        return hashes
+
+    def revalidate(self, force=False):
+        """Drop indexes whose source resources changed.  Checks at most once per TERMINOLOGY_CACHE_TTL seconds."""
+        now = time.time()
+        if not force and now - self._checked_at < current_app.config.get('TERMINOLOGY_CACHE_TTL', 300):
+            return
+        self._checked_at = now
+        if not self._dependencies:
+            return
+        hashes = self.current_hashes()
+        with self._lock:
+            for url, dependencies in list(self._dependencies.items()):
+                for key, data_hash in dependencies.items():
+                    if hashes.get(key) != data_hash:
+                        self._concepts.pop(url, None)
+                        self._dependencies.pop(url, None)
+                        break
+
+    def refresh(self, url=None):
+        """
+        Invalidate every index built from the resource with the given url (or all indexes if no url is given).
+        If the url belongs to a ValueSet or CodeSystem its index is rebuilt immediately.
+        """
+        with self._lock:
+            if url is None:
+                self._concepts.clear()
+                self._dependencies.clear()
+            else:
+                for indexed_url, dependencies in list(self._dependencies.items()):
+                    if indexed_url == url or url in [dependency_url for _, dependency_url in dependencies]:
+                        self._concepts.pop(indexed_url, None)
+                        self._dependencies.pop(indexed_url, None)
+        if url:
+            self.load(url)
+
+
+terminology_cache = TerminologyCache()
+
+
 ###########################################################
 # HELPER FUNCTIONS TO RETRIEVE & PROCESS FHIR RESOURCES   #
 ###########################################################
@@ -420,7 +688,10 @@ def process_fhir_codeset(source_data):
             source_data.response = {}
             db.session.add(source_data)
             db.session.add(obj)
+            db.session.flush()
+            obj.index_concepts()
             db.session.commit()
+            terminology_cache.refresh(url=obj.url)
 
         elif source_data.route == '/valueset':
             obj = ValueSet.query.filter(ValueSet.url == url).first()
@@ -435,7 +706,10 @@ def process_fhir_codeset(source_data):
             source_data.response = {}
             db.session.add(source_data)
             db.session.add(obj)
+            db.session.flush()
+            obj.index_concepts()
             db.session.commit()
+            terminology_cache.refresh(url=obj.url)
 
             if obj.codesystem_dependencies:
                 for url in obj.codesystem_dependencies:
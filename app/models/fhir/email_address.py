@@ -5,7 +5,7 @@ from sqlalchemy.dialects.postgresql import UUID as postgresql_uuid
 from app.utils import validate_email
 from app.utils.demographics import *
 from app.utils.general import json_serial
-from app.models.extensions import BaseExtension
+from app.models.extensions import BaseExtension, set_search_columns, search_indexes, row_hash_changed
 from fhirclient.models import contactpoint
 
 import hashlib, json
@@ -17,8 +17,12 @@ import hashlib, json
 
 class EmailAddress(db.Model):
     __tablename__ = 'email_address'
-    __versioned__ = {}
+    __versioned__ = {'exclude': ['email_search']}
     __mapper_args__ = {'extension': BaseExtension()}
+    # Source columns and the folded (unaccented, uppercase) columns that string search parameters are matched on
+    search_columns = {'email': 'email_search'}
+    # Attributes row_hash is built from
+    row_hash_columns = ('email', 'patient_id', 'user_id')
 
     id = db.Column(db.Integer, primary_key=True, index=True)
     email = db.Column("email", db.Text, index=True)
@@ -32,6 +36,7 @@ class EmailAddress(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow())
     updated_at = db.Column(db.DateTime)
     row_hash = db.Column(db.Text, index=True)
+    email_search = db.Column(db.Text)
 
     def __init__(self, email=None, primary=False, active=True):
         self.email = email
@@ -114,27 +119,59 @@ class EmailAddress(db.Model):
 
         self._fhir = fhir_contact
 
+    def fhir_json(self):
+        """
+        Serialize the EmailAddress straight to the FHIR ContactPoint JSON dict that create_fhir_object() and
+        fhirclient as_json() produce, without building fhirclient objects
+        :return:
+            dict
+        """
+        fhir_contact = {'system': 'email'}
+        if self.active:
+            fhir_contact['use'] = 'home'
+            if self.primary:
+                fhir_contact['rank'] = 1
+            else:
+                fhir_contact['rank'] = 2
+        else:
+            fhir_contact['use'] = 'old'
+            fhir_contact['rank'] = 3
+
+        if self.email:
+            fhir_contact['value'] = self.email
+
+        return fhir_contact
+
     def dump_fhir_json(self):
         self.create_fhir_object()
         return self.fhir.as_json()
 
     def generate_row_hash(self):
-        data = {"email": self.email, "patient_id": self.patient_id, "user_id": self.user_id}
+        data = {key: getattr(self, key) for key in self.row_hash_columns}
         data_str = json.dumps(data, sort_keys=True, default=json_serial)
         data_hash = hashlib.sha1(data_str.encode('utf-8')).hexdigest()
         return data_hash
 
-    def before_insert(self):
+    def refresh_row_hash(self):
         self.row_hash = self.generate_row_hash()
+        set_search_columns(self)
+
+    def before_insert(self):
+        self.refresh_row_hash()
         if not self.avatar_hash:
             self.generate_avatar_hash()
 
     def before_update(self):
-        self.row_hash = self.generate_row_hash()
+        if row_hash_changed(self):
+            self.refresh_row_hash()
         if not self.avatar_hash:
             self.generate_avatar_hash()
 
 
+# Prefix and trigram indexes for string search parameters
+search_indexes(EmailAddress.email_search)
+
+
 ##################################################################################################
 # MARSHMALLOW SHCHEMA FOR EASY USER SERIALIZATION
 ##################################################################################################
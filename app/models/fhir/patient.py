@@ -1,25 +1,64 @@
 from app.extensions import db, ma
 from sqlalchemy.dialects.postgresql import UUID as postgresql_uuid
-from sqlalchemy import inspect
+from sqlalchemy import inspect, func, event
+from sqlalchemy.orm import Load
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy_continuum import version_class, versioning_manager
 from marshmallow import fields, post_load
 from app.utils.demographics import *
-from flask import url_for, render_template, has_request_context
+from flask import url_for, render_template, has_request_context, has_app_context, current_app
 from app.utils.general import json_serial
 from app.models.fhir.address import Address, AddressSchema
 from app.models.fhir.email_address import EmailAddress, EmailAddressSchema
 from app.models.fhir.phone_number import PhoneNumber, PhoneNumberSchema
-from app.models.fhir.codesets import ValueSet, CodeSystem
-from app.models.extensions import BaseExtension
+from app.models.fhir.codesets import ValueSet, CodeSystem, terminology_cache
+from app.models.extensions import BaseExtension, set_search_columns, search_indexes, row_hash_changed
 from fhirclient.models import patient as fhir_patient, meta, codeableconcept, coding, extension, identifier, narrative
-from app.utils.fhir_utils import fhir_gen_humanname, fhir_gen_datetime
+from app.utils.fhir_utils import fhir_gen_humanname, fhir_gen_datetime, fhir_humanname_json, fhir_date_json, \
+    fhir_codeable_concept_json
 from app.utils.demographics import race_dict, ethnicity_dict
-import hashlib, json, uuid
+from collections import OrderedDict
+import hashlib, itertools, json, threading, uuid
+
+# fhirclient Patient attributes of FHIR elements whose name differs from the attribute name
+fhir_element_attributes = {'deceased': ['deceasedBoolean', 'deceasedDateTime']}
 
 
 class Patient(db.Model):
     __tablename__ = 'patient'
-    __versioned__ = {}
+    __versioned__ = {'exclude': ['first_name_search', 'last_name_search', 'middle_name_search', 'prefix_search',
+                                 'suffix_search', 'sex_search', 'preferred_language_search', 'narrative',
+                                 'narrative_hash']}
     __mapper_args__ = {'extension': BaseExtension()}
+    # Source columns and the folded (unaccented, uppercase) columns that string search parameters are matched on
+    search_columns = {'first_name': 'first_name_search', 'last_name': 'last_name_search',
+                      'middle_name': 'middle_name_search', 'prefix': 'prefix_search', 'suffix': 'suffix_search',
+                      'sex': 'sex_search', 'preferred_language': 'preferred_language_search'}
+    # Attributes row_hash is built from
+    row_hash_columns = ('first_name', 'last_name', 'middle_name', 'dob', 'sex', 'prefix', 'suffix', 'race',
+                        'ethnicity', 'marital_status', 'deceased', 'deceased_date', 'multiple_birth', 'ssn',
+                        'preferred_language', 'active')
+    # Top-level FHIR elements built by create_fhir_object() with the columns and relationships each is built from.
+    # Used to load and build only the elements requested with _summary / _elements.  id and meta are always built,
+    # and text (the narrative) is rendered from the whole resource.
+    fhir_elements = {'identifier': (['uuid', 'ssn'], []),
+                     'active': (['active'], []),
+                     'name': (['first_name', 'last_name', 'middle_name', 'suffix', 'prefix'], []),
+                     'telecom': ([], ['phone_numbers', 'email_addresses']),
+                     'gender': (['sex'], []),
+                     'birthDate': (['dob'], []),
+                     'deceased': (['deceased', 'deceased_date'], []),
+                     'address': ([], ['addresses']),
+                     'maritalStatus': (['marital_status'], []),
+                     'communication': (['preferred_language'], []),
+                     'extension': (['race', 'ethnicity', 'sex'], []),
+                     'text': ([], [])}
+    # Elements returned for _summary=true
+    fhir_summary_elements = ['identifier', 'active', 'name', 'telecom', 'gender', 'birthDate', 'deceased', 'address']
+    # ValueSets that create_fhir_object() looks displays up in, part of the narrative and resource cache keys
+    narrative_valueset_urls = ('http://hl7.org/fhir/ValueSet/marital-status',
+                               'http://hl7.org/fhir/us/core/ValueSet/omb-race-category',
+                               'http://hl7.org/fhir/ValueSet/languages')
 
     id = db.Column(db.Integer, primary_key=True, index=True)
     uuid = db.Column(postgresql_uuid(as_uuid=True), unique=True, nullable=False, default=uuid.uuid4)
@@ -42,6 +81,15 @@ class Patient(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow())
     updated_at = db.Column(db.DateTime)
     row_hash = db.Column(db.Text, index=True)
+    first_name_search = db.Column(db.Text)
+    last_name_search = db.Column(db.Text)
+    middle_name_search = db.Column(db.Text)
+    prefix_search = db.Column(db.Text)
+    suffix_search = db.Column(db.Text)
+    sex_search = db.Column(db.Text)
+    preferred_language_search = db.Column(db.Text)
+    narrative = db.Column(db.Text)
+    narrative_hash = db.Column(db.Text)
     addresses = db.relationship("Address", order_by=Address.id.desc(), back_populates="patient", lazy="dynamic",
                                 cascade="all, delete, delete-orphan")
     email_addresses = db.relationship("EmailAddress", order_by=EmailAddress.id.desc(), back_populates="patient",
@@ -294,6 +342,9 @@ class Patient(db.Model):
     ############################################
     @property
     def version_number(self):
+        preloaded = getattr(self, '_fhir_preload', None)
+        if preloaded and preloaded.get('version_number'):
+            return preloaded['version_number']
         if self.versions:
             return len(self.versions.all())
         raise ValueError('No versions exist for this object.')
@@ -325,6 +376,181 @@ class Patient(db.Model):
         # else:
         #     return None
 
+    ############################################
+    # FHIR READ LOADER
+    ############################################
+    @staticmethod
+    def version_count_subquery():
+        """
+        Correlated scalar subquery counting the rows in the patient version table for the outer Patient row.
+        Used to select the current version number alongside the patient in the same round trip.
+        """
+        patient_version = version_class(Patient)
+        return db.session.query(func.count(patient_version.transaction_id)) \
+            .filter(patient_version.id == Patient.id).correlate(Patient).as_scalar()
+
+    @staticmethod
+    def get_fhir_read(patientid, elements=None):
+        """
+        Load a Patient with everything needed to build its FHIR resource in a fixed number of queries.
+        The patient row and its current version number are selected together, then the addresses, phone numbers
+        and email addresses are fetched once each and attached to the instance.
+        :param patientid:
+            The id of the Patient to load
+        :param elements:
+            Optional set of top-level FHIR elements to load, see fhir_load_plan()
+        :return:
+            Patient instance with preloaded relations or None if no Patient matches the id
+        """
+        columns, relations = Patient.fhir_load_plan(elements)
+        query = db.session.query(Patient, Patient.version_count_subquery()).filter(Patient.id == patientid)
+        if columns is not None:
+            query = query.options(Load(Patient).load_only(*columns))
+        row = query.first()
+        if not row:
+            return None
+        pt, version_number = row
+        pt.preload_fhir_relations(version_number=version_number, relations=relations)
+        return pt
+
+    @staticmethod
+    def fhir_load_plan(elements=None):
+        """
+        Work out which columns and relationships must be loaded to build the requested FHIR elements.
+        :param elements:
+            Set of top-level FHIR element names, or None for the whole resource
+        :return:
+            Tuple of (column names for load_only or None for all columns, relationship names or None for all)
+        """
+        if elements is None or 'text' in elements:
+            return None, None
+        columns = ['id', 'updated_at']
+        relations = []
+        for name in elements:
+            element_columns, element_relations = Patient.fhir_elements.get(name, ([], []))
+            columns.extend(c for c in element_columns if c not in columns)
+            relations.extend(r for r in element_relations if r not in relations)
+        return columns, relations
+
+    @staticmethod
+    def get_fhir_version_metadata(patientid):
+        """
+        Select the version metadata used to validate conditional reads in a single query, without loading the
+        patient or building its FHIR resource.  Edits to addresses, phone numbers and email addresses do not create
+        a new patient version, so the latest versioning transaction over the patient and its children is selected
+        as well.  Its id distinguishes the weak ETag and its issued_at time is the Last-Modified date.
+        :param patientid:
+            The id of the Patient
+        :return:
+            Dict with version_number, transaction_id and last_modified or None if no Patient matches the id
+        """
+        transaction_ids = []
+        for model, foreign_key in ((Patient, 'id'), (Address, 'patient_id'), (PhoneNumber, 'patient_id'),
+                                   (EmailAddress, 'patient_id')):
+            model_version = version_class(model)
+            transaction_ids.append(db.session.query(func.max(model_version.transaction_id))
+                                   .filter(getattr(model_version, foreign_key) == patientid).as_scalar())
+        last_transaction_id = func.greatest(*transaction_ids)
+        transaction = versioning_manager.transaction_cls
+        issued_at = db.session.query(transaction.issued_at).filter(transaction.id == last_transaction_id).as_scalar()
+
+        row = db.session.query(Patient.updated_at, Patient.version_count_subquery(), last_transaction_id, issued_at) \
+            .filter(Patient.id == patientid).first()
+        if not row:
+            return None
+        updated_at, version_number, transaction_id, issued_at = row
+        return {'version_number': version_number,
+                'transaction_id': transaction_id,
+                'last_modified': issued_at or updated_at}
+
+    def preload_fhir_relations(self, version_number=None, relations=None):
+        """
+        Fetch the contact points, addresses and version number used by create_fhir_object() and store them in
+        the protected attribute _fhir_preload so the FHIR object can be built without further lazy queries.
+        :param version_number:
+            The current version number, if it was already selected with the patient row
+        :param relations:
+            Optional list of the relationships to fetch, defaults to all
+        :return:
+            None
+        """
+        version_numbers = {self.id: version_number} if version_number else None
+        Patient.bulk_preload_fhir_relations([self], version_numbers=version_numbers, relations=relations)
+
+    @staticmethod
+    def bulk_preload_fhir_relations(patients, version_numbers=None, relations=None):
+        """
+        Batch version of preload_fhir_relations() for a page of patients.  Version counts, addresses, phone numbers
+        and email addresses for every patient are fetched with one IN query each and distributed to the patients
+        from in-memory maps, so the number of queries does not grow with the number of patients.
+        :param patients:
+            List of persistent Patient instances
+        :param version_numbers:
+            Optional dict of {patient id: version number} if the version numbers were already selected
+        :param relations:
+            Optional list of the relationships to fetch, defaults to all.  Relationships that are not fetched are
+            left to lazy loading.
+        :return:
+            None
+        """
+        patients = [pt for pt in patients if pt.id is not None]
+        if not patients:
+            return
+        ids = [pt.id for pt in patients]
+
+        if version_numbers is None:
+            patient_version = version_class(Patient)
+            version_numbers = dict(db.session.query(patient_version.id, func.count(patient_version.transaction_id))
+                                   .filter(patient_version.id.in_(ids)).group_by(patient_version.id).all())
+
+        grouped = {}
+        for name, model in (('addresses', Address), ('phone_numbers', PhoneNumber),
+                            ('email_addresses', EmailAddress)):
+            if relations is None or name in relations:
+                grouped[name] = Patient._group_by_patient_id(
+                    model.query.filter(model.patient_id.in_(ids)).order_by(model.id.desc()))
+
+        for pt in patients:
+            pt._fhir_preload = {'version_number': version_numbers.get(pt.id)}
+            for name, records in grouped.items():
+                pt._fhir_preload[name] = records.get(pt.id, [])
+            pt._fhir = None
+
+    @staticmethod
+    def _group_by_patient_id(query):
+        """Execute a query of patient child records and return a dict of {patient_id: [records]}"""
+        grouped = {}
+        for record in query:
+            grouped.setdefault(record.patient_id, []).append(record)
+        return grouped
+
+    def get_fhir_relation(self, name):
+        """
+        Return the list of related objects for one of the dynamic relationships (addresses, phone_numbers,
+        email_addresses), using the preloaded list when available instead of querying.
+        """
+        preloaded = getattr(self, '_fhir_preload', None)
+        if preloaded and name in preloaded:
+            return preloaded[name]
+        return getattr(self, name).all()
+
+    def fhir_cache_key(self):
+        """
+        Return a string identifying this exact state of the Patient FHIR resource, for caching the serialized
+        resource.  Built from the patient id, version, row_hash and updated_at, the id, row_hash and updated_at
+        of every address, phone number and email address, and the version of the terminology that displays are
+        looked up in, so any change to the patient, its children or those codesets changes the key.  Uses the
+        preloaded relations when available.
+        """
+        children = []
+        for name in ['addresses', 'phone_numbers', 'email_addresses']:
+            for child in self.get_fhir_relation(name):
+                children.append('{}:{}:{}:{}'.format(name, child.id, child.row_hash, child.updated_at))
+        children_hash = hashlib.sha1('|'.join(children).encode('utf-8')).hexdigest()
+        return 'Patient/{}/{}/{}/{}/{}/{}'.format(self.id, self.version_number, self.row_hash, self.updated_at,
+                                                  children_hash,
+                                                  terminology_cache.version(self.narrative_valueset_urls))
+
     ############################################
     # FHIR STU 3 UTILITY PROPERTIES AND METHODS
     ############################################
@@ -358,12 +584,24 @@ class Patient(db.Model):
         else:
             self._fhir = fhir_obj
 
-    def create_fhir_object(self):
+    def create_fhir_object(self, include_narrative=True, elements=None):
         """
         Generate a fhirclient.Patient class object and store in the protected attribute _fhir
+        :param include_narrative:
+            Whether to set the generated XHTML narrative (Patient.text)
+        :param elements:
+            Optional set of top-level FHIR elements (see fhir_elements) to build, for _summary and _elements requests.
+            Other elements are not built and their columns and relationships are not read.  id and meta are always
+            included and meta is tagged SUBSETTED.
         :return:
             None
         """
+        # The narrative is rendered from the whole resource
+        build_all = elements is None or 'text' in elements
+
+        def want(name):
+            return build_all or name in elements
+
         # Patient object must be persistent to generate FHIR attributes
         ins = inspect(self)
         if ins.persistent:
@@ -380,70 +618,73 @@ class Patient(db.Model):
             fhir_meta.profile = ['http://hl7.org/fhir/us/core/StructureDefinition/us-core-patient']
             fhir_pt.meta = fhir_meta
 
-            # Patient name represented as HumanName resource
-            fhir_pt.name = []
-            fhir_pt.name.append(fhir_gen_humanname(use='usual', first_name=self.first_name, last_name=self.last_name,
-                                                   middle_name=self.middle_name, suffix=self.suffix,
-                                                   prefix=self.prefix))
-            # Display MRN as identifier codeable concept = Patient.identifier.codeableconcept.coding
-            # Initialize Identifier resource
-            id_mrn = identifier.Identifier()
-            id_mrn.use = 'usual'
-            id_mrn.system = 'http://unkani.com'
-            id_mrn.value = str(self.uuid)
-
-            # Initialize CodeableConcept resource
-            mrn_cc = codeableconcept.CodeableConcept()
-            mrn_cc.text = 'Medical Record Number'
-
-            # Initialize Coding resource
-            mrn_coding = coding.Coding()
-            mrn_coding.system = 'http://hl7.org/fhir/v2/0203'
-            mrn_coding.code = 'MR'
-            mrn_coding.display = 'Medical Record Number'
-
-            # Assign Coding resource to CodeableConcept
-            mrn_cc.coding = [mrn_coding]
-
-            # Assign CodeableConcept to Identifier
-            id_mrn.type = mrn_cc
-
-            # Assign CodeableConcept to Patient
-            fhir_pt.identifier = [id_mrn]
-
-            # Display SSN as identifier codeable concept = Patient.identifier.codeableconcept.coding
-            if self.ssn:
+            if want('name'):
+                # Patient name represented as HumanName resource
+                fhir_pt.name = []
+                fhir_pt.name.append(fhir_gen_humanname(use='usual', first_name=self.first_name,
+                                                       last_name=self.last_name, middle_name=self.middle_name,
+                                                       suffix=self.suffix, prefix=self.prefix))
+
+            if want('identifier'):
+                # Display MRN as identifier codeable concept = Patient.identifier.codeableconcept.coding
                 # Initialize Identifier resource
-                id_ssn = identifier.Identifier()
-                id_ssn.use = 'usual'
-                id_ssn.system = 'http://hl7.org/fhir/sid/us-ssn'
-                id_ssn.value = self.ssn
+                id_mrn = identifier.Identifier()
+                id_mrn.use = 'usual'
+                id_mrn.system = 'http://unkani.com'
+                id_mrn.value = str(self.uuid)
 
                 # Initialize CodeableConcept resource
-                ssn_cc = codeableconcept.CodeableConcept()
-                ssn_cc.text = 'Social Security Number'
+                mrn_cc = codeableconcept.CodeableConcept()
+                mrn_cc.text = 'Medical Record Number'
 
                 # Initialize Coding resource
-                ssn_coding = coding.Coding()
-                ssn_coding.system = 'http://hl7.org/fhir/v2/0203'
-                ssn_coding.code = 'SS'
-                ssn_coding.display = 'Social Security Number'
+                mrn_coding = coding.Coding()
+                mrn_coding.system = 'http://hl7.org/fhir/v2/0203'
+                mrn_coding.code = 'MR'
+                mrn_coding.display = 'Medical Record Number'
 
                 # Assign Coding resource to CodeableConcept
-                ssn_cc.coding = [ssn_coding]
+                mrn_cc.coding = [mrn_coding]
 
                 # Assign CodeableConcept to Identifier
-                id_ssn.type = ssn_cc
+                id_mrn.type = mrn_cc
 
                 # Assign CodeableConcept to Patient
-                fhir_pt.identifier.append(id_ssn)
+                fhir_pt.identifier = [id_mrn]
+
+                # Display SSN as identifier codeable concept = Patient.identifier.codeableconcept.coding
+                if self.ssn:
+                    # Initialize Identifier resource
+                    id_ssn = identifier.Identifier()
+                    id_ssn.use = 'usual'
+                    id_ssn.system = 'http://hl7.org/fhir/sid/us-ssn'
+                    id_ssn.value = self.ssn
+
+                    # Initialize CodeableConcept resource
+                    ssn_cc = codeableconcept.CodeableConcept()
+                    ssn_cc.text = 'Social Security Number'
+
+                    # Initialize Coding resource
+                    ssn_coding = coding.Coding()
+                    ssn_coding.system = 'http://hl7.org/fhir/v2/0203'
+                    ssn_coding.code = 'SS'
+                    ssn_coding.display = 'Social Security Number'
 
-            if self.marital_status:
+                    # Assign Coding resource to CodeableConcept
+                    ssn_cc.coding = [ssn_coding]
+
+                    # Assign CodeableConcept to Identifier
+                    id_ssn.type = ssn_cc
+
+                    # Assign CodeableConcept to Patient
+                    fhir_pt.identifier.append(id_ssn)
+
+            if want('maritalStatus') and self.marital_status:
                 marital_status_cc = codeableconcept.CodeableConcept()
                 marital_status_url = 'http://hl7.org/fhir/ValueSet/marital-status'
-                marital_status_concept = ValueSet.get_valueset_concept(marital_status_url, self.marital_status)
-                if marital_status_concept:
-                    marital_status_cc.text = getattr(marital_status_concept, 'display')
+                marital_status_display = ValueSet.get_valueset_display(marital_status_url, self.marital_status)
+                if marital_status_display:
+                    marital_status_cc.text = marital_status_display
                 marital_status_coding = coding.Coding()
                 marital_status_coding.code = self.marital_status
                 marital_status_coding.system = marital_status_url
@@ -452,14 +693,14 @@ class Patient(db.Model):
                 marital_status_cc.coding = [marital_status_coding]
                 fhir_pt.maritalStatus = marital_status_cc
 
-            if self.race:
+            if want('extension') and self.race:
                 ext_race = extension.Extension()
                 ext_race.url = 'http://hl7.org/fhir/StructureDefinition/us-core-race'
                 race_url = 'http://hl7.org/fhir/us/core/ValueSet/omb-race-category'
                 cc_race = codeableconcept.CodeableConcept()
-                race_concept = ValueSet.get_valueset_concept(race_url, self.race)
-                if race_concept:
-                    cc_race.text = getattr(race_concept, 'display')
+                race_display = ValueSet.get_valueset_display(race_url, self.race)
+                if race_display:
+                    cc_race.text = race_display
                 coding_race = coding.Coding()
                 coding_race.system = race_url
                 coding_race.code = self.race
@@ -471,7 +712,7 @@ class Patient(db.Model):
                 except AttributeError:
                     fhir_pt.extension = [ext_race]
 
-            if self.ethnicity:
+            if want('extension') and self.ethnicity:
                 ext_ethnicity = extension.Extension()
                 ext_ethnicity.url = 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity'
                 cc_ethnicity = codeableconcept.CodeableConcept()
@@ -488,32 +729,36 @@ class Patient(db.Model):
                 except AttributeError:
                     fhir_pt.extension = [ext_ethnicity]
 
-            if self.sex:
+            if (want('gender') or want('extension')) and self.sex:
                 sex_dict = {"administrativeGender": {"M": "male", "F": "female", "u": "unknown", "o": "other"},
                             "usCoreBirthSex": {"M": "M", "F": "F", "U": "UNK", "O": "UNK"}}
 
-                fhir_pt.gender = sex_dict['administrativeGender'][str(self.sex).upper()]
+                if want('gender'):
+                    fhir_pt.gender = sex_dict['administrativeGender'][str(self.sex).upper()]
 
-                ext_birth_sex = extension.Extension()
-                ext_birth_sex.url = 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-birthsex'
-                ext_birth_sex.valueCode = sex_dict['usCoreBirthSex'][str(self.sex).upper()]
+                if want('extension'):
+                    ext_birth_sex = extension.Extension()
+                    ext_birth_sex.url = 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-birthsex'
+                    ext_birth_sex.valueCode = sex_dict['usCoreBirthSex'][str(self.sex).upper()]
 
-                try:
-                    fhir_pt.extension.append(ext_birth_sex)
-                except AttributeError:
-                    fhir_pt.extension = [ext_birth_sex]
+                    try:
+                        fhir_pt.extension.append(ext_birth_sex)
+                    except AttributeError:
+                        fhir_pt.extension = [ext_birth_sex]
 
-            if self.dob:
+            if want('birthDate') and self.dob:
                 fhir_pt.birthDate = fhir_gen_datetime(value=self.dob, to_date=True)
 
-            fhir_pt.active = self.active
+            if want('active'):
+                fhir_pt.active = self.active
 
-            fhir_pt.deceasedBoolean = self.deceased
+            if want('deceased'):
+                fhir_pt.deceasedBoolean = self.deceased
 
-            if self.deceased_date:
+            if want('deceased') and self.deceased_date:
                 fhir_pt.deceasedDateTime = fhir_gen_datetime(value=self.deceased_date, to_date=False)
 
-            if self.preferred_language:
+            if want('communication') and self.preferred_language:
                 fhir_comm = fhir_patient.PatientCommunication()
                 fhir_comm.preferred = True
                 fhir_lang_cc = codeableconcept.CodeableConcept()
@@ -521,45 +766,280 @@ class Patient(db.Model):
                 fhir_lang_coding.code = self.preferred_language
                 fhir_lang_url = 'http://hl7.org/fhir/ValueSet/languages'
                 fhir_lang_coding.system = fhir_lang_url
-                fhir_lang_concept = ValueSet.get_valueset_concept(fhir_lang_url, self.preferred_language)
-                if fhir_lang_concept:
-                    fhir_lang_coding.display = fhir_lang_concept.display
+                fhir_lang_display = ValueSet.get_valueset_display(fhir_lang_url, self.preferred_language)
+                if fhir_lang_display:
+                    fhir_lang_coding.display = fhir_lang_display
                     fhir_lang_cc.text = fhir_lang_coding.display
                 fhir_lang_cc.coding = [fhir_lang_coding]
                 fhir_comm.language = fhir_lang_cc
                 fhir_pt.communication = [fhir_comm]
 
-            contact_point_list = []
+            if want('telecom'):
+                contact_point_list = []
+
+                phone_list = self.get_fhir_relation('phone_numbers')
+                if phone_list:
+                    for ph in phone_list:
+                        contact_point_list.append(ph.fhir)
+
+                email_list = self.get_fhir_relation('email_addresses')
+                if email_list:
+                    for em in email_list:
+                        contact_point_list.append(em.fhir)
+
+                if contact_point_list:
+                    fhir_pt.telecom = contact_point_list
+
+            if want('address'):
+                address_list = self.get_fhir_relation('addresses')
+                if address_list:
+                    fhir_pt.address = []
+                    for addr in address_list:
+                        fhir_pt.address.append(addr.fhir)
+
+            if include_narrative and want('text'):
+                fhir_pt.text = narrative.Narrative()
+                fhir_pt.text.status = 'generated'
+                fhir_pt.text.div = self.get_narrative(fhir_pt)
+
+            if elements is not None:
+                # The narrative is rendered from the whole resource, so drop what was only built for it
+                for name in set(Patient.fhir_elements) - set(elements):
+                    for attribute in fhir_element_attributes.get(name, [name]):
+                        setattr(fhir_pt, attribute, None)
+                subsetted = coding.Coding()
+                subsetted.system = 'http://hl7.org/fhir/v3/ObservationValue'
+                subsetted.code = 'SUBSETTED'
+                subsetted.display = 'subsetted'
+                fhir_meta.tag = [subsetted]
 
-            phone_list = self.phone_numbers.all()
-            if phone_list:
-                for ph in phone_list:
-                    contact_point_list.append(ph.fhir)
+            self._fhir = fhir_pt
 
-            email_list = self.email_addresses.all()
-            if email_list:
-                for em in email_list:
-                    contact_point_list.append(em.fhir)
+    def dump_fhir_json(self, include_narrative=True, elements=None):
+        self.create_fhir_object(include_narrative=include_narrative, elements=elements)
+        return self.fhir.as_json()
+
+    def fhir_json(self, include_narrative=True, elements=None):
+        """
+        Serialize the Patient straight to the FHIR STU 3.0 Patient JSON dict that dump_fhir_json() produces, without
+        building and validating fhirclient objects.  Addresses and contact points are serialized with their own
+        fhir_json methods.  Any change to create_fhir_object() must be mirrored here.
+        :param include_narrative:
+            Whether to include the generated XHTML narrative (Patient.text)
+        :param elements:
+            Optional set of top-level FHIR elements to build, as for create_fhir_object()
+        :return:
+            dict, or None if the Patient is not persistent
+        """
+        build_all = elements is None or 'text' in elements
+
+        def want(name):
+            return build_all or name in elements
+
+        if not inspect(self).persistent:
+            return None
+
+        fhir_pt = {'resourceType': 'Patient', 'id': self.get_url()}
 
+        fhir_meta = {'lastUpdated': fhir_date_json(value=self.updated_at, to_date=False),
+                     'versionId': str(self.version_number),
+                     'profile': ['http://hl7.org/fhir/us/core/StructureDefinition/us-core-patient']}
+        fhir_pt['meta'] = fhir_meta
+
+        if want('name'):
+            fhir_pt['name'] = [fhir_humanname_json(use='usual', first_name=self.first_name, last_name=self.last_name,
+                                                   middle_name=self.middle_name, suffix=self.suffix,
+                                                   prefix=self.prefix)]
+
+        if want('identifier'):
+            fhir_pt['identifier'] = [
+                {'use': 'usual', 'system': 'http://unkani.com', 'value': str(self.uuid),
+                 'type': {'text': 'Medical Record Number',
+                          'coding': [{'system': 'http://hl7.org/fhir/v2/0203', 'code': 'MR',
+                                      'display': 'Medical Record Number'}]}}]
+            if self.ssn:
+                fhir_pt['identifier'].append(
+                    {'use': 'usual', 'system': 'http://hl7.org/fhir/sid/us-ssn', 'value': self.ssn,
+                     'type': {'text': 'Social Security Number',
+                              'coding': [{'system': 'http://hl7.org/fhir/v2/0203', 'code': 'SS',
+                                          'display': 'Social Security Number'}]}})
+
+        if want('maritalStatus') and self.marital_status:
+            marital_status_url = 'http://hl7.org/fhir/ValueSet/marital-status'
+            marital_status_display = ValueSet.get_valueset_display(marital_status_url, self.marital_status)
+            fhir_pt['maritalStatus'] = fhir_codeable_concept_json(system=marital_status_url, code=self.marital_status,
+                                                                  text=marital_status_display or None)
+
+        extensions = []
+        if want('extension') and self.race:
+            race_url = 'http://hl7.org/fhir/us/core/ValueSet/omb-race-category'
+            race_display = ValueSet.get_valueset_display(race_url, self.race)
+            extensions.append({'url': 'http://hl7.org/fhir/StructureDefinition/us-core-race',
+                               'valueCodeableConcept': fhir_codeable_concept_json(system=race_url, code=self.race,
+                                                                                  text=race_display or None)})
+
+        if want('extension') and self.ethnicity:
+            extensions.append({'url': 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity',
+                               'valueCodeableConcept': fhir_codeable_concept_json(
+                                   system='http://hl7.org/fhir/us/core/ValueSet/omb-ethnicity-category',
+                                   code=self.race, text=ethnicity_dict.get(self.ethnicity)[0].capitalize())})
+
+        if (want('gender') or want('extension')) and self.sex:
+            sex_dict = {"administrativeGender": {"M": "male", "F": "female", "u": "unknown", "o": "other"},
+                        "usCoreBirthSex": {"M": "M", "F": "F", "U": "UNK", "O": "UNK"}}
+
+            if want('gender'):
+                fhir_pt['gender'] = sex_dict['administrativeGender'][str(self.sex).upper()]
+
+            if want('extension'):
+                extensions.append({'url': 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-birthsex',
+                                   'valueCode': sex_dict['usCoreBirthSex'][str(self.sex).upper()]})
+
+        if extensions:
+            fhir_pt['extension'] = extensions
+
+        if want('birthDate') and self.dob:
+            fhir_pt['birthDate'] = fhir_date_json(value=self.dob, to_date=True)
+
+        if want('active') and self.active is not None:
+            fhir_pt['active'] = self.active
+
+        if want('deceased') and self.deceased is not None:
+            fhir_pt['deceasedBoolean'] = self.deceased
+
+        if want('deceased') and self.deceased_date:
+            fhir_pt['deceasedDateTime'] = fhir_date_json(value=self.deceased_date, to_date=False)
+
+        if want('communication') and self.preferred_language:
+            fhir_lang_url = 'http://hl7.org/fhir/ValueSet/languages'
+            fhir_lang_display = ValueSet.get_valueset_display(fhir_lang_url, self.preferred_language)
+            fhir_lang_coding = {'code': self.preferred_language, 'system': fhir_lang_url}
+            fhir_lang_cc = {'coding': [fhir_lang_coding]}
+            if fhir_lang_display:
+                fhir_lang_coding['display'] = fhir_lang_display
+                fhir_lang_cc['text'] = fhir_lang_display
+            fhir_pt['communication'] = [{'preferred': True, 'language': fhir_lang_cc}]
+
+        if want('telecom'):
+            contact_point_list = [ph.fhir_json() for ph in self.get_fhir_relation('phone_numbers')]
+            contact_point_list.extend(em.fhir_json() for em in self.get_fhir_relation('email_addresses'))
             if contact_point_list:
-                fhir_pt.telecom = contact_point_list
+                fhir_pt['telecom'] = contact_point_list
 
-            address_list = self.addresses.all()
+        if want('address'):
+            address_list = self.get_fhir_relation('addresses')
             if address_list:
-                fhir_pt.address = []
-                for addr in address_list:
-                    fhir_pt.address.append(addr.fhir)
+                fhir_pt['address'] = [addr.fhir_json() for addr in address_list]
 
-            xhtml = render_template('fhir/patient.html', fhir_patient=fhir_pt, patient=self)
-            fhir_pt.text = narrative.Narrative()
-            fhir_pt.text.status = 'generated'
-            fhir_pt.text.div = xhtml
+        if include_narrative and want('text'):
+            fhir_pt['text'] = {'status': 'generated', 'div': self.get_narrative()}
 
-            self._fhir = fhir_pt
+        if elements is not None:
+            for name in set(Patient.fhir_elements) - set(elements):
+                for attribute in fhir_element_attributes.get(name, [name]):
+                    fhir_pt.pop(attribute, None)
+            fhir_meta['tag'] = [{'system': 'http://hl7.org/fhir/v3/ObservationValue', 'code': 'SUBSETTED',
+                                 'display': 'subsetted'}]
 
-    def dump_fhir_json(self):
-        self.create_fhir_object()
-        return self.fhir.as_json()
+        return fhir_pt
+
+    ############################################
+    # FHIR NARRATIVE
+    ############################################
+    def narrative_source_hash(self):
+        """
+        Hash of everything the generated narrative is rendered from: the patient id, uuid and row_hash, the id,
+        row_hash and updated_at of every address, phone number and email address, and the version of the
+        terminology the displays are looked up in.
+        :return:
+            SHA1 hex digest
+        """
+        parts = [str(self.id), str(self.uuid), str(self.row_hash)]
+        for name in ['addresses', 'phone_numbers', 'email_addresses']:
+            for child in self.get_fhir_relation(name):
+                parts.append('{}:{}:{}:{}'.format(name, child.id, child.row_hash, child.updated_at))
+        parts.append(terminology_cache.version(self.narrative_valueset_urls))
+        return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+    def render_narrative(self, fhir_pt):
+        """
+        Render the XHTML narrative (Patient.text.div) from the fhirclient Patient object with Jinja.
+        :param fhir_pt:
+            fhirclient Patient object built by create_fhir_object()
+        :return:
+            XHTML string
+        """
+        return render_template('fhir/patient.html', fhir_patient=fhir_pt, patient=self)
+
+    def get_narrative(self, fhir_pt=None):
+        """
+        Return the XHTML narrative for the Patient without rendering it when possible: from the precomputed
+        narrative column if its narrative_hash is current, else from the in-process narrative cache.
+        :param fhir_pt:
+            fhirclient Patient object built by create_fhir_object(), used if the narrative must be rendered.
+            If not given, one is built.
+        :return:
+            XHTML string
+        """
+        key = self.narrative_source_hash()
+        if self.narrative and self.narrative_hash == key:
+            return self.narrative
+        xhtml = narrative_cache.get(key)
+        if xhtml is None:
+            if fhir_pt is None:
+                previous = getattr(self, '_fhir', None)
+                self.create_fhir_object(include_narrative=False)
+                fhir_pt, self._fhir = self._fhir, previous
+            xhtml = self.render_narrative(fhir_pt)
+            narrative_cache.set(key, xhtml)
+        return xhtml
+
+    @staticmethod
+    def refresh_narratives(patient_ids, force=False):
+        """
+        Render and store the precomputed narrative of each patient whose narrative_hash is out of date.
+        Rows are written with a core UPDATE, so no new patient version is created and updated_at is unchanged.
+        Requires an app context, and a request context or SERVER_NAME to build resource urls.  Patients whose
+        narrative fails to render are logged and skipped, so a write is not rolled back because of its narrative.
+        :param patient_ids:
+            Iterable of Patient ids
+        :param force:
+            Re-render narratives even if their narrative_hash is current
+        :return:
+            The number of narratives written
+        """
+        patient_ids = list(patient_ids)
+        if not patient_ids:
+            return 0
+        patients = Patient.query.filter(Patient.id.in_(patient_ids)).all()
+        # Patients may already be in the session identity map, so restore their FHIR state afterwards
+        saved = [(pt, pt.__dict__.get('_fhir_preload'), pt.__dict__.get('_fhir')) for pt in patients]
+        Patient.bulk_preload_fhir_relations(patients)
+        table = Patient.__table__
+        updated = 0
+        try:
+            for pt in patients:
+                key = pt.narrative_source_hash()
+                if pt.narrative_hash == key and not force:
+                    continue
+                try:
+                    pt.create_fhir_object(include_narrative=False)
+                    xhtml = pt.render_narrative(pt.fhir)
+                except Exception:
+                    # Leave the stored narrative stale, it is rendered on read instead
+                    current_app.logger.exception('Narrative of patient {} could not be rendered'.format(pt.id))
+                    continue
+                narrative_cache.set(key, xhtml)
+                db.session.execute(table.update().where(table.c.id == pt.id)
+                                   .values(narrative=xhtml, narrative_hash=key))
+                set_committed_value(pt, 'narrative', xhtml)
+                set_committed_value(pt, 'narrative_hash', key)
+                updated += 1
+        finally:
+            for pt, preload, fhir_obj in saved:
+                pt._fhir_preload = preload
+                pt._fhir = fhir_obj
+        return updated
 
     ##############################################################################################
     # Patient RANDOMIZATION UTILITIES
@@ -637,29 +1117,113 @@ class Patient(db.Model):
         db.session.add(pt)
 
     def generate_row_hash(self):
-        data = {"first_name": self.first_name, "last_name": self.last_name, "middle_name": self.middle_name,
-                "dob": self.dob, "sex": self.sex, "prefix": self.prefix, "suffix": self.suffix, "race": self.race,
-                "ethnicity": self.ethnicity, "marital_status": self.marital_status, "deceased": self.deceased,
-                "deceased_date": self.deceased_date, "multiple_birth": self.multiple_birth, "ssn": self.ssn,
-                "preferred_language": self.preferred_language, "active": self.active}
+        data = {key: getattr(self, key) for key in self.row_hash_columns}
 
         data_str = json.dumps(data, sort_keys=True, default=json_serial)
         data_hash = hashlib.sha1(data_str.encode('utf-8')).hexdigest()
         return data_hash
 
+    def refresh_row_hash(self):
+        """
+        Recompute row_hash and the folded search columns, which are built from the same attributes
+        :return: None
+        """
+        self.row_hash = self.generate_row_hash()
+        set_search_columns(self)
+
     def before_insert(self):
         """
         Stuff to do before record is inserted into database
         :return: None
         """
-        self.row_hash = self.generate_row_hash()
+        self.refresh_row_hash()
 
     def before_update(self):
         """
-        Stuff to do before record is updated in database
+        Stuff to do before record is updated in database.  The row hash is only recomputed when a hashed attribute
+        has changed.
         :return: None
         """
-        self.row_hash = self.generate_row_hash()
+        if row_hash_changed(self):
+            self.refresh_row_hash()
+
+
+# Prefix and trigram indexes for string search parameters
+search_indexes(Patient.first_name_search)
+search_indexes(Patient.middle_name_search)
+search_indexes(Patient.last_name_search)
+
+
+##################################################################################################
+# NARRATIVE CACHE AND WRITE-TIME NARRATIVE REFRESH
+##################################################################################################
+
+class NarrativeCache(object):
+    """
+    In-process LRU of rendered Patient narratives keyed by Patient.narrative_source_hash(), holding up to
+    NARRATIVE_CACHE_SIZE entries.  Keys change whenever the narrative content would, so entries are never invalidated.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            xhtml = self._entries.get(key)
+            if xhtml is not None:
+                self._entries.move_to_end(key)
+            return xhtml
+
+    def set(self, key, xhtml):
+        max_entries = current_app.config.get('NARRATIVE_CACHE_SIZE', 4096) if has_app_context() else 4096
+        with self._lock:
+            self._entries[key] = xhtml
+            self._entries.move_to_end(key)
+            while len(self._entries) > max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+narrative_cache = NarrativeCache()
+
+
+def collect_narrative_patient_ids(session, flush_context):
+    """Session after_flush listener: remember the ids of patients whose row or child rows were written"""
+    ids = session.info.setdefault('narrative_patient_ids', set())
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Patient):
+            ids.add(obj.id)
+        elif isinstance(obj, (Address, PhoneNumber, EmailAddress)) and obj.patient_id:
+            ids.add(obj.patient_id)
+
+
+def refresh_committed_narratives(session):
+    """
+    Session before_commit listener: update the precomputed narratives of the patients written in this transaction.
+    Skipped when FHIR_NARRATIVE_ON_WRITE is off or resource urls cannot be built, in which case narratives are
+    rendered on read and can be regenerated in bulk with the patient_narratives command.
+    """
+    session.flush()
+    ids = session.info.pop('narrative_patient_ids', None)
+    if not ids or not has_app_context() or not current_app.config.get('FHIR_NARRATIVE_ON_WRITE', True):
+        return
+    if not has_request_context() and not current_app.config.get('SERVER_NAME'):
+        return
+    Patient.refresh_narratives(ids)
+
+
+def discard_narrative_patient_ids(session):
+    """Session after_rollback listener"""
+    session.info.pop('narrative_patient_ids', None)
+
+
+event.listen(db.session, 'after_flush', collect_narrative_patient_ids)
+event.listen(db.session, 'before_commit', refresh_committed_narratives)
+event.listen(db.session, 'after_rollback', discard_narrative_patient_ids)
 
 
 class PatientSchema(ma.Schema):
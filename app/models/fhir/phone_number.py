@@ -4,7 +4,7 @@ from datetime import datetime
 from sqlalchemy.dialects.postgresql import UUID as postgresql_uuid
 
 from app.utils.demographics import validate_phone, validate_contact_type, format_phone
-from app.models.extensions import BaseExtension
+from app.models.extensions import BaseExtension, set_search_columns, search_indexes, row_hash_changed
 from fhirclient.models import contactpoint
 import hashlib, json
 
@@ -14,8 +14,12 @@ import hashlib, json
 ##################################################################################################
 class PhoneNumber(db.Model):
     __tablename__ = 'phone_number'
-    __versioned__ = {}
+    __versioned__ = {'exclude': ['number_search']}
     __mapper_args__ = {'extension': BaseExtension()}
+    # Source columns and the folded (unaccented, uppercase) columns that string search parameters are matched on
+    search_columns = {'number': 'number_search'}
+    # Attributes row_hash is built from
+    row_hash_columns = ('number', 'type', 'active')
 
     id = db.Column(db.Integer, primary_key=True)
     number = db.Column("number", db.Text)
@@ -30,6 +34,7 @@ class PhoneNumber(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow())
     updated_at = db.Column(db.DateTime)
     row_hash = db.Column(db.Text, index=True)
+    number_search = db.Column(db.Text)
 
     def __init__(self, number=None, type=None, active=True, primary=False, user_id=None, patient_id=None, **kwargs):
         self.number = number
@@ -41,18 +46,21 @@ class PhoneNumber(db.Model):
         self._fhir = None
 
     def generate_row_hash(self):
-        data = {"number": self.number, "type": self.type, "active": self.active}
-        for key in data:
-            data[key] = str(data[key])
+        data = {key: str(getattr(self, key)) for key in self.row_hash_columns}
         data_str = json.dumps(data, sort_keys=True)
         data_hash = hashlib.sha1(data_str.encode('utf-8')).hexdigest()
         return data_hash
 
-    def before_insert(self):
+    def refresh_row_hash(self):
         self.row_hash = self.generate_row_hash()
+        set_search_columns(self)
+
+    def before_insert(self):
+        self.refresh_row_hash()
 
     def before_update(self):
-        self.row_hash = self.generate_row_hash()
+        if row_hash_changed(self):
+            self.refresh_row_hash()
 
     @property
     def formatted_phone(self):
@@ -107,11 +115,37 @@ class PhoneNumber(db.Model):
 
         self._fhir = fhir_contact
 
+    def fhir_json(self):
+        """
+        Serialize the PhoneNumber straight to the FHIR ContactPoint JSON dict that create_fhir_object() and
+        fhirclient as_json() produce, without building fhirclient objects
+        :return:
+            dict
+        """
+        fhir_contact = {'system': 'phone'}
+
+        if self.active:
+            fhir_contact['use'] = self.type.lower()
+            if self.primary:
+                fhir_contact['rank'] = 1
+            else:
+                fhir_contact['rank'] = 2
+        else:
+            fhir_contact['use'] = 'old'
+            fhir_contact['rank'] = 3
+
+        if self.number:
+            fhir_contact['value'] = self.formatted_phone
+
+        return fhir_contact
+
     def dump_fhir_json(self):
         self.create_fhir_object()
         return self.fhir.as_json()
 
 
+# Prefix and trigram indexes for string search parameters
+search_indexes(PhoneNumber.number_search)
 
 
 class PhoneNumberSchema(ma.Schema):
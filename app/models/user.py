@@ -1,6 +1,8 @@
-import os, hashlib, json, base64
+import os, hashlib, itertools, json, base64
 from flask import current_app, g, url_for
+from sqlalchemy import event
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm.attributes import set_committed_value
 from marshmallow import fields, ValidationError
 from itsdangerous import TimedJSONWebSignatureSerializer as TimedSerializer
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -13,7 +15,7 @@ from app.models.fhir.address import AddressAPI
 from app.models.role import Role
 from app.models.fhir.address import Address, AddressSchema
 from app.models.fhir.phone_number import PhoneNumber
-from app.models.extensions import BaseExtension
+from app.models.extensions import BaseExtension, row_hash_changed
 from app.models.app_group import user_app_group, AppGroup, AppGroupSchema
 from app.security import app_permission_useractivation, app_permission_userforceconfirmation, \
     app_permission_userpasswordchange, app_permission_userrolechange, app_permission_userappgroupupdate
@@ -64,6 +66,10 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow())
     updated_at = db.Column(db.DateTime)
     row_hash = db.Column(db.Text, index=True)
+    # Attributes and relationships row_hash is built from
+    row_hash_columns = ('username', 'first_name', 'last_name', 'dob', 'sex', 'app_groups', 'email_addresses',
+                        'phone_numbers', 'addresses', 'role_id', 'password_hash', 'last_password_hash',
+                        'password_timestamp', 'description', 'confirmed', 'active')
 
     def __init__(self, username=None, first_name=None, last_name=None, dob=None, description=None,
                  password=None, sex=None, role_id=None, confirmed=False, active=True, **kwargs):
@@ -632,7 +638,8 @@ class User(db.Model):
         """
         Generates a sha1 hash of the user attributes.  Used to track whether changes are made
         from one version of the user to the next.  Compiles related child object attributes in the user
-        record hash for ease of use.
+        record hash for ease of use.  Timestamps are left out, so requests that only update last_seen leave the
+        hash unchanged.
         """
         data = {"username": self.username, "first_name": self.first_name, "last_name": self.last_name,
                 "dob": self.dob_string, "sex": self.sex, "app_group_ids": [x.id for x in self.app_groups],
@@ -641,17 +648,21 @@ class User(db.Model):
                 "address_hash": self.address.address_hash if self.address else None,
                 "role_id": self.role_id, "password_hash": self.password_hash,
                 "last_password_hash": self.last_password_hash, "password_timestamp": self.password_timestamp,
-                "description": self.description, "confirmed": self.confirmed, "active": self.active,
-                "last_seen": self.last_seen, "created_at": self.created_at, "updated_at": self.updated_at}
+                "description": self.description, "confirmed": self.confirmed, "active": self.active}
         data_str = json.dumps(data, sort_keys=True, default=json_serial)
         data_hash = hashlib.sha1(data_str.encode('utf-8')).hexdigest()
         return data_hash
 
-    def before_insert(self):
+    def refresh_row_hash(self):
         self.row_hash = self.generate_row_hash()
 
+    def before_insert(self):
+        self.refresh_row_hash()
+
     def before_update(self):
-        self.row_hash = self.generate_row_hash()
+        # The hash queries the primary email, phone number and address, so skip it when nothing hashed changed
+        if row_hash_changed(self):
+            self.refresh_row_hash()
 
     ##############################################################################################
     # USER SERIALIZATION METHOD
@@ -668,6 +679,28 @@ class User(db.Model):
         return user
 
 
+def refresh_contact_user_row_hashes(session, flush_context):
+    """
+    Session after_flush listener: recompute the row hash of users whose email addresses, phone numbers or addresses
+    were written.  The user hash covers the primary contacts, which can change without any User attribute changing,
+    e.g. when UserAPI promotes an existing email back to primary.  Runs after the flush so the contact queries see
+    the written rows, and writes a changed hash with a direct UPDATE.
+    """
+    user_ids = {obj.user_id for obj in itertools.chain(session.new, session.dirty, session.deleted)
+                if isinstance(obj, (EmailAddress, PhoneNumber, Address)) and obj.user_id}
+    for user_id in user_ids:
+        user = session.query(User).get(user_id)
+        if user is None or user in session.deleted:
+            continue
+        row_hash = user.generate_row_hash()
+        if row_hash != user.row_hash:
+            session.execute(User.__table__.update().where(User.__table__.c.id == user_id).values(row_hash=row_hash))
+            set_committed_value(user, 'row_hash', row_hash)
+
+
+event.listen(db.session, 'after_flush', refresh_contact_user_row_hashes)
+
+
 ##################################################################################################
 # MARSHMALLOW USER SCHEMA DEFINITION FOR USER OBJECT SERIALIZATION
 ##################################################################################################
@@ -0,0 +1,199 @@
+import json, os, shutil, threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import islice
+from sqlalchemy import func
+from app.extensions import db
+from app.models.bulk_export import BulkExportJob
+from app.models.fhir.patient import Patient
+
+# Resource types that can be exported, with the model each is read from
+export_models = {'Patient': Patient}
+
+
+##################################################################################################
+# BULK DATA EXPORT JOBS
+##################################################################################################
+
+def export_directory(app, job):
+    """Return the directory the NDJSON files of an export job are written to"""
+    return os.path.join(app.config['EXPORT_DIR'], str(job.uuid))
+
+
+def start_export_job(app, job_id):
+    """
+    Run an export job in a background thread.
+    :param app:
+        Flask application object (not the current_app proxy)
+    :param job_id:
+        Id of a committed BulkExportJob
+    :return:
+        The started threading.Thread
+    """
+    thread = threading.Thread(target=run_export_job, kwargs={'app': app, 'job_id': job_id}, daemon=True)
+    thread.start()
+    return thread
+
+
+def touch_export_job(job_id):
+    """
+    Record progress of a running export job by setting its updated_at.  Written on its own connection, so the
+    server-side cursor of the calling session is left open.
+    :param job_id:
+        Id of the BulkExportJob
+    :return:
+        False if the job is no longer in progress (it was deleted or failed) and the export should stop
+    """
+    table = BulkExportJob.__table__
+    with db.engine.begin() as connection:
+        result = connection.execute(table.update()
+                                    .where(table.c.id == job_id)
+                                    .where(table.c.status == 'in-progress')
+                                    .values(updated_at=datetime.utcnow()))
+    return result.rowcount > 0
+
+
+def fail_stale_export_jobs(app):
+    """
+    Mark accepted and in-progress export jobs that have not recorded progress for EXPORT_STALE_AFTER seconds as
+    failed.  Export threads do not survive a restart of the process running them, so their jobs would otherwise
+    stay in progress forever.
+    :param app:
+        Flask application object
+    :return:
+        The number of jobs marked as failed
+    """
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=app.config.get('EXPORT_STALE_AFTER', 600))
+    table = BulkExportJob.__table__
+    result = db.session.execute(table.update()
+                                .where(table.c.status.in_(['accepted', 'in-progress']))
+                                .where(func.coalesce(table.c.updated_at, table.c.created_at) < cutoff)
+                                .values(status='error', error='The export was interrupted before it completed',
+                                        completed_at=now, updated_at=now))
+    db.session.commit()
+    return result.rowcount
+
+
+def run_export_job(app, job_id):
+    """
+    Export every resource type of a BulkExportJob.  The id range of each type is split into EXPORT_WORKERS ranges
+    that are exported in parallel, each to its own series of NDJSON files.  Job status and output are committed
+    when the export finishes or fails.  The files of a job deleted while it ran are removed.
+    :param app:
+        Flask application object
+    :param job_id:
+        Id of the BulkExportJob
+    :return:
+        None
+    """
+    with app.app_context():
+        job = BulkExportJob.query.get(job_id)
+        if job.finished:
+            # Deleted or failed before the export started
+            db.session.remove()
+            return
+        job.status = 'in-progress'
+        db.session.commit()
+        directory = export_directory(app, job)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            output = []
+            for resource_type in job.resource_types:
+                ranges = id_ranges(model=export_models[resource_type], since=job.since,
+                                   parts=app.config.get('EXPORT_WORKERS', 4))
+                with ThreadPoolExecutor(max_workers=max(len(ranges), 1)) as executor:
+                    futures = [executor.submit(export_id_range, app=app, job_id=job.id, resource_type=resource_type,
+                                               start=start, end=end, part=part, directory=directory)
+                               for part, (start, end) in enumerate(ranges)]
+                    for future in futures:
+                        output.extend(future.result())
+            job = BulkExportJob.query.get(job_id)
+            if job.status == 'in-progress':
+                job.output = output
+                job.status = 'completed'
+        except Exception as e:
+            db.session.rollback()
+            job = BulkExportJob.query.get(job_id)
+            if not job.finished:
+                job.status = 'error'
+                job.error = str(e)
+        db.session.commit()
+        if job.status == 'deleted':
+            shutil.rmtree(directory, ignore_errors=True)
+        db.session.remove()
+
+
+def id_ranges(model, since=None, parts=4):
+    """
+    Split the ids of a model's rows into contiguous ranges of about equal width.
+    :param model:
+        SQLAlchemy model with an integer id and an updated_at column
+    :param since:
+        Only consider rows updated at or after this datetime
+    :param parts:
+        Number of ranges
+    :return:
+        List of (start, end) tuples, start inclusive and end exclusive
+    """
+    query = db.session.query(func.min(model.id), func.max(model.id))
+    if since is not None:
+        query = query.filter(model.updated_at >= since)
+    low, high = query.one()
+    if low is None:
+        return []
+    width = max((high - low + 1) // max(parts, 1), 1)
+    ranges = []
+    start = low
+    while start <= high:
+        end = start + width if len(ranges) < parts - 1 else high + 1
+        ranges.append((start, min(end, high + 1)))
+        start = end
+    return ranges
+
+
+def export_id_range(app, job_id, resource_type, start, end, part, directory):
+    """
+    Write the resources with ids in [start, end) as NDJSON.  Rows are read from a server-side cursor in batches of
+    EXPORT_BATCH_SIZE with their related records preloaded per batch.  A new file is started whenever the current
+    one exceeds EXPORT_FILE_MAX_BYTES.  Progress is recorded per batch and the export stops once the job is no
+    longer in progress.  Runs in a worker thread with its own session.
+    :return:
+        List of {'type', 'file', 'count'} dicts, one per file written
+    """
+    model = export_models[resource_type]
+    batch_size = app.config.get('EXPORT_BATCH_SIZE', 500)
+    max_bytes = app.config.get('EXPORT_FILE_MAX_BYTES', 50 * 1024 * 1024)
+    files = []
+    f = None
+    try:
+        with app.app_context():
+            job = BulkExportJob.query.get(job_id)
+            # Resource ids are absolute urls built for the host the export was requested from
+            with app.test_request_context(base_url=job.base_url):
+                query = model.query.filter(model.id >= start, model.id < end)
+                if job.since is not None:
+                    query = query.filter(model.updated_at >= job.since)
+                results = iter(query.order_by(model.id).yield_per(batch_size))
+                while True:
+                    batch = list(islice(results, batch_size))
+                    if not batch:
+                        break
+                    if not touch_export_job(job_id):
+                        break
+                    model.bulk_preload_fhir_relations(batch)
+                    for record in batch:
+                        if f is None or f.tell() > max_bytes:
+                            if f is not None:
+                                f.close()
+                            name = '{}.{}.{}.ndjson'.format(resource_type, part, len(files))
+                            f = open(os.path.join(directory, name), 'w', encoding='utf-8')
+                            files.append({'type': resource_type, 'file': name, 'count': 0})
+                        f.write(json.dumps(record.fhir_json(), separators=(',', ':')))
+                        f.write('\n')
+                        files[-1]['count'] += 1
+            db.session.remove()
+    finally:
+        if f is not None:
+            f.close()
+    return files
@@ -0,0 +1,702 @@
+import csv, json, os, random, time, uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+from sqlalchemy import inspect, text
+from sqlalchemy_continuum import version_class, versioning_manager
+from app.extensions import db
+from app.models.fhir.patient import Patient
+from app.models.fhir.address import Address
+from app.models.fhir.phone_number import PhoneNumber
+from app.models.fhir.email_address import EmailAddress
+from app.utils.demographics import validate_sex, validate_marital_status, validate_state, validate_phone, \
+    validate_contact_type, validate_language, race_dict, ethnicity_dict, non_digits_re, random_demographics, \
+    validate_dob, validate_ssn, validate_race, validate_ethnicity, validate_email, normalize_name, \
+    normalize_lastname_suffix, normalize_deceased, normalize_addresses
+from app.utils.type_validation import validate_datetime
+from app.utils.zipcodes import zipcode_index
+
+
+##################################################################################################
+# READING FHIR BUNDLES AND NDJSON
+##################################################################################################
+
+def iter_fhir_paths(paths):
+    """
+    Yield the FHIR resources in a list of files and directories.  Directories are expanded to the .json and .ndjson
+    files they contain, in name order.
+    :param paths:
+        List of file or directory paths
+    :return:
+        Generator of resource dicts
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted(n for n in os.listdir(path) if n.endswith('.json') or n.endswith('.ndjson'))
+            for name in names:
+                yield from iter_fhir_file(os.path.join(path, name))
+        else:
+            yield from iter_fhir_file(path)
+
+
+def iter_fhir_file(path):
+    """
+    Yield the FHIR resources in one file.  NDJSON files are read a line at a time.  JSON files hold a single resource
+    or a Bundle, whose entries are yielded; one Bundle is held in memory at a time.
+    """
+    with open(path, encoding='utf-8') as f:
+        if path.endswith('.ndjson'):
+            yield from iter_fhir_ndjson(f)
+        else:
+            yield from iter_fhir_resource(json.load(f))
+
+
+def iter_fhir_ndjson(lines):
+    """Yield the resources of an iterable of NDJSON lines (str or bytes), skipping blank lines"""
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if line.strip():
+            yield json.loads(line)
+
+
+def iter_fhir_resource(resource):
+    """Yield the entry resources of a Bundle, or the resource itself"""
+    if resource.get('resourceType') == 'Bundle':
+        for entry in resource.get('entry', []):
+            if entry.get('resource'):
+                yield entry['resource']
+    else:
+        yield resource
+
+
+##################################################################################################
+# MAPPING FHIR PATIENT RESOURCES TO MODELS
+##################################################################################################
+
+def fhir_state(value):
+    """Return the two character abbreviation of a US state name or abbreviation, or None"""
+    if not value:
+        return None
+    try:
+        return validate_state(value)
+    except ValueError:
+        return None
+
+
+def fhir_extension_code(resource, url_suffix):
+    """
+    Return the code of a US Core race or ethnicity extension, as nested ombCategory extensions (US Core) or a
+    valueCodeableConcept (as this server writes them)
+    """
+    for extension in resource.get('extension', []):
+        if not extension.get('url', '').endswith(url_suffix):
+            continue
+        for nested in extension.get('extension', []):
+            if nested.get('url') == 'ombCategory' and nested.get('valueCoding'):
+                return nested['valueCoding'].get('code')
+        for coding in extension.get('valueCodeableConcept', {}).get('coding', []):
+            return coding.get('code')
+    return None
+
+
+def fhir_coding_code(codeable_concept):
+    """Return the code of the first coding of a CodeableConcept dict"""
+    for coding in (codeable_concept or {}).get('coding', []):
+        if coding.get('code'):
+            return coding['code']
+    return None
+
+
+def patient_from_fhir(resource):
+    """
+    Map a FHIR Patient resource onto new, transient Patient, Address, PhoneNumber and EmailAddress instances.
+    Values that do not validate against the server's value sets are dropped rather than failing the resource.
+    :param resource:
+        A FHIR STU 3.0 Patient resource dict, e.g. from a Synthea bundle
+    :return:
+        Tuple of (Patient, list of Address, list of PhoneNumber, list of EmailAddress).  The instances are not added
+        to the session and have no ids.
+    """
+    pt = Patient()
+    try:
+        pt.uuid = uuid.UUID(str(resource.get('id')))
+    except ValueError:
+        pt.uuid = uuid.uuid4()
+
+    names = resource.get('name', [])
+    name = next((n for n in names if n.get('use') == 'official'), names[0] if names else {})
+    family = name.get('family')
+    # DSTU2 HumanName.family is a list
+    pt.last_name = ' '.join(family) if isinstance(family, list) else family
+    given = name.get('given', [])
+    pt.first_name = given[0] if given else None
+    pt.middle_name = ' '.join(given[1:]) or None
+    pt.prefix = (name.get('prefix') or [None])[0]
+    pt.suffix = (name.get('suffix') or [None])[0]
+
+    for identifier in resource.get('identifier', []):
+        if identifier.get('system') == 'http://hl7.org/fhir/sid/us-ssn':
+            ssn = non_digits_re.sub('', identifier.get('value', ''))
+            pt.ssn = ssn if len(ssn) == 9 else None
+
+    if resource.get('gender'):
+        sex = validate_sex(resource['gender'])
+        # Patient serialization maps M and F only
+        pt.sex = sex if sex in ('M', 'F') else None
+    if resource.get('birthDate'):
+        pt.dob = validate_datetime(resource['birthDate'], to_date=True)
+    if resource.get('deceasedDateTime'):
+        pt.deceased = True
+        pt.deceased_date = validate_datetime(resource['deceasedDateTime'], to_date=True)
+    else:
+        pt.deceased = bool(resource.get('deceasedBoolean', False))
+    pt.multiple_birth = bool(resource.get('multipleBirthBoolean', False) or resource.get('multipleBirthInteger'))
+    if 'active' in resource:
+        pt.active = bool(resource['active'])
+
+    marital_status = fhir_coding_code(resource.get('maritalStatus'))
+    if marital_status:
+        try:
+            pt.marital_status = validate_marital_status(marital_status)
+        except ValueError:
+            pass
+
+    race = fhir_extension_code(resource, 'us-core-race')
+    if race:
+        pt.race = race if race in race_dict else 'UNK'
+    ethnicity = fhir_extension_code(resource, 'us-core-ethnicity')
+    if ethnicity in ethnicity_dict:
+        pt.ethnicity = ethnicity
+
+    for communication in resource.get('communication', []):
+        language = fhir_coding_code(communication.get('language'))
+        for code in [language, (language or '').split('-')[0]]:
+            try:
+                pt.preferred_language = validate_language(code)
+                break
+            except (ValueError, AttributeError):
+                pass
+        if pt.preferred_language:
+            break
+
+    addresses = []
+    for fa in resource.get('address', []):
+        lines = fa.get('line', [])
+        period = fa.get('period', {})
+        country = fa.get('country')
+        addresses.append(Address(address1=lines[0] if lines else None, address2=' '.join(lines[1:]) or None,
+                                 city=fa.get('city'), state=fhir_state(fa.get('state')),
+                                 zipcode=fa.get('postalCode'), district=fa.get('district'),
+                                 country='USA' if country == 'US' else country,
+                                 use=fa['use'].upper() if fa.get('use') else None,
+                                 start_date=validate_datetime(period['start'], to_date=True)
+                                 if period.get('start') else None,
+                                 end_date=validate_datetime(period['end'], to_date=True) if period.get('end') else None,
+                                 primary=not addresses, active=not period.get('end')))
+
+    phone_numbers = []
+    email_addresses = []
+    for contact_point in resource.get('telecom', []):
+        if contact_point.get('system') == 'phone':
+            try:
+                number = validate_phone(contact_point.get('value'))
+            except ValueError:
+                continue
+            try:
+                contact_type = validate_contact_type(contact_point.get('use'))
+            except ValueError:
+                contact_type = 'HOME'
+            phone_numbers.append(PhoneNumber(number=number, type=contact_type, primary=not phone_numbers))
+        elif contact_point.get('system') == 'email' and contact_point.get('value'):
+            email_addresses.append(EmailAddress(email=contact_point['value'], primary=not email_addresses))
+
+    return pt, addresses, phone_numbers, email_addresses
+
+
+def patient_from_demographics(demo_dict):
+    """
+    Map a random_demographics() dict onto new, transient model instances, as Patient.randomize_patient() does for a
+    session-bound patient.
+    :return:
+        Tuple of (Patient, list of Address, list of PhoneNumber, list of EmailAddress), as for patient_from_fhir()
+    """
+    pt = Patient()
+    for attribute in ['first_name', 'last_name', 'middle_name', 'suffix', 'dob', 'sex', 'ssn', 'race', 'ethnicity',
+                      'marital_status', 'deceased_date', 'preferred_language']:
+        setattr(pt, attribute, demo_dict.get(attribute))
+    pt.deceased = demo_dict.get('deceased', False)
+    pt.multiple_birth = demo_dict.get('multiple_birth', False)
+
+    addresses = [Address(address1=demo_dict.get('address1'), address2=demo_dict.get('address2'),
+                         city=demo_dict.get('city'), state=demo_dict.get('state'), zipcode=demo_dict.get('zipcode'),
+                         active=True, primary=True, is_physical=True, is_postal=True, use='HOME')]
+
+    phone_numbers = [PhoneNumber(number=demo_dict[key], type=contact_type)
+                     for key, contact_type in (('home_phone', 'HOME'), ('mobile_phone', 'MOBILE'),
+                                               ('work_phone', 'WORK')) if demo_dict.get(key)]
+    if phone_numbers:
+        random.choice(phone_numbers).primary = True
+
+    email_addresses = []
+    if demo_dict.get('email'):
+        email_addresses.append(EmailAddress(email=demo_dict['email'], active=True, primary=True))
+    return pt, addresses, phone_numbers, email_addresses
+
+
+##################################################################################################
+# BATCHED MULTI-ROW INSERTS
+##################################################################################################
+
+def next_ids(model, number):
+    """Reserve the next ids of a model's serial primary key sequence in one round trip"""
+    if not number:
+        return []
+    rows = db.session.execute(text("SELECT nextval(pg_get_serial_sequence(:table_name, 'id')) "
+                                   "FROM generate_series(1, :number)"),
+                              {'table_name': model.__tablename__, 'number': number})
+    return [row[0] for row in rows]
+
+
+def model_row(obj):
+    """
+    Return the column values of a transient model instance as an insert row.  Unset columns take their column
+    default, as they would in an ORM flush.
+    """
+    row = {}
+    for prop in inspect(type(obj)).column_attrs:
+        column = prop.columns[0]
+        value = getattr(obj, prop.key)
+        if value is None and column.default is not None:
+            value = column.default.arg(None) if column.default.is_callable else column.default.arg
+        row[column.key] = value
+    return row
+
+
+def version_rows(model, rows, transaction_id):
+    """Build the insert-operation version table rows SQLAlchemy-Continuum would write for new rows of a model"""
+    columns = version_class(model).__table__.columns
+    result = []
+    for row in rows:
+        version_row = {}
+        for column in columns:
+            if column.key in row:
+                version_row[column.key] = row[column.key]
+            elif column.key == 'transaction_id':
+                version_row[column.key] = transaction_id
+            elif column.key == 'operation_type':
+                version_row[column.key] = 0
+            elif column.key.endswith('_mod'):
+                version_row[column.key] = True
+            else:
+                version_row[column.key] = None
+        result.append(version_row)
+    return result
+
+
+def insert_patient_batch(records, user_id=None):
+    """
+    Insert a batch of mapped patients and their addresses, phone numbers and email addresses with one multi-row
+    INSERT per table.  Ids are reserved from the sequences up front so child rows can reference their patient
+    without RETURNING round trips.  Model before_insert() hooks still fill in row hashes and search columns, and
+    one versioning transaction with insert-operation version rows is written so history and ETags match records
+    created through the ORM.  The caller commits.
+    :param records:
+        List of (Patient, addresses, phone numbers, email addresses) tuples from patient_from_fhir()
+    :param user_id:
+        Id of the User recorded on the versioning transaction
+    :return:
+        List of the new patient ids
+    """
+    if not records:
+        return []
+    now = datetime.utcnow()
+    patient_ids = next_ids(Patient, len(records))
+    children = {Address: [], PhoneNumber: [], EmailAddress: []}
+    for (pt, addresses, phone_numbers, email_addresses), patient_id in zip(records, patient_ids):
+        pt.id = patient_id
+        for model, instances in ((Address, addresses), (PhoneNumber, phone_numbers),
+                                 (EmailAddress, email_addresses)):
+            for instance in instances:
+                instance.patient_id = patient_id
+            children[model].extend(instances)
+
+    instances_by_model = [(Patient, [record[0] for record in records])]
+    instances_by_model.extend(children.items())
+
+    transaction_table = versioning_manager.transaction_cls.__table__
+    transaction_values = {'issued_at': now}
+    if 'user_id' in transaction_table.c:
+        transaction_values['user_id'] = user_id
+    transaction_id = db.session.execute(transaction_table.insert().values(transaction_values)
+                                        .returning(transaction_table.c.id)).scalar()
+
+    for model, instances in instances_by_model:
+        if not instances:
+            continue
+        if model is not Patient:
+            for instance, instance_id in zip(instances, next_ids(model, len(instances))):
+                instance.id = instance_id
+        for instance in instances:
+            instance.created_at = now
+            instance.updated_at = now
+            instance.before_insert()
+        rows = [model_row(instance) for instance in instances]
+        db.session.execute(model.__table__.insert().values(rows))
+        db.session.execute(version_class(model).__table__.insert().values(
+            version_rows(model, rows, transaction_id)))
+    return patient_ids
+
+
+class PatientBulkLoader(object):
+    """
+    Accumulate FHIR Patient resources and insert them in batches with insert_patient_batch(), committing each batch.
+    Resources of other types are skipped, as are patients whose uuid (the resource id) was already loaded, so
+    re-running an import is safe.  Counts and throughput are kept for reporting.
+    """
+
+    def __init__(self, batch_size=500, user_id=None):
+        self.batch_size = batch_size
+        self.user_id = user_id
+        self.pending = []
+        self.loaded = 0
+        self.skipped = 0
+        self.errors = []
+        self.started = time.time()
+
+    def add(self, resource):
+        """Map one resource and insert the pending batch once it is full"""
+        if resource.get('resourceType') != 'Patient':
+            self.skipped += 1
+            return
+        try:
+            self.pending.append(patient_from_fhir(resource))
+        except (ValueError, TypeError, KeyError) as e:
+            self.errors.append('Patient {}: {}'.format(resource.get('id'), e))
+            return
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def load(self, resources):
+        """Add every resource of an iterable and insert the remainder"""
+        for resource in resources:
+            self.add(resource)
+        self.flush()
+        return self
+
+    def flush(self):
+        """Insert and commit the pending patients that are not already in the database"""
+        pending, self.pending = self.pending, []
+        unique = {}
+        for record in pending:
+            unique.setdefault(record[0].uuid, record)
+        existing = set()
+        if unique:
+            existing = {row[0] for row in db.session.query(Patient.uuid).filter(Patient.uuid.in_(list(unique)))}
+        records = [record for key, record in unique.items() if key not in existing]
+        self.skipped += len(pending) - len(records)
+        if records:
+            insert_patient_batch(records, user_id=self.user_id)
+            db.session.commit()
+            self.loaded += len(records)
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    @property
+    def rate(self):
+        """Loaded resources per second"""
+        return self.loaded / max(self.elapsed, 1e-9)
+
+    def summary(self):
+        return 'Loaded {} patients in {} seconds ({} resources/sec), skipped {}, {} errors'.format(
+            self.loaded, round(self.elapsed, 3), round(self.rate, 1), self.skipped, len(self.errors))
+
+
+def bulk_create_random_patients(number, chunk_size=1000, progress=None):
+    """
+    Generate random patients a chunk at a time and insert each chunk with insert_patient_batch(), committing per
+    chunk so memory use and transaction size stay flat however many patients are created.
+    :param number:
+        Number of patients to create
+    :param chunk_size:
+        Patients generated, inserted and committed together
+    :param progress:
+        Optional callable, called after each commit with (patients created, rows inserted)
+    :return:
+        Tuple of (patients created, rows inserted).  Rows include child tables but not version rows.
+    """
+    created = 0
+    rows = 0
+    while created < number:
+        records = [patient_from_demographics(demo)
+                   for demo in random_demographics(number=min(chunk_size, number - created))]
+        insert_patient_batch(records)
+        db.session.commit()
+        created += len(records)
+        rows += sum(1 + len(addresses) + len(phone_numbers) + len(email_addresses)
+                    for pt, addresses, phone_numbers, email_addresses in records)
+        if progress:
+            progress(created, rows)
+    return created, rows
+
+
+##################################################################################################
+# LOADING PIPE-DELIMITED DEMOGRAPHIC SEED FILES
+##################################################################################################
+
+# Columns of demographic_seed.txt.  first_name, last_name and dob are required in every row.
+seed_columns = ('first_name', 'last_name', 'middle_name', 'prefix', 'suffix', 'sex', 'dob', 'ssn', 'race',
+                'ethnicity', 'marital_status', 'deceased', 'deceased_date', 'multiple_birth', 'preferred_language',
+                'address1', 'address2', 'city', 'state', 'zipcode', 'district', 'country', 'is_physical', 'is_postal',
+                'use', 'start_date', 'email', 'home_phone', 'mobile_phone', 'work_phone')
+seed_phone_types = (('home_phone', 'HOME'), ('mobile_phone', 'MOBILE'), ('work_phone', 'WORK'))
+
+
+def iter_seed_rows(f):
+    """
+    Yield the rows of a pipe-delimited demographic seed file, reading a line at a time.
+    :param f:
+        Open text file
+    :raises ValueError:
+        If the header is missing a seed column
+    :return:
+        Generator of (line number, row dict) tuples.  Blank values are None.
+    """
+    reader = csv.DictReader(f, delimiter='|')
+    missing = [column for column in seed_columns if column not in (reader.fieldnames or [])]
+    if missing:
+        raise ValueError('The seed file header is missing the columns: {}'.format(', '.join(missing)))
+    for row in reader:
+        yield reader.line_num, {key: (value.strip() or None) if isinstance(value, str) else value
+                                for key, value in row.items() if key is not None}
+
+
+def seed_boolean(value, default=False):
+    """Parse a true/false seed value.  Blank values are the default."""
+    if value is None:
+        return default
+    value = str(value).strip().upper()
+    if value in ('TRUE', 'T', 'YES', 'Y', '1'):
+        return True
+    if value in ('FALSE', 'F', 'NO', 'N', '0'):
+        return False
+    raise ValueError('An invalid value ({}) was supplied as a boolean.'.format(value))
+
+
+def validate_seed_row(row):
+    """
+    Validate and normalize one seed row with the demographics validate_* and normalize_* helpers.  Addresses are
+    normalized separately, in batches, by normalize_addresses().
+    :param row:
+        Row dict from iter_seed_rows()
+    :raises ValueError:
+        Naming the first column that does not validate
+    :return:
+        Dict of patient attributes, plus 'address' (normalize_address() keyword arguments and the address use,
+        type and start date, or None), 'phone_numbers' ((number, type) tuples) and 'email'
+    """
+    def validated(column, validator, required=False):
+        value = row.get(column)
+        if value is None and not required:
+            return None
+        try:
+            return validator(value)
+        except (ValueError, TypeError) as e:
+            raise ValueError('{}: {}'.format(column, e))
+
+    first_name = normalize_name(name=row.get('first_name'))
+    last_name, suffix = normalize_lastname_suffix(last_name=row.get('last_name'), suffix=row.get('suffix'))
+    if not first_name or not last_name:
+        raise ValueError('first_name and last_name are required')
+
+    sex = validated('sex', validate_sex)
+    cleaned = {'first_name': first_name, 'last_name': last_name, 'suffix': suffix,
+               'middle_name': normalize_name(name=row.get('middle_name')) or None,
+               'prefix': normalize_name(name=row.get('prefix')) or None,
+               # Patient serialization maps M and F only
+               'sex': sex if sex in ('M', 'F') else None,
+               'dob': validated('dob', validate_dob, required=True),
+               'ssn': validated('ssn', validate_ssn),
+               'race': validated('race', validate_race),
+               'ethnicity': validated('ethnicity', validate_ethnicity),
+               'marital_status': validated('marital_status', validate_marital_status),
+               'deceased_date': validated('deceased_date', lambda v: validate_datetime(v, to_date=True)),
+               'multiple_birth': validated('multiple_birth', seed_boolean) or False,
+               'preferred_language': validated('preferred_language', validate_language),
+               'email': validated('email', validate_email)}
+    cleaned['deceased'] = bool(cleaned['deceased_date']) or \
+        validated('deceased', lambda v: normalize_deceased(v) or seed_boolean(v)) or False
+
+    cleaned['address'] = None
+    if any(row.get(column) for column in ('address1', 'address2', 'city', 'state', 'zipcode')):
+        cleaned['address'] = {column: row.get(column) for column in ('address1', 'address2', 'city', 'state',
+                                                                     'zipcode', 'district', 'country')}
+        cleaned['address_use'] = (row.get('use') or 'HOME').upper()
+        cleaned['address_is_physical'] = validated('is_physical', lambda v: seed_boolean(v, default=True))
+        cleaned['address_is_postal'] = validated('is_postal', lambda v: seed_boolean(v, default=True))
+        cleaned['address_start_date'] = validated('start_date', lambda v: validate_datetime(v, to_date=True))
+
+    cleaned['phone_numbers'] = [(validated(column, validate_phone), contact_type)
+                                for column, contact_type in seed_phone_types if row.get(column)]
+    return cleaned
+
+
+def validate_seed_chunk(rows):
+    """
+    Validate a chunk of seed rows and normalize their addresses in one normalize_addresses() call, so address
+    locations shared within the chunk are resolved once.  Module level so SeedLoader can run chunks in a process
+    pool.
+    :param rows:
+        List of (line number, row dict) tuples
+    :return:
+        List of (line number, row dict, cleaned dict or None, error message or None) tuples
+    """
+    results = []
+    for line_number, row in rows:
+        try:
+            results.append([line_number, row, validate_seed_row(row), None])
+        except ValueError as e:
+            results.append([line_number, row, None, str(e)])
+
+    with_address = [result for result in results if result[2] and result[2]['address']]
+    normalized = normalize_addresses([result[2]['address'] for result in with_address], workers=1)
+    for result, address in zip(with_address, normalized):
+        if address is None:
+            result[2], result[3] = None, 'address: Could not normalize the address state'
+        else:
+            result[2]['address'] = address
+    return [tuple(result) for result in results]
+
+
+def patient_from_seed(cleaned):
+    """
+    Map a validate_seed_row() dict onto new, transient model instances
+    :return:
+        Tuple of (Patient, list of Address, list of PhoneNumber, list of EmailAddress), as for patient_from_fhir()
+    """
+    pt = Patient()
+    for attribute in ['first_name', 'last_name', 'middle_name', 'prefix', 'suffix', 'sex', 'dob', 'ssn', 'race',
+                      'ethnicity', 'marital_status', 'deceased', 'deceased_date', 'multiple_birth',
+                      'preferred_language']:
+        setattr(pt, attribute, cleaned[attribute])
+
+    addresses = []
+    if cleaned['address']:
+        addresses.append(Address(active=True, primary=True, use=cleaned['address_use'],
+                                 is_physical=cleaned['address_is_physical'],
+                                 is_postal=cleaned['address_is_postal'],
+                                 start_date=cleaned['address_start_date'], **cleaned['address']))
+    phone_numbers = [PhoneNumber(number=number, type=contact_type, primary=not i)
+                     for i, (number, contact_type) in enumerate(cleaned['phone_numbers'])]
+    email_addresses = [EmailAddress(email=cleaned['email'], active=True, primary=True)] if cleaned['email'] else []
+    return pt, addresses, phone_numbers, email_addresses
+
+
+def bounded_map(executor, fn, iterable, window):
+    """
+    Like executor.map(), but only 'window' calls are submitted ahead of the results consumed, so arbitrarily large
+    inputs are read lazily.  Results are yielded in input order.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class SeedLoader(object):
+    """
+    Load a pipe-delimited demographic seed file (demographic_seed.txt or larger files of the same format).  Rows are
+    read a chunk at a time and validated in a process pool while the main process inserts the previous chunks with
+    insert_patient_batch(), committing each batch.  Rows that do not validate are written, with their line number
+    and error, to a pipe-delimited rejects file.  Patients whose row hash is already in the database are skipped, so
+    re-running a load is safe.
+    """
+
+    def __init__(self, batch_size=1000, workers=None, rejects_path=None, user_id=None):
+        self.batch_size = batch_size
+        self.workers = workers
+        self.rejects_path = rejects_path
+        self.user_id = user_id
+        self.rows = 0
+        self.loaded = 0
+        self.skipped = 0
+        self.rejected = 0
+        self.started = time.time()
+        self._rejects = None
+
+    def load(self, path):
+        """Validate and insert every row of a seed file"""
+        with open(path, encoding='utf-8', newline='') as f:
+            rows = iter_seed_rows(f)
+            chunks = iter(lambda: list(islice(rows, self.batch_size)), [])
+            try:
+                if self.workers == 1:
+                    for chunk in map(validate_seed_chunk, chunks):
+                        self.insert(chunk)
+                else:
+                    # Load the zipcode index before the pool starts so forked workers share it
+                    zipcode_index()
+                    with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                        window = (self.workers or os.cpu_count() or 1) * 2
+                        for chunk in bounded_map(executor, validate_seed_chunk, chunks, window=window):
+                            self.insert(chunk)
+            finally:
+                if self._rejects is not None:
+                    self._rejects.close()
+                    self._rejects = None
+        return self
+
+    def insert(self, chunk):
+        """Insert and commit the valid rows of a validated chunk and record the rejects"""
+        self.rows += len(chunk)
+        records = []
+        for line_number, row, cleaned, error in chunk:
+            if error:
+                self.reject(line_number, row, error)
+            else:
+                records.append(patient_from_seed(cleaned))
+
+        unique = {}
+        for record in records:
+            unique.setdefault(record[0].generate_row_hash(), record)
+        existing = set()
+        if unique:
+            existing = {row[0] for row in db.session.query(Patient.row_hash).filter(
+                Patient.row_hash.in_(list(unique)))}
+        records = [record for key, record in unique.items() if key not in existing]
+        self.skipped += len(chunk) - len(records) - sum(1 for result in chunk if result[3])
+        if records:
+            insert_patient_batch(records, user_id=self.user_id)
+            db.session.commit()
+            self.loaded += len(records)
+
+    def reject(self, line_number, row, error):
+        """Write a row that did not validate to the rejects file"""
+        self.rejected += 1
+        if not self.rejects_path:
+            return
+        if self._rejects is None:
+            self._rejects = open(self.rejects_path, 'w', encoding='utf-8', newline='')
+            self._rejects_writer = csv.DictWriter(self._rejects, fieldnames=('line',) + seed_columns + ('error',),
+                                                  delimiter='|', extrasaction='ignore')
+            self._rejects_writer.writeheader()
+        self._rejects_writer.writerow(dict(row, line=line_number, error=error))
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    @property
+    def rate(self):
+        """Rows read per second"""
+        return self.rows / max(self.elapsed, 1e-9)
+
+    def summary(self):
+        return 'Read {} rows in {} seconds ({} rows/sec): loaded {} patients, skipped {}, rejected {}'.format(
+            self.rows, round(self.elapsed, 3), round(self.rate, 1), self.loaded, self.skipped, self.rejected)
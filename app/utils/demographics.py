@@ -1,12 +1,13 @@
 import re
 import random
+from concurrent.futures import ProcessPoolExecutor
 import unidecode
 from datetime import datetime, date, timedelta
 from dateutil import parser as dateparser
 from dateutil.relativedelta import relativedelta
-from uszipcode import ZipcodeSearchEngine
 from faker import Faker
 from entropy import shannon_entropy
+from app.utils.zipcodes import zipcode_index
 
 # Regex utilities
 non_digits_re = re.compile('[^0-9]')
@@ -201,10 +202,10 @@ def normalize_city_state(city=None, state=None):
         The tuple is returned as ("cityname", "statename", "zipcode"). If lookup fails for one or all three items a None 
         object is returned in the tuple.
     """
-    zipcode_search = ZipcodeSearchEngine()
+    index = zipcode_index()
     if state and city:
         try:
-            city_state_zips = zipcode_search.by_city_and_state(city, state)
+            city_state_zips = index.city_state(city, state)
             if city_state_zips:
                 zip_object = city_state_zips[0]
                 single_zipcode = None
@@ -231,16 +232,7 @@ def validate_state(state):
         If a valid US state is found, the two character state abbreviation is returned.
         Otherwise, a ValueError is raised
     """
-    zipcode_search = ZipcodeSearchEngine()
-    try:
-        state_zips = zipcode_search.by_state(state)
-        if state:
-            state = state_zips[0]
-            return state.State
-        else:
-            raise ValueError('Could not find a valid US state with the given input: {}'.format(state))
-    except TypeError:
-        raise ValueError('Could not find a valid US state with the given input: {}'.format(state))
+    return zipcode_index().state(state)
 
 
 def validate_country(country):
@@ -272,14 +264,12 @@ def lookup_zipcode_object(zipcode):
         A string value for a zipcode to lookup
         
     :return:
-        If matching zipcode is found a dictionary object for the zipcode including information about it is returned.  
-        This is a uszipcode zipcode object.  
+        If matching zipcode is found a record for the zipcode including information about it is returned.  
+        This is an app.utils.zipcodes.ZipcodeRecord with the uszipcode Zipcode, City, State and Population attributes.
         
         If no zipcode is found, None is returned.
     """
-    zipcode_search = ZipcodeSearchEngine()
-    zipcode = zipcode_search.by_zipcode(zipcode)
-    return zipcode
+    return zipcode_index().zipcode(zipcode)
 
 
 def validate_zipcode(zipcode):
@@ -308,9 +298,8 @@ def random_zipcode(number=1, potential_matches=1000, string_only=True):
     Randomly generates an object from the top 'potential_matches' zipcodes by population.
     
     USAGE NOTES:
-    When generating random zipcodes, it is best to use this function to generate the number of results  you need,
-    and then manipulate the returned list, rather than calling this function for each zipcode required.  
-    Repeated calls to this function will repeat the generation of a list of 1000 zipcodes and affect performance.
+    The list of the most populous zipcodes is loaded once per process by top_zipcodes(), so repeated calls only
+    pay for the random selection.
       
     :param number:
         TYPE: int - positive values only
@@ -346,9 +335,7 @@ def random_zipcode(number=1, potential_matches=1000, string_only=True):
 
         string_only = bool(string_only)
 
-        search = ZipcodeSearchEngine()
-        res = search.by_population(lower=0, upper=999999999, sort_by="Population", ascending=False,
-                                   returns=potential_matches)
+        res = top_zipcodes(potential_matches)
         zipcode_list = []
         for x in range(0, number):
             zipcode = random.choice(res)
@@ -429,55 +416,133 @@ def normalize_address(address1=None, address2=None, city=None, state=None, zipco
     
         If zipcode is not supplied, and city is supplied, the city name is accepted without validation.
     """
-    n_address_dict = {"address1": None, "address2": None, "city": None, "state": None, "zipcode": None,
-                      "district": None, "country": None}
-
-    n_district = normalize_name(name=district)
-
     if address1:
         address1 = str(address1).upper().strip()
     if address2:
         address2 = str(address2).upper().strip()
 
+    n_address_dict = {"address1": address1, "address2": address2}
+    n_address_dict.update(normalize_address_location(city=city, state=state, zipcode=zipcode, district=district,
+                                                     country=country))
+    return n_address_dict
+
+
+def normalize_address_location(city=None, state=None, zipcode=None, district=None, country=None):
+    """
+    Normalize the city, state, zipcode, district and country of an address, as described for normalize_address().
+    The result depends only on these five values, so it can be memoized across addresses.
+
+    :return:
+        Returns a dictionary with keys "city", "state", "zipcode", "district", "country"
+    """
+    n_location_dict = {"city": None, "state": None, "zipcode": None, "district": None, "country": None}
+
+    n_district = normalize_name(name=district)
+
     zip_object = None
     if zipcode:
         zip_object = lookup_zipcode_object(zipcode)
 
     if zip_object:
-        n_address_dict["zipcode"] = zip_object.Zipcode
-        n_address_dict["state"] = zip_object.State
-        n_address_dict["city"] = (str(zip_object.City).upper())
-        n_address_dict["address1"] = address1
-        n_address_dict["address2"] = address2
-        n_address_dict["district"] = n_district
-        n_address_dict["country"] = "USA"
+        n_location_dict["zipcode"] = zip_object.Zipcode
+        n_location_dict["state"] = zip_object.State
+        n_location_dict["city"] = (str(zip_object.City).upper())
+        n_location_dict["district"] = n_district
+        n_location_dict["country"] = "USA"
 
     elif state:
         n_city, n_state, n_zipcode = normalize_city_state(city=city, state=state)
-        n_address_dict["state"] = n_state
+        n_location_dict["state"] = n_state
         if n_state:
-            n_address_dict["country"] = "USA"
-            n_address_dict["district"] = n_district
-        n_address_dict["city"] = str(n_city).upper()
-        n_address_dict["zipcode"] = n_zipcode
-        if not n_address_dict.get("city", None):
-            n_address_dict["city"] = str(city).upper().strip()
-        n_address_dict["address1"] = address1
-        n_address_dict["address2"] = address2
+            n_location_dict["country"] = "USA"
+            n_location_dict["district"] = n_district
+        if n_city:
+            n_location_dict["city"] = str(n_city).upper()
+        elif city:
+            n_location_dict["city"] = str(city).upper().strip()
+        n_location_dict["zipcode"] = n_zipcode
 
     else:
         if country:
             try:
                 n_country = validate_country(country=country)
-                n_address_dict["country"] = n_country
+                n_location_dict["country"] = n_country
             except ValueError:
                 pass
         if city:
-            n_address_dict["city"] = str(city).strip().upper()
-        n_address_dict["address1"] = address1
-        n_address_dict["address2"] = address2
+            n_location_dict["city"] = str(city).strip().upper()
 
-    return n_address_dict
+    return n_location_dict
+
+
+address_keys = ("address1", "address2", "city", "state", "zipcode", "district", "country")
+
+
+def _normalize_address_locations(locations):
+    """
+    Normalize a list of (city, state, zipcode, district, country) tuples.  Module level so normalize_addresses()
+    can run chunks in a process pool.
+    :return:
+        List of location dicts, with None for locations that raise ValueError
+    """
+    result = []
+    for city, state, zipcode, district, country in locations:
+        try:
+            result.append(normalize_address_location(city=city, state=state, zipcode=zipcode, district=district,
+                                                     country=country))
+        except ValueError:
+            result.append(None)
+    return result
+
+
+def normalize_addresses(addresses, workers=None, parallel_threshold=20000, chunk_size=2000):
+    """
+    Batch version of normalize_address() for ingestion.  Identical addresses are normalized once, and the
+    city / state / zipcode resolution is memoized across addresses that share a location, which is most of them in
+    bulk data.  Large batches resolve their distinct locations across a process pool.
+
+    :param addresses:
+        Iterable of dicts with any of the normalize_address() keyword arguments (address1, address2, city, state,
+        zipcode, district, country).  Other keys are ignored.
+    :param workers:
+        Number of worker processes, defaults to the number of CPUs
+    :param parallel_threshold:
+        Minimum number of distinct locations before a process pool is used
+    :param chunk_size:
+        Distinct locations per pool task
+
+    :return:
+        List of normalized address dicts in input order.  Addresses whose state cannot be resolved are None.
+    """
+    keys = [tuple(address.get(key) for key in address_keys) for address in addresses]
+    # Distinct (city, state, zipcode, district, country) values, in first-seen order
+    locations = list(dict.fromkeys(key[2:] for key in keys))
+
+    if len(locations) >= parallel_threshold and workers != 1:
+        # Load the zipcode index before the pool starts so forked workers share it
+        zipcode_index()
+        chunks = [locations[i:i + chunk_size] for i in range(0, len(locations), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            resolved = [location for chunk in executor.map(_normalize_address_locations, chunks)
+                        for location in chunk]
+    else:
+        resolved = _normalize_address_locations(locations)
+    location_map = dict(zip(locations, resolved))
+
+    normalized = {}
+    result = []
+    for key in keys:
+        if key not in normalized:
+            location = location_map[key[2:]]
+            if location is None:
+                normalized[key] = None
+            else:
+                address1, address2 = key[0], key[1]
+                normalized[key] = dict(location, address1=str(address1).upper().strip() if address1 else address1,
+                                       address2=str(address2).upper().strip() if address2 else address2)
+        # Each input gets its own dict so callers can modify results independently
+        result.append(dict(normalized[key]) if normalized[key] is not None else None)
+    return result
 
 
 def random_full_address(number=1):
@@ -1207,44 +1272,174 @@ def random_demographics(number=1):
     except ValueError:
         print("Invalid value passed as argument for 'number'.  Must be an integer of base 10.")
 
-    address_list = random_full_address(number=number)
-    result = []
-
-    for x in range(0, number):
-        sex = random_sex()
-        first_name = random_first_name(sex=sex)
-        middle_name = random_first_name(sex=sex)
-        last_name = random_last_name()
-        suffix = random_suffix()
-        ssn = random_ssn()
-        home_phone = random_phone()
-        mobile_phone = random_phone()
-        work_phone = random_phone()
-        username = (first_name + "." + last_name + str(random.randint(0, 1000)))
-        email = username + '@EXAMPLE.COM'
-        dob = random_dob()
-        multiple_birth = random_deceased()
-        deceased = random_deceased()
-        if deceased:
-            deceased_date = random_death_date(dob=dob)
-        else:
-            deceased_date = None
-        marital_status = random_marital_status()
-        preferred_language = random_language()
-        race = random_race()
-        ethnicity = random_ethnicity()
-        password = random.randint(1, 99999999999)
-
-        demo_dict = {"first_name": first_name, "last_name": last_name, "middle_name": middle_name, "dob": dob,
-                     "sex": sex, "ssn": ssn, "home_phone": home_phone, "mobile_phone": mobile_phone,
-                     "work_phone": work_phone, "email": email, "deceased": deceased, "deceased_date": deceased_date,
-                     "suffix": suffix, "marital_status": marital_status, "race": race, "multiple_birth": multiple_birth,
-                     "ethnicity": ethnicity, "username": username, "password": password,
-                     "preferred_language": preferred_language}
-        demo_dict.update(address_list.pop(0))
-        result.append(demo_dict)
+    result = list(iter_random_demographics(number=number))
 
     if result:
         return result
     else:
         return None
+
+
+##################################################################################################
+# BATCHED RANDOM DEMOGRAPHICS
+##################################################################################################
+
+# Value lists and weights that random demographics are drawn from, loaded once per process
+_demographic_values = {}
+
+
+def top_zipcodes(potential_matches=1000):
+    """
+    Return the 'potential_matches' most populous zipcode records from the process-wide zipcode index.
+    """
+    return zipcode_index().by_population(potential_matches)
+
+
+def _weighted_values(values):
+    """Split a Faker value list into (values, weights).  Weighted lists are OrderedDicts of {value: weight}."""
+    if isinstance(values, dict):
+        return [str(v).upper() for v in values.keys()], list(values.values())
+    return [str(v).upper() for v in values], None
+
+
+def demographic_values():
+    """
+    Return the name, street and code value lists used by random_demographic_columns().  Names and street suffixes
+    are read from the Faker en_US providers once, with Faker's own frequency weights.
+    """
+    if 'names' not in _demographic_values:
+        from faker.providers.person.en_US import Provider as PersonProvider
+        from faker.providers.address.en_US import Provider as AddressProvider
+        _demographic_values['names'] = {
+            'M': _weighted_values(PersonProvider.first_names_male),
+            'F': _weighted_values(PersonProvider.first_names_female),
+            'last': _weighted_values(PersonProvider.last_names),
+            'street_suffix': _weighted_values(AddressProvider.street_suffixes)}
+    return _demographic_values['names']
+
+
+def _digits(number, low=0, high=9):
+    """Draw a column of single digit strings"""
+    return random.choices([str(d) for d in range(low, high + 1)], k=number)
+
+
+def _random_ssns(number):
+    """
+    Draw a column of SSNs in the Faker en_US ranges: area 001-899 except 666, group 01-99, serial 0001-9999.
+    The few that validate_ssn() rejects for low entropy are drawn again.  Only SSNs of at most three distinct
+    digits can fall below its entropy limit, so only those are validated.
+    """
+    areas = random.choices(range(1, 899), k=number)
+    ssns = ['{0:03d}-{1:02d}-{2:04d}'.format(area if area < 666 else area + 1, group, serial)
+            for area, group, serial in zip(areas, random.choices(range(1, 100), k=number),
+                                           random.choices(range(1, 10000), k=number))]
+    for i, ssn in enumerate(ssns):
+        # The set includes the '-'
+        if len(set(ssn)) > 4:
+            continue
+        try:
+            validate_ssn(ssn)
+        except ValueError:
+            ssns[i] = _random_ssns(1)[0]
+    return ssns
+
+
+def _random_phones(number):
+    """Draw a column of phone numbers with the digit ranges used by random_phone()"""
+    columns = [_digits(number, 1, 9), _digits(number), _digits(number), _digits(number, 0, 8),
+               _digits(number, 0, 8), _digits(number, 0, 8), _digits(number), _digits(number), _digits(number),
+               _digits(number)]
+    return [''.join(digits) for digits in zip(*columns)]
+
+
+def _choose(values_weights, number):
+    values, weights = values_weights
+    return random.choices(values, weights=weights, k=number)
+
+
+def random_demographic_columns(number, potential_matches=None):
+    """
+    Draw 'number' random demographic records a column at a time.  Every column is sampled with one
+    random.choices() call over value lists that are loaded once per process (see demographic_values() and
+    top_zipcodes()), instead of calling the random_* helpers and building Faker instances per value.
+    :param number:
+        Number of records
+    :param potential_matches:
+        Size of the most populous zipcode list addresses are drawn from.  Defaults to the random_full_address() sizes.
+    :return:
+        Dict of {demographic key: list of 'number' values}, with the keys of random_demographics() dicts
+    """
+    if potential_matches is None:
+        potential_matches = 1000 if number < 10 else 5000
+    names = demographic_values()
+    columns = {}
+
+    sex = random.choices(['M', 'F'], k=number)
+    first_names = {key: _choose(names[key], number) for key in ('M', 'F')}
+    middle_names = {key: _choose(names[key], number) for key in ('M', 'F')}
+    columns['sex'] = sex
+    columns['first_name'] = [first_names[s][i] for i, s in enumerate(sex)]
+    columns['middle_name'] = [middle_names[s][i] for i, s in enumerate(sex)]
+    columns['last_name'] = _choose(names['last'], number)
+    suffixes = random.choices(["JR", "SR", "I", "II", "III", "IV"], k=number)
+    columns['suffix'] = [suffix if keep else None
+                         for suffix, keep in zip(suffixes, random.choices([False, True], weights=[9, 1], k=number))]
+
+    columns['ssn'] = _random_ssns(number)
+    for key in ('home_phone', 'mobile_phone', 'work_phone'):
+        columns[key] = _random_phones(number)
+
+    columns['username'] = ['{}.{}{}'.format(first, last, n) for first, last, n in
+                           zip(columns['first_name'], columns['last_name'], random.choices(range(0, 1001), k=number))]
+    columns['email'] = [username + '@EXAMPLE.COM' for username in columns['username']]
+    columns['password'] = random.choices(range(1, 100000000000), k=number)
+
+    today = datetime.today().date()
+    dob_range = range((today + relativedelta(years=-100)).toordinal(), (today + relativedelta(years=-18)).toordinal())
+    columns['dob'] = [date.fromordinal(ordinal) for ordinal in random.choices(dob_range, k=number)]
+    columns['multiple_birth'] = random.choices([False, True], weights=[99, 1], k=number)
+    columns['deceased'] = random.choices([False, True], weights=[99, 1], k=number)
+    columns['deceased_date'] = [random_death_date(dob) if deceased else None
+                                for dob, deceased in zip(columns['dob'], columns['deceased'])]
+    columns['marital_status'] = random.choices(['D', 'M', 'S', 'U', 'W'], k=number)
+    columns['preferred_language'] = random.choices(['en', 'es'], weights=[4, 1], k=number)
+    columns['race'] = random.choices(list(race_dict.keys()), k=number)
+    columns['ethnicity'] = random.choices(["2135-2", "2186-5"], k=number)
+
+    # Addresses: "<building number> <first or last name> <street suffix>", sometimes with a secondary line
+    zipcodes = random.choices(top_zipcodes(potential_matches), k=number)
+    street_names = [name if use_first else last for name, last, use_first in
+                    zip(_choose(names['F'], number), _choose(names['last'], number),
+                        random.choices([True, False], k=number))]
+    buildings = random.choices(range(100, 100000), k=number)
+    secondary = ['{} {}'.format(kind, n) for kind, n in zip(random.choices(['APT.', 'SUITE'], k=number),
+                                                           random.choices(range(100, 1000), k=number))]
+    line_kind = random.choices([1, 2, 3], weights=[50, 35, 15], k=number)
+    columns['address1'] = ['{} {} {}'.format(building, street, suffix) + (' ' + second if kind == 1 else '')
+                           for building, street, suffix, second, kind in
+                           zip(buildings, street_names, _choose(names['street_suffix'], number), secondary,
+                               line_kind)]
+    columns['address2'] = [second if kind == 3 else None for second, kind in zip(secondary, line_kind)]
+    columns['zipcode'] = [z.Zipcode for z in zipcodes]
+    columns['city'] = [str(z.City).upper() for z in zipcodes]
+    columns['state'] = [z.State for z in zipcodes]
+    columns['use'] = ['HOME'] * number
+    columns['end_date'] = [today] * number
+    columns['start_date'] = [today - timedelta(days=days) for days in random.choices(range(365, 3650), k=number)]
+    columns['country'] = ['USA'] * number
+    return columns
+
+
+def iter_random_demographics(number, chunk_size=10000):
+    """
+    Lazily yield 'number' random demographic dicts, drawing columns with random_demographic_columns() a chunk at a
+    time so memory use is bounded by chunk_size.
+    """
+    remaining = int(number)
+    while remaining > 0:
+        size = min(chunk_size, remaining)
+        columns = random_demographic_columns(size)
+        keys = list(columns.keys())
+        for values in zip(*(columns[key] for key in keys)):
+            yield dict(zip(keys, values))
+        remaining -= size
@@ -1,5 +1,7 @@
+from datetime import date, datetime, time
 from fhirclient.models import humanname, fhirdate
 from app.utils.type_validation import validate_datetime
+import isodate
 
 
 def fhir_gen_humanname(use='official', first_name=None, last_name=None, middle_name=None, suffix=None, prefix=None):
@@ -55,3 +57,94 @@ def fhir_gen_datetime(value=None, to_date=False, error_out=False):
         return fhir_date_obj
     fhir_date_obj.date = None
     return fhir_date_obj
+
+
+##################################################################################################
+# DIRECT FHIR JSON SERIALIZATION
+##################################################################################################
+
+def fhir_humanname_json(use='official', first_name=None, last_name=None, middle_name=None, suffix=None,
+                        prefix=None):
+    """
+    Build the FHIR HumanName JSON dict produced by fhir_gen_humanname(...).as_json(), without fhirclient objects.
+    Takes the same parameters as fhir_gen_humanname.
+    :return:
+        dict
+    """
+    hn = {}
+    if use:
+        hn['use'] = use
+    if last_name is not None:
+        hn['family'] = last_name
+    given_name = []
+    if first_name:
+        given_name.append(first_name)
+    if middle_name:
+        given_name.append(middle_name)
+    if given_name:
+        hn['given'] = given_name
+    if suffix:
+        hn['suffix'] = [suffix]
+    if prefix:
+        hn['prefix'] = [prefix]
+
+    hn['text'] = '{}{}{}{}'.format(last_name + ',' if last_name else '',
+                                   ' ' + first_name if first_name else '',
+                                   ' ' + middle_name if middle_name else '',
+                                   ' ' + suffix if suffix else '')
+    return hn
+
+
+def fhir_date_json(value=None, to_date=False):
+    """
+    Return the FHIR JSON date string produced by fhir_gen_datetime(value, to_date).as_json().  date and datetime
+    values are formatted directly instead of being converted to strings and parsed again.
+    :param value:
+        date, datetime or date string
+    :param to_date:
+        If true, output is a date.  If false, a datetime
+    :return:
+        ISO 8601 string or None if no date could be constructed
+    """
+    if isinstance(value, datetime):
+        if to_date:
+            return isodate.date_isoformat(value.date())
+        return isodate.datetime_isoformat(value)
+    if isinstance(value, date):
+        if to_date:
+            return isodate.date_isoformat(value)
+        return isodate.datetime_isoformat(datetime.combine(value, time()))
+    return fhir_gen_datetime(value=value, to_date=to_date).as_json()
+
+
+def fhir_period_date_json(value):
+    """Return the FHIR JSON string of a date or datetime assigned directly to fhirclient FHIRDate.date"""
+    if isinstance(value, datetime):
+        return isodate.datetime_isoformat(value)
+    return isodate.date_isoformat(value)
+
+
+def fhir_codeable_concept_json(system=None, code=None, text=None):
+    """
+    Build a FHIR CodeableConcept JSON dict with one Coding whose display is the concept text, the shape the
+    models build with fhirclient CodeableConcept and Coding objects
+    :param system:
+        Coding system url
+    :param code:
+        Coding code
+    :param text:
+        CodeableConcept text and Coding display, left out when None
+    :return:
+        dict
+    """
+    cc_coding = {}
+    if system is not None:
+        cc_coding['system'] = system
+    if code is not None:
+        cc_coding['code'] = code
+    if text is not None:
+        cc_coding['display'] = text
+    cc = {'coding': [cc_coding]}
+    if text is not None:
+        cc['text'] = text
+    return cc
@@ -1,7 +1,13 @@
 import os
+import shutil
 import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
 from config import config
 from random import randint
+from app.utils.bulk_import import PatientBulkLoader, iter_fhir_file
 
 config_object = config[os.getenv('FLASK_CONFIG') or 'default']
 
@@ -18,18 +24,143 @@ def get_total_weight(synthea_settings):
     return total_weight
 
 
+def synthea_slices(total_population, synthea_settings):
+    """Split a total population across the geography settings by weight into (state, city, population) slices"""
+    total_weight = get_total_weight(synthea_settings)
+    slices = []
+    for x in synthea_settings:
+        state, city, weight = x
+        slices.append((state, city, round((int(weight) / int(total_weight)) * total_population)))
+    return slices
+
+
+def synthea_command(command, state, city, population, output_dir=None):
+    """
+    Build the command line for one geography slice.
+    :param command:
+        List of the command and any leading arguments, e.g. [<synthea path>/run_synthea]
+    :param output_dir:
+        Optional base directory for the slice's exported files, passed as --exporter.baseDirectory
+    :return:
+        List of arguments for subprocess
+    """
+    cmd = list(command) + ['-p', str(population), '-s', str(randint(0, 99999))]
+    if output_dir:
+        cmd.extend(['--exporter.baseDirectory', output_dir])
+    cmd.append(state)
+    if city:
+        cmd.append(city)
+    return cmd
+
+
 def run_synthea(total_population, synthea_path=None, synthea_settings=None):
     if not synthea_path:
         synthea_path = config_object.SYNTHEA_SCRIPT_LOCATION
     if not synthea_settings:
         synthea_settings = config_object.SYNTHEA_GEOGRAPHY
-    total_weight = get_total_weight(synthea_settings)
-    for x in synthea_settings:
-        state, city, weight = x
-        city_population = round((int(weight) / int(total_weight)) * total_population)
-        cmd = [os.path.join(synthea_path, 'run_synthea'), '-p', str(city_population), '-s', str(randint(0, 99999)),
-               state]
-        if city:
-            cmd.append(city)
+    for state, city, population in synthea_slices(total_population, synthea_settings):
+        cmd = synthea_command([os.path.join(synthea_path, 'run_synthea')], state, city, population)
         subprocess.call(cmd, cwd=synthea_path)
     subprocess.call(['rm', '-r', os.path.join(synthea_path, 'output/cwd')])  # Get rid of cdw files
+
+
+##################################################################################################
+# PIPELINED GENERATION AND LOADING
+##################################################################################################
+
+def run_synthea_slice(cmd, cwd=None):
+    """Run one generator process.  Module level so it can be submitted to a process pool."""
+    return subprocess.call(cmd, cwd=cwd)
+
+
+def finished_bundles(directory, sizes, loaded, slice_done):
+    """
+    Return the new bundle files in a slice's fhir output directory that are complete: the slice has exited, or the
+    file size was unchanged since the previous poll.
+    :param sizes:
+        Dict of {path: size at the previous poll}, updated in place
+    :param loaded:
+        Set of the paths already loaded
+    """
+    fhir_dir = os.path.join(directory, 'fhir')
+    if not os.path.isdir(fhir_dir):
+        return []
+    ready = []
+    for name in sorted(os.listdir(fhir_dir)):
+        path = os.path.join(fhir_dir, name)
+        if not name.endswith('.json') or path in loaded:
+            continue
+        size = os.path.getsize(path)
+        if slice_done or sizes.get(path) == size:
+            ready.append(path)
+        sizes[path] = size
+    return ready
+
+
+def run_synthea_pipeline(total_population, synthea_path=None, synthea_settings=None, command=None, workers=None,
+                         batch_size=500, poll_interval=None, output_dir=None):
+    """
+    Generate synthetic patients and load them while generation continues.  Each geography slice runs in a process
+    pool worker and exports to its own directory.  The output directories are polled, and each finished bundle is
+    fed to a PatientBulkLoader, which inserts and commits a batch whenever batch_size patients are pending.
+    Must be called within an application context.
+    :param total_population:
+        Number of patients to generate across all slices
+    :param command:
+        Optional generator command as a list, defaults to [<synthea_path>/run_synthea].  Any script that accepts the
+        run_synthea arguments and writes bundles to <--exporter.baseDirectory>/fhir can stand in for Synthea.
+    :param workers:
+        Number of slices generated concurrently, defaults to SYNTHEA_WORKERS
+    :param output_dir:
+        Optional directory to generate into and keep.  By default a temporary directory is used and removed once
+        the bundles are loaded.
+    :return:
+        The PatientBulkLoader, with counts and throughput
+    """
+    synthea_path = synthea_path or current_app.config.get('SYNTHEA_SCRIPT_LOCATION')
+    synthea_settings = synthea_settings or current_app.config.get('SYNTHEA_GEOGRAPHY')
+    command = command or [os.path.join(synthea_path, 'run_synthea')]
+    workers = workers or current_app.config.get('SYNTHEA_WORKERS', 4)
+    poll_interval = poll_interval or current_app.config.get('SYNTHEA_POLL_INTERVAL', 1.0)
+
+    loader = PatientBulkLoader(batch_size=batch_size)
+    keep_output = output_dir is not None
+    output_dir = output_dir or tempfile.mkdtemp(prefix='synthea_')
+    sizes = {}
+    loaded = set()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for n, (state, city, population) in enumerate(synthea_slices(total_population, synthea_settings)):
+                slice_dir = os.path.join(output_dir, 'slice_{}'.format(n))
+                cmd = synthea_command(command, state, city, population, output_dir=slice_dir)
+                futures[slice_dir] = executor.submit(run_synthea_slice, cmd, cwd=synthea_path)
+            while True:
+                # Checked before the sweep so the last sweep sees every file of the finished slices
+                all_done = all(future.done() for future in futures.values())
+                for slice_dir, future in futures.items():
+                    slice_done = future.done()
+                    for path in finished_bundles(slice_dir, sizes, loaded, slice_done=slice_done):
+                        try:
+                            resources = list(iter_fhir_file(path))
+                        except ValueError as e:
+                            # A pause mid-write looks finished; retry until the slice exits
+                            if not slice_done:
+                                continue
+                            loader.errors.append('{}: {}'.format(path, e))
+                            resources = []
+                        for resource in resources:
+                            if resource.get('resourceType') == 'Patient':
+                                loader.add(resource)
+                        loaded.add(path)
+                if all_done:
+                    break
+                time.sleep(poll_interval)
+            loader.flush()
+            for slice_dir, future in futures.items():
+                if future.result() != 0:
+                    loader.errors.append('Generator exited with status {} for {}'.format(future.result(), slice_dir))
+    finally:
+        if not keep_output:
+            shutil.rmtree(output_dir, ignore_errors=True)
+    return loader
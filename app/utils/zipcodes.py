@@ -0,0 +1,129 @@
+import functools
+import sqlite3
+import threading
+from collections import namedtuple
+from uszipcode.data import DB_FILE, STATE_ABBR_SHORT_TO_LONG, STATE_ABBR_LONG_TO_SHORT
+from uszipcode.packages.fuzzywuzzy.process import extractOne
+
+# The uszipcode Zipcode attributes used by this app.  Attribute names match uszipcode so records can be used in its
+# place.
+ZipcodeRecord = namedtuple('ZipcodeRecord', ['Zipcode', 'City', 'State', 'Population'])
+
+
+class ZipcodeIndex(object):
+    """
+    Read-only, in-memory index of the uszipcode database.  The database is read once, with a single query, into
+    lookups of zipcode -> record, (city, state) -> records and state -> cities.  State and city names are matched
+    exactly first and then with the same fuzzy matching (confidence >= 70) as uszipcode.ZipcodeSearchEngine, so
+    lookups never open the database.  Fuzzy results are memoized in LRU caches of fuzzy_cache_size entries each,
+    bounded because the names come from client requests.
+    """
+
+    def __init__(self, db_file=DB_FILE, fuzzy_cache_size=1024):
+        connect = sqlite3.connect(db_file)
+        try:
+            rows = connect.execute('SELECT Zipcode, City, State, Population, ZipcodeType FROM zipcode '
+                                   'ORDER BY Zipcode').fetchall()
+        finally:
+            connect.close()
+
+        self.zipcodes = {}
+        self.city_state_zipcodes = {}
+        self.state_cities = {}
+        # ZipcodeSearchEngine searches return Standard zipcodes only, but match city names against every zipcode
+        for zipcode, city, state, population, zipcode_type in rows:
+            self.state_cities.setdefault(state, set()).add(city)
+            if zipcode_type != 'Standard':
+                continue
+            record = ZipcodeRecord(zipcode, city, state, population)
+            self.zipcodes[zipcode] = record
+            self.city_state_zipcodes.setdefault((city.upper(), state), []).append(record)
+        self.state_cities = {state: sorted(cities) for state, cities in self.state_cities.items()}
+        self.state_names = list(STATE_ABBR_LONG_TO_SHORT)
+        self._match_state = functools.lru_cache(maxsize=fuzzy_cache_size)(self._match_state)
+        self._match_city = functools.lru_cache(maxsize=fuzzy_cache_size)(self._match_city)
+        self._by_population = None
+
+    def zipcode(self, zipcode):
+        """Return the record of a standard zipcode, or None"""
+        if zipcode is None:
+            return None
+        return self.zipcodes.get(str(zipcode).strip()[:5].zfill(5))
+
+    def state(self, state):
+        """
+        Return the two character abbreviation of a state abbreviation or name
+        :raises ValueError:
+            If no state matches
+        """
+        if not isinstance(state, str):
+            raise ValueError('Could not find a valid US state with the given input: {}'.format(state))
+        abbreviation = state.strip().upper()
+        if abbreviation in STATE_ABBR_SHORT_TO_LONG:
+            return abbreviation
+        match = self._match_state(state.strip().lower())
+        if match is None:
+            raise ValueError('Could not find a valid US state with the given input: {}'.format(state))
+        return match
+
+    def _match_state(self, name):
+        """Return the abbreviation of the state whose lower case name matches name, or None"""
+        if name in STATE_ABBR_LONG_TO_SHORT:
+            return STATE_ABBR_LONG_TO_SHORT[name]
+        if name:
+            choice, confidence = extractOne(name, self.state_names)
+            if confidence >= 70:
+                return STATE_ABBR_LONG_TO_SHORT[choice]
+        return None
+
+    def city(self, city, state):
+        """
+        Return the city name, as spelled in the database, that best matches a city in a state
+        :raises ValueError:
+            If the state or city does not match
+        """
+        state = self.state(state)
+        match = self._match_city(str(city).strip().upper(), state)
+        if match is None:
+            raise ValueError('{} is not a valid city name in {}'.format(city, state))
+        return match
+
+    def _match_city(self, city, state):
+        """Return the database spelling of the city in a state abbreviation matching the upper case city, or None"""
+        if (city, state) in self.city_state_zipcodes:
+            return self.city_state_zipcodes[(city, state)][0].City
+        cities = self.state_cities.get(state, [])
+        if cities and city:
+            choice, confidence = extractOne(city.lower(), cities)
+            if confidence >= 70:
+                return choice
+        return None
+
+    def city_state(self, city, state):
+        """
+        Return the standard zipcode records of a city and state, ordered by zipcode
+        :raises ValueError:
+            If the state or city does not match
+        """
+        matched_city = self.city(city, state)
+        return self.city_state_zipcodes.get((matched_city.upper(), self.state(state)), [])
+
+    def by_population(self, number):
+        """Return the 'number' most populous standard zipcodes"""
+        if self._by_population is None:
+            self._by_population = sorted(self.zipcodes.values(), key=lambda r: r.Population or 0, reverse=True)
+        return self._by_population[:number]
+
+
+_zipcode_index = None
+_zipcode_index_lock = threading.Lock()
+
+
+def zipcode_index():
+    """Return the process-wide ZipcodeIndex, loading it on first use"""
+    global _zipcode_index
+    if _zipcode_index is None:
+        with _zipcode_index_lock:
+            if _zipcode_index is None:
+                _zipcode_index = ZipcodeIndex()
+    return _zipcode_index
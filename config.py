@@ -29,6 +29,33 @@ class Config:
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
     BROKER_TRANSPORT = 'redis',
 
+    # Seconds between checks of ValueSet / CodeSystem data hashes by the in-process terminology cache
+    TERMINOLOGY_CACHE_TTL = 300
+
+    # Serialized FHIR resource cache: in-process LRU size, optional sharing through Redis and the Redis expiry
+    RESOURCE_CACHE_SIZE = 1024
+    RESOURCE_CACHE_REDIS = os.environ.get('RESOURCE_CACHE_REDIS', 'false').lower() == 'true'
+    RESOURCE_CACHE_TTL = 3600
+
+    # Patient narratives: in-process cache size and whether the precomputed narrative column is refreshed on commit
+    NARRATIVE_CACHE_SIZE = 4096
+    FHIR_NARRATIVE_ON_WRITE = True
+
+    # Searchset bundles with a _count above the threshold are streamed, reading rows from the cursor in batches
+    BUNDLE_STREAM_THRESHOLD = 100
+    BUNDLE_STREAM_BATCH_SIZE = 100
+
+    # Bulk data $export: output directory, parallel id range workers, rows per read and NDJSON file size limit
+    EXPORT_DIR = os.environ.get('EXPORT_DIR') or os.path.join(basedir, 'exports')
+    EXPORT_WORKERS = 4
+    EXPORT_BATCH_SIZE = 500
+    EXPORT_FILE_MAX_BYTES = 50 * 1024 * 1024
+    EXPORT_RETRY_AFTER = 10
+    # Seconds without progress after which a running export is considered lost, e.g. to a restart
+    EXPORT_STALE_AFTER = 600
+    # Bulk data $import / flask import-fhir: patients per multi-row INSERT and commit
+    IMPORT_BATCH_SIZE = 500
+
     CODESYSTEM_IMPORT = {'organization-type': 'http://hl7.org/fhir/organization-type',
                          'name-use': 'http://hl7.org/fhir/name-use'}
 
@@ -89,6 +116,9 @@ class DevelopmentConfig(Config):
         , ('Wisconsin', 'Waunakee', 9)
         , ('Wisconsin', 'Verona', 7)
     ]
+    # Geography slices generated concurrently by `flask synthea` and seconds between checks for finished bundles
+    SYNTHEA_WORKERS = 4
+    SYNTHEA_POLL_INTERVAL = 1.0
     SERVER_NAME = '127.0.0.1:5000'
 
 
@@ -0,0 +1,126 @@
+"""flattened concept index
+
+Revision ID: 9c1d7e2a4b60
+Revises: 43b2beea5ab3
+Create Date: 2026-10-18 10:12:41.318211
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '9c1d7e2a4b60'
+down_revision = '43b2beea5ab3'
+branch_labels = None
+depends_on = None
+
+
+def iter_concepts(data):
+    """
+    Walk the nested concept tree of CodeSystem JSON breadth-first, as CodeSystem.iter_concepts does.
+    :return:
+        Generator of (code, display, parent_code) tuples
+    """
+    concepts = [(concept, None) for concept in (data or {}).get('concept') or []]
+    while concepts:
+        nested_concepts = []
+        for concept, parent_code in concepts:
+            yield concept.get('code'), concept.get('display'), parent_code
+            nested_concepts.extend((x, concept.get('code')) for x in concept.get('concept') or [])
+        concepts = nested_concepts
+
+
+def backfill_concepts():
+    """
+    Index the CodeSystems and ValueSets already stored, in id order, the same way CodeSystem.index_concepts and
+    ValueSet.index_concepts do on write.  Without it code lookups would return nothing for existing terminology until
+    the index_concepts command is run.
+    """
+    bind = op.get_bind()
+    codesystem = sa.table('codesystem', sa.column('id', sa.Integer), sa.column('url', sa.Text),
+                          sa.column('data', postgresql.JSONB))
+    valueset = sa.table('valueset', sa.column('id', sa.Integer), sa.column('url', sa.Text),
+                        sa.column('data', postgresql.JSONB))
+    concept = sa.table('concept', sa.column('id', sa.Integer), sa.column('system', sa.Text),
+                       sa.column('code', sa.Text), sa.column('display', sa.Text), sa.column('parent_code', sa.Text),
+                       sa.column('codesystem_id', sa.Integer))
+    valueset_concept = sa.table('valueset_concept', sa.column('valueset_id', sa.Integer),
+                                sa.column('concept_id', sa.Integer), sa.column('display', sa.Text))
+
+    for cs_id, url, data in bind.execute(sa.select([codesystem.c.id, codesystem.c.url, codesystem.c.data])
+                                         .order_by(codesystem.c.id)).fetchall():
+        rows = {}
+        for code, display, parent_code in iter_concepts(data):
+            if code and code not in rows:
+                rows[code] = dict(system=url, code=code, display=display, parent_code=parent_code,
+                                  codesystem_id=cs_id)
+        if url and rows:
+            stmt = postgresql.insert(concept).values(list(rows.values()))
+            stmt = stmt.on_conflict_do_update(constraint='uq_concept_system_code',
+                                              set_=dict(display=stmt.excluded.display,
+                                                        parent_code=stmt.excluded.parent_code,
+                                                        codesystem_id=stmt.excluded.codesystem_id))
+            bind.execute(stmt)
+
+    for vs_id, data in bind.execute(sa.select([valueset.c.id, valueset.c.data])
+                                    .order_by(valueset.c.id)).fetchall():
+        for inc in ((data or {}).get('compose') or {}).get('include') or []:
+            system = inc.get('system')
+            # ValueSet references are not indexed, see ValueSet.index_concepts
+            if not system or inc.get('valueSet'):
+                continue
+            if inc.get('concept'):
+                inline = {}
+                for c in inc.get('concept'):
+                    if c.get('code'):
+                        inline.setdefault(c.get('code'), c.get('display'))
+                if not inline:
+                    continue
+                bind.execute(postgresql.insert(concept).values(
+                    [dict(system=system, code=code, display=display) for code, display in inline.items()])
+                             .on_conflict_do_nothing(constraint='uq_concept_system_code'))
+                q = sa.select([concept.c.id, concept.c.code]).where(
+                    sa.and_(concept.c.system == system, concept.c.code.in_(list(inline))))
+                members = [dict(valueset_id=vs_id, concept_id=concept_id, display=inline.get(code))
+                           for concept_id, code in bind.execute(q)]
+                if members:
+                    bind.execute(postgresql.insert(valueset_concept).values(members).on_conflict_do_nothing())
+            else:
+                members = sa.select([sa.literal(vs_id, type_=sa.Integer), concept.c.id]) \
+                    .where(concept.c.system == system)
+                bind.execute(postgresql.insert(valueset_concept)
+                             .from_select(['valueset_id', 'concept_id'], members)
+                             .on_conflict_do_nothing())
+
+
+def upgrade():
+    op.create_table('concept',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('system', sa.Text(), nullable=False),
+                    sa.Column('code', sa.Text(), nullable=False),
+                    sa.Column('display', sa.Text(), nullable=True),
+                    sa.Column('parent_code', sa.Text(), nullable=True),
+                    sa.Column('codesystem_id', sa.Integer(), nullable=True),
+                    sa.ForeignKeyConstraint(['codesystem_id'], ['codesystem.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('system', 'code', name='uq_concept_system_code')
+                    )
+    op.create_index(op.f('ix_concept_codesystem_id'), 'concept', ['codesystem_id'], unique=False)
+    op.create_table('valueset_concept',
+                    sa.Column('valueset_id', sa.Integer(), nullable=False),
+                    sa.Column('concept_id', sa.Integer(), nullable=False),
+                    sa.Column('display', sa.Text(), nullable=True),
+                    sa.ForeignKeyConstraint(['concept_id'], ['concept.id'], ondelete='CASCADE'),
+                    sa.ForeignKeyConstraint(['valueset_id'], ['valueset.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('valueset_id', 'concept_id')
+                    )
+    op.create_index(op.f('ix_valueset_concept_concept_id'), 'valueset_concept', ['concept_id'], unique=False)
+    backfill_concepts()
+
+
+def downgrade():
+    op.drop_index(op.f('ix_valueset_concept_concept_id'), table_name='valueset_concept')
+    op.drop_table('valueset_concept')
+    op.drop_index(op.f('ix_concept_codesystem_id'), table_name='concept')
+    op.drop_table('concept')
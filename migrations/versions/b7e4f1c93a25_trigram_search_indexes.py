@@ -0,0 +1,43 @@
+"""trigram search indexes
+
+Revision ID: b7e4f1c93a25
+Revises: 9c1d7e2a4b60
+Create Date: 2026-10-18 11:02:17.540932
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'b7e4f1c93a25'
+down_revision = '9c1d7e2a4b60'
+branch_labels = None
+depends_on = None
+
+# (table, column) pairs searched with case and accent insensitive LIKE
+trigram_columns = [('patient', 'first_name'),
+                   ('patient', 'middle_name'),
+                   ('patient', 'last_name'),
+                   ('address', 'address1'),
+                   ('address', 'address2'),
+                   ('address', 'city'),
+                   ('address', 'zipcode'),
+                   ('email_address', 'email'),
+                   ('phone_number', 'number')]
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.execute('CREATE EXTENSION IF NOT EXISTS unaccent')
+    op.execute("CREATE OR REPLACE FUNCTION fhir_search_fold(text) RETURNS text AS "
+               "$$ SELECT lower(public.unaccent('public.unaccent', $1)) $$ "
+               "LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE")
+    for table, column in trigram_columns:
+        op.execute('CREATE INDEX ix_{0}_{1}_trgm ON {0} USING gin (fhir_search_fold({1}) gin_trgm_ops)'
+                   .format(table, column))
+
+
+def downgrade():
+    for table, column in trigram_columns:
+        op.execute('DROP INDEX IF EXISTS ix_{}_{}_trgm'.format(table, column))
+    op.execute('DROP FUNCTION IF EXISTS fhir_search_fold(text)')
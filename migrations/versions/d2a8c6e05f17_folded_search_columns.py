@@ -0,0 +1,104 @@
+"""folded search columns
+
+Revision ID: d2a8c6e05f17
+Revises: b7e4f1c93a25
+Create Date: 2026-10-18 11:48:03.207115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from app.models.extensions import fold_search_text
+
+# revision identifiers, used by Alembic.
+revision = 'd2a8c6e05f17'
+down_revision = 'b7e4f1c93a25'
+branch_labels = None
+depends_on = None
+
+# Source columns that get a folded <column>_search copy, by table
+search_columns = {'patient': ['first_name', 'last_name', 'middle_name', 'prefix', 'suffix', 'sex',
+                              'preferred_language'],
+                  'address': ['address1', 'address2', 'city', 'state', 'zipcode', 'country'],
+                  'email_address': ['email'],
+                  'phone_number': ['number']}
+
+# Search columns with prefix (text_pattern_ops) and trigram (gin_trgm_ops) indexes
+indexed_columns = [('patient', 'first_name_search'),
+                   ('patient', 'middle_name_search'),
+                   ('patient', 'last_name_search'),
+                   ('address', 'address1_search'),
+                   ('address', 'address2_search'),
+                   ('address', 'city_search'),
+                   ('address', 'zipcode_search'),
+                   ('email_address', 'email_search'),
+                   ('phone_number', 'number_search')]
+
+# Expression indexes from the previous revision, replaced by indexes on the search columns
+expression_indexes = [('patient', 'first_name'),
+                      ('patient', 'middle_name'),
+                      ('patient', 'last_name'),
+                      ('address', 'address1'),
+                      ('address', 'address2'),
+                      ('address', 'city'),
+                      ('address', 'zipcode'),
+                      ('email_address', 'email'),
+                      ('phone_number', 'number')]
+
+
+def backfill_search_columns(table, columns, batch_size=1000):
+    """
+    Fill the search columns of existing rows with fold_search_text, the fold the models apply on write, in id
+    ordered batches.  PostgreSQL's unaccent is not used because it leaves characters such as ß, Ø and Đ that
+    unidecode transliterates, so searches would match differently depending on when a row was written.
+    """
+    bind = op.get_bind()
+    t = sa.table(table, sa.column('id', sa.Integer),
+                 *[sa.column(name, sa.Text) for column in columns for name in [column, '{}_search'.format(column)]])
+    update = t.update().where(t.c.id == sa.bindparam('b_id')).values(
+        {'{}_search'.format(column): sa.bindparam('b_{}'.format(column)) for column in columns})
+    last_id = 0
+    while True:
+        rows = bind.execute(sa.select([t.c.id] + [t.c[column] for column in columns])
+                            .where(t.c.id > last_id).order_by(t.c.id).limit(batch_size)).fetchall()
+        if not rows:
+            break
+        params = []
+        for row in rows:
+            values = {'b_{}'.format(column): fold_search_text(row[column]) for column in columns}
+            values['b_id'] = row['id']
+            params.append(values)
+        bind.execute(update, params)
+        last_id = rows[-1]['id']
+
+
+def upgrade():
+    for table, columns in search_columns.items():
+        for column in columns:
+            op.add_column(table, sa.Column('{}_search'.format(column), sa.Text(), nullable=True))
+        # Backfill existing rows.  New and updated rows are folded by the model before_insert / before_update hooks
+        backfill_search_columns(table=table, columns=columns)
+
+    for table, column in expression_indexes:
+        op.execute('DROP INDEX IF EXISTS ix_{}_{}_trgm'.format(table, column))
+    op.execute('DROP FUNCTION IF EXISTS fhir_search_fold(text)')
+
+    for table, column in indexed_columns:
+        op.execute('CREATE INDEX ix_{0}_{1}_pattern ON {0} ({1} text_pattern_ops)'.format(table, column))
+        op.execute('CREATE INDEX ix_{0}_{1}_trgm ON {0} USING gin ({1} gin_trgm_ops)'.format(table, column))
+
+
+def downgrade():
+    for table, column in indexed_columns:
+        op.execute('DROP INDEX IF EXISTS ix_{}_{}_trgm'.format(table, column))
+        op.execute('DROP INDEX IF EXISTS ix_{}_{}_pattern'.format(table, column))
+
+    op.execute("CREATE OR REPLACE FUNCTION fhir_search_fold(text) RETURNS text AS "
+               "$$ SELECT lower(public.unaccent('public.unaccent', $1)) $$ "
+               "LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE")
+    for table, column in expression_indexes:
+        op.execute('CREATE INDEX ix_{0}_{1}_trgm ON {0} USING gin (fhir_search_fold({1}) gin_trgm_ops)'
+                   .format(table, column))
+
+    for table, columns in search_columns.items():
+        for column in columns:
+            op.drop_column(table, '{}_search'.format(column))
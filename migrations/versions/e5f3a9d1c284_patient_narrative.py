@@ -0,0 +1,27 @@
+"""patient narrative
+
+Revision ID: e5f3a9d1c284
+Revises: d2a8c6e05f17
+Create Date: 2026-10-18 14:02:37.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'e5f3a9d1c284'
+down_revision = 'd2a8c6e05f17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Precomputed narratives are filled in on write or with `flask patient_narratives`.
+    # Not versioned, so patient_version is unchanged.
+    op.add_column('patient', sa.Column('narrative', sa.Text(), nullable=True))
+    op.add_column('patient', sa.Column('narrative_hash', sa.Text(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('patient', 'narrative_hash')
+    op.drop_column('patient', 'narrative')
@@ -0,0 +1,46 @@
+"""bulk export job
+
+Revision ID: f1b7c2d84e60
+Revises: e5f3a9d1c284
+Create Date: 2026-10-18 16:21:09.740113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'f1b7c2d84e60'
+down_revision = 'e5f3a9d1c284'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('bulk_export_job',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('uuid', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('status', sa.Text(), nullable=False),
+    sa.Column('request_url', sa.Text(), nullable=True),
+    sa.Column('base_url', sa.Text(), nullable=True),
+    sa.Column('resource_types', postgresql.ARRAY(sa.Text()), nullable=True),
+    sa.Column('since', sa.DateTime(), nullable=True),
+    sa.Column('output', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('transaction_time', sa.DateTime(), nullable=True),
+    sa.Column('completed_at', sa.DateTime(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('uuid')
+    )
+    op.create_index(op.f('ix_bulk_export_job_status'), 'bulk_export_job', ['status'], unique=False)
+    op.create_index(op.f('ix_bulk_export_job_user_id'), 'bulk_export_job', ['user_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_bulk_export_job_user_id'), table_name='bulk_export_job')
+    op.drop_index(op.f('ix_bulk_export_job_status'), table_name='bulk_export_job')
+    op.drop_table('bulk_export_job')
@@ -1 +1,3 @@
-from . import test_basics, utils, test_model_user
+from . import test_basics, utils, test_model_user, test_model_patient, test_model_codesets, \
+    test_bundle_pagination, test_search, test_resource_cache, test_bulk_export, \
+    test_bulk_import, test_synthea_pipeline, test_zipcodes, test_demographics
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""
+Stand-in for Synthea's run_synthea script used by the pipeline tests.  Accepts the same arguments
+(-p population, -s seed, --exporter.baseDirectory dir, state [city]) and writes one small Patient bundle per
+person to <baseDirectory>/fhir.
+"""
+import json, os, random, sys, time, uuid
+
+
+def main(args):
+    population, seed, base_dir, positional = 1, 0, 'output', []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == '-p':
+            population = int(args.pop(0))
+        elif arg == '-s':
+            seed = int(args.pop(0))
+        elif arg == '--exporter.baseDirectory':
+            base_dir = args.pop(0)
+        else:
+            positional.append(arg)
+    state = positional[0]
+    city = positional[1] if len(positional) > 1 else 'Springfield'
+    rng = random.Random(seed)
+    fhir_dir = os.path.join(base_dir, 'fhir')
+    os.makedirs(fhir_dir, exist_ok=True)
+    for n in range(population):
+        patient_id = str(uuid.uuid4())
+        patient = {'resourceType': 'Patient', 'id': patient_id,
+                   'name': [{'use': 'official', 'family': 'Stub', 'given': ['Person{}'.format(n)]}],
+                   'gender': rng.choice(['male', 'female']),
+                   'birthDate': '19{}-0{}-1{}'.format(rng.randint(10, 99), rng.randint(1, 9), rng.randint(0, 9)),
+                   'address': [{'line': ['{} Main St'.format(rng.randint(1, 999))], 'city': city, 'state': state}]}
+        bundle = {'resourceType': 'Bundle', 'type': 'collection',
+                  'entry': [{'fullUrl': 'urn:uuid:{}'.format(patient_id), 'resource': patient}]}
+        with open(os.path.join(fhir_dir, 'Stub_{}.json'.format(patient_id)), 'w') as f:
+            json.dump(bundle, f)
+        time.sleep(0.05)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
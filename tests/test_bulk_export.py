@@ -0,0 +1,83 @@
+import json, os, shutil, tempfile
+from datetime import datetime, timedelta
+from flask import g
+from werkzeug.exceptions import NotFound
+from tests.utils import BaseClientTestCase
+from app.api_v1.views.BulkData import get_export_job
+from app.utils.bulk_export import run_export_job, id_ranges, fail_stale_export_jobs
+from app.models.bulk_export import BulkExportJob
+from app.models.fhir.patient import Patient
+from app.extensions import db
+
+
+class BulkExportTestCase(BaseClientTestCase):
+
+    def setUp(self):
+        super(BulkExportTestCase, self).setUp()
+        self.export_dir = tempfile.mkdtemp()
+        self.app.config['EXPORT_DIR'] = self.export_dir
+        self.app.config['EXPORT_BATCH_SIZE'] = 2
+        for x in range(7):
+            Patient.create_random_patient()
+        db.session.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.export_dir, ignore_errors=True)
+        super(BulkExportTestCase, self).tearDown()
+
+    def test_id_ranges_cover_all_ids(self):
+        ids = [pt.id for pt in Patient.query]
+        ranges = id_ranges(model=Patient, parts=3)
+        self.assertEqual(len(ranges), 3)
+        self.assertEqual(ranges[0][0], min(ids))
+        self.assertEqual(ranges[-1][1], max(ids) + 1)
+        for (start, end), (next_start, next_end) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, next_start)
+
+    def test_export_writes_ndjson(self):
+        job = BulkExportJob(resource_types=['Patient'], base_url='http://localhost/')
+        db.session.add(job)
+        db.session.commit()
+        run_export_job(app=self.app, job_id=job.id)
+
+        job = BulkExportJob.query.get(job.id)
+        self.assertEqual(job.status, 'completed')
+        self.assertIsNotNone(job.completed_at)
+        self.assertEqual(sum(o['count'] for o in job.output), 7)
+
+        ids = []
+        for o in job.output:
+            with open(os.path.join(self.export_dir, str(job.uuid), o['file'])) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(len(lines), o['count'])
+            ids.extend(json.loads(line)['id'] for line in lines)
+        self.assertEqual(len(set(ids)), 7)
+
+    def test_stale_jobs_are_failed(self):
+        stale = BulkExportJob(resource_types=['Patient'], base_url='http://localhost/', status='in-progress')
+        running = BulkExportJob(resource_types=['Patient'], base_url='http://localhost/', status='in-progress')
+        db.session.add_all([stale, running])
+        db.session.commit()
+        table = BulkExportJob.__table__
+        db.session.execute(table.update().where(table.c.id == stale.id)
+                           .values(updated_at=datetime.utcnow() - timedelta(hours=1)))
+        db.session.commit()
+
+        self.assertEqual(fail_stale_export_jobs(self.app), 1)
+        self.assertEqual(BulkExportJob.query.get(stale.id).status, 'error')
+        self.assertEqual(BulkExportJob.query.get(running.id).status, 'in-progress')
+
+    def test_deleted_job_is_not_found(self):
+        self.create_test_user()
+        user = self.get_test_user()
+        job = BulkExportJob(resource_types=['Patient'], base_url='http://localhost/', user_id=user.id,
+                            status='deleted')
+        db.session.add(job)
+        db.session.commit()
+        with self.app.test_request_context():
+            g.current_user = user
+            with self.assertRaises(NotFound):
+                get_export_job(job.uuid)
+        # An export deleted before its thread ran is not started
+        run_export_job(app=self.app, job_id=job.id)
+        self.assertEqual(BulkExportJob.query.get(job.id).status, 'deleted')
@@ -0,0 +1,114 @@
+import json, os, shutil, tempfile
+from sqlalchemy_continuum import version_class
+from tests.utils import BaseClientTestCase
+from app.utils.bulk_import import PatientBulkLoader, iter_fhir_file, iter_fhir_ndjson, patient_from_fhir, \
+    bulk_create_random_patients, SeedLoader
+from app.models.fhir.patient import Patient
+from app.models.fhir.address import Address
+from app.extensions import db
+
+seed_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'seed', 'patients', 'fhir',
+                         'Adrian_Friesen_280855a0-ba4e-40a6-8e6a-a997ad79cdb7.json')
+demographic_seed_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                     'demographic_seed.txt')
+
+
+class BulkImportTestCase(BaseClientTestCase):
+
+    def synthea_patient(self):
+        return next(r for r in iter_fhir_file(seed_file) if r['resourceType'] == 'Patient')
+
+    def test_patient_from_fhir(self):
+        pt, addresses, phone_numbers, email_addresses = patient_from_fhir(self.synthea_patient())
+        self.assertEqual(str(pt.uuid), '375f4c0c-b029-48ca-abe7-0e721a470c2f')
+        self.assertEqual((pt.first_name, pt.last_name, pt.sex), ('Adrian', 'Friesen', 'M'))
+        self.assertEqual(str(pt.dob), '2002-07-27')
+        self.assertEqual(pt.race, '2106-3')
+        self.assertEqual(pt.ethnicity, '2186-5')
+        self.assertEqual(pt.marital_status, 'S')
+        self.assertEqual(len(addresses), 1)
+        self.assertEqual(addresses[0].zipcode, '53590')
+        self.assertTrue(addresses[0].primary)
+        self.assertEqual(phone_numbers[0].number, '5552341446')
+        self.assertEqual(phone_numbers[0].type, 'HOME')
+        self.assertEqual(email_addresses, [])
+
+    def test_bundle_import(self):
+        loader = PatientBulkLoader(batch_size=10).load(iter_fhir_file(seed_file))
+        self.assertEqual(loader.loaded, 1)
+        self.assertEqual(loader.errors, [])
+        pt = Patient.query.filter(Patient.last_name == 'Friesen').one()
+        self.assertEqual(pt.last_name_search, 'FRIESEN')
+        self.assertIsNotNone(pt.row_hash)
+        self.assertEqual(pt.version_number, 1)
+        self.assertEqual(Address.query.filter(Address.patient_id == pt.id).count(), 1)
+        self.assertEqual(db.session.query(version_class(Address)).filter(
+            version_class(Address).patient_id == pt.id).count(), 1)
+        self.assertIsNotNone(Patient.get_fhir_version_metadata(pt.id)['transaction_id'])
+
+        # Patients already loaded are skipped
+        loader = PatientBulkLoader().load(iter_fhir_file(seed_file))
+        self.assertEqual(loader.loaded, 0)
+        self.assertEqual(Patient.query.filter(Patient.last_name == 'Friesen').count(), 1)
+
+    def test_ndjson_import_batches(self):
+        resource = self.synthea_patient()
+        lines = []
+        for x in range(5):
+            resource = dict(resource, id='00000000-0000-0000-0000-00000000000{}'.format(x))
+            lines.append(json.dumps(resource) + '\n')
+        lines.append('\n')
+        loader = PatientBulkLoader(batch_size=2).load(iter_fhir_ndjson(lines))
+        self.assertEqual(loader.loaded, 5)
+        self.assertEqual(Patient.query.count(), 5)
+        self.assertEqual(len({pt.id for pt in Patient.query}), 5)
+
+    def test_bulk_create_random_patients(self):
+        progress = []
+        created, rows = bulk_create_random_patients(number=5, chunk_size=2,
+                                                    progress=lambda n, r: progress.append(n))
+        self.assertEqual(created, 5)
+        self.assertEqual(progress, [2, 4, 5])
+        self.assertEqual(Patient.query.count(), 5)
+        # Each patient has an address, three phone numbers and an email address
+        self.assertEqual(rows, 5 * 6)
+        pt = Patient.query.first()
+        self.assertEqual(pt.version_number, 1)
+        self.assertEqual(pt.phone_numbers.filter_by(primary=True).count(), 1)
+        self.assertIsNotNone(pt.email)
+
+    def test_load_seed(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'seed.txt')
+        with open(demographic_seed_file, encoding='utf-8') as f:
+            lines = [next(f) for x in range(6)]
+        # An invalid dob and an unknown state are rejected
+        bad_dob = lines[1].split('|')
+        bad_dob[6] = '2999-01-01'
+        bad_state = lines[2].split('|')
+        bad_state[18], bad_state[19] = 'ZZ', ''
+        with open(path, 'w', encoding='utf-8') as f:
+            f.writelines(lines + ['|'.join(bad_dob), '|'.join(bad_state)])
+
+        rejects = os.path.join(directory, 'rejects.txt')
+        loader = SeedLoader(batch_size=2, workers=1, rejects_path=rejects).load(path)
+        self.assertEqual((loader.rows, loader.loaded, loader.rejected), (7, 5, 2))
+        self.assertEqual(Patient.query.count(), 5)
+        pt = Patient.query.filter(Patient.first_name == 'SHERI').one()
+        self.assertEqual(str(pt.dob), '1918-07-03')
+        self.assertEqual(pt.version_number, 1)
+        self.assertEqual(pt.addresses.one().zipcode, '77088')
+        self.assertEqual(pt.phone_numbers.count(), 3)
+        with open(rejects, encoding='utf-8') as f:
+            reject_lines = f.read().splitlines()
+        self.assertEqual(len(reject_lines), 3)
+        self.assertTrue(reject_lines[0].startswith('line|first_name|'))
+        self.assertTrue(reject_lines[1].startswith('7|'))
+        self.assertIn('dob:', reject_lines[1])
+        self.assertIn('address:', reject_lines[2])
+
+        # Patients already loaded are skipped
+        loader = SeedLoader(workers=1).load(path)
+        self.assertEqual((loader.loaded, loader.skipped, loader.rejected), (0, 5, 2))
+        self.assertEqual(Patient.query.count(), 5)
@@ -0,0 +1,157 @@
+import json
+from flask import request
+from tests.utils import BaseClientTestCase
+from app.api_v1.utils.bundle import keyset_paginate_query, paginate_query, create_bundle, estimate_query_count, \
+    bundle_should_stream, stream_bundle, keyset_supported
+from app.api_v1.utils.search import parse_fhir_search
+from app.api_v1.views.Patient import patient_search_registry
+from app.api_v1.errors.exceptions import ValidationError
+from app.models.fhir.patient import Patient
+from app.extensions import db
+
+
+class KeysetPaginationTestCase(BaseClientTestCase):
+
+    def setUp(self):
+        super(KeysetPaginationTestCase, self).setUp()
+        for x in range(7):
+            Patient.create_random_patient()
+        db.session.commit()
+
+    def walk_pages(self, query_string):
+        ids = []
+        token = None
+        while True:
+            qs = query_string + ('&_page_token={}'.format(token) if token else '')
+            with self.app.test_request_context('/?' + qs):
+                sort = parse_fhir_search(args=request.args, base=Patient, model_support={}).get('_sort')
+                page, per_page = keyset_paginate_query(query=Patient.query, base=Patient, sort=sort)
+            self.assertLessEqual(len(page.items), per_page)
+            ids.extend(pt.id for pt in page.items)
+            if not page.has_next:
+                return ids
+            token = page.next_token
+
+    def test_keyset_pages_by_id(self):
+        expected = [pt.id for pt in Patient.query.order_by(Patient.id)]
+        self.assertEqual(self.walk_pages('_count=3'), expected)
+
+    def test_keyset_pages_with_descending_sort(self):
+        expected = [pt.id for pt in Patient.query.order_by(Patient.updated_at.desc().nullsfirst(),
+                                                            Patient.id.desc())]
+        self.assertEqual(self.walk_pages('_count=2&_sort=-_lastUpdated'), expected)
+
+    def test_registry_sort_uses_keyset_pagination(self):
+        expected = [pt.id for pt in Patient.query.order_by(Patient.dob.asc().nullslast(), Patient.id)]
+        ids = []
+        token = None
+        while True:
+            qs = '/api/v1/fhir/Patient?_count=3&_sort=birthdate' + ('&_page_token={}'.format(token) if token else '')
+            with self.app.test_request_context(qs):
+                query, spec = patient_search_registry.search(args=request.args)
+                self.assertTrue(keyset_supported(base=Patient, sort=spec['_sort']))
+                page, per_page = keyset_paginate_query(query=query, base=Patient, sort=spec['_sort'])
+                links = {link.relation: link.url for link in
+                         create_bundle(query=query, base=Patient, sort=spec['_sort']).link}
+            self.assertNotIn('last', links)
+            ids.extend(pt.id for pt in page.items)
+            if not page.has_next:
+                break
+            self.assertIn('_page_token=', links['next'])
+            token = page.next_token
+        self.assertEqual(ids, expected)
+
+    def test_invalid_count(self):
+        for count in ['0', '-3']:
+            with self.app.test_request_context('/api/v1/fhir/Patient?_count={}'.format(count)):
+                with self.assertRaises(ValidationError):
+                    keyset_paginate_query(query=Patient.query, base=Patient)
+                with self.assertRaises(ValidationError):
+                    stream_bundle(query=Patient.query, base=Patient)
+                with self.assertRaises(ValidationError):
+                    create_bundle(query=Patient.query, base=Patient)
+
+    def test_invalid_page_token(self):
+        with self.app.test_request_context('/?_count=2&_page_token=garbage'):
+            with self.assertRaises(ValidationError):
+                keyset_paginate_query(query=Patient.query, base=Patient)
+
+
+class BundleTotalTestCase(BaseClientTestCase):
+
+    def setUp(self):
+        super(BundleTotalTestCase, self).setUp()
+        for x in range(5):
+            Patient.create_random_patient()
+        db.session.commit()
+
+    def test_summary_count(self):
+        with self.app.test_request_context('/?_summary=count'):
+            self.assertEqual(create_bundle(query=Patient.query, base=Patient).total, 5)
+
+    def test_total_none_skips_last_link(self):
+        with self.app.test_request_context('/?page=1&_count=2&_total=none'):
+            p, per_page = paginate_query(query=Patient.query, total='none')
+            self.assertIsNone(p.total)
+            self.assertTrue(p.has_next)
+            self.assertEqual(len(p.items), 2)
+
+    def test_total_accurate(self):
+        with self.app.test_request_context('/?page=3&_count=2'):
+            p, per_page = paginate_query(query=Patient.query)
+            self.assertEqual(p.total, 5)
+            self.assertEqual(p.pages, 3)
+            self.assertFalse(p.has_next)
+
+    def test_total_estimate(self):
+        self.assertGreaterEqual(estimate_query_count(Patient.query.filter(Patient.active.is_(True))), 0)
+
+    def test_invalid_total(self):
+        with self.app.test_request_context('/?_total=maybe'):
+            with self.assertRaises(ValidationError):
+                create_bundle(query=Patient.query, base=Patient)
+
+
+class StreamedBundleTestCase(BaseClientTestCase):
+
+    def setUp(self):
+        super(StreamedBundleTestCase, self).setUp()
+        for x in range(7):
+            Patient.create_random_patient()
+        db.session.commit()
+        self.app.config['BUNDLE_STREAM_BATCH_SIZE'] = 2
+
+    def read_stream(self, response):
+        self.assertTrue(response.is_streamed)
+        return json.loads(response.get_data(as_text=True))
+
+    def test_streamed_page_matches_bundle(self):
+        self.app.config['BUNDLE_STREAM_THRESHOLD'] = 2
+        with self.app.test_request_context('/api/v1/fhir/Patient?_count=3&_total=accurate'):
+            self.assertTrue(bundle_should_stream(base=Patient))
+            expected = create_bundle(query=Patient.query, base=Patient).as_json()
+            streamed = self.read_stream(stream_bundle(query=Patient.query, base=Patient))
+        self.assertEqual(streamed, json.loads(json.dumps(expected)))
+        self.assertEqual(len(streamed['entry']), 3)
+        self.assertIn('next', [link['relation'] for link in streamed['link']])
+
+    def test_registry_sorted_page_is_streamed(self):
+        self.app.config['BUNDLE_STREAM_THRESHOLD'] = 2
+        with self.app.test_request_context('/api/v1/fhir/Patient?_count=3&_sort=-birthdate'):
+            query, spec = patient_search_registry.search(args=request.args)
+            self.assertTrue(bundle_should_stream(base=Patient, sort=spec['_sort']))
+            expected = create_bundle(query=query, base=Patient, sort=spec['_sort']).as_json()
+            streamed = self.read_stream(stream_bundle(query=query, base=Patient, sort=spec['_sort']))
+        self.assertEqual(streamed, json.loads(json.dumps(expected)))
+        self.assertEqual(len(streamed['entry']), 3)
+
+    def test_small_pages_are_not_streamed(self):
+        with self.app.test_request_context('/api/v1/fhir/Patient?_count=3'):
+            self.assertFalse(bundle_should_stream(base=Patient))
+
+    def test_unpaginated_stream(self):
+        with self.app.test_request_context('/api/v1/fhir/Patient?_elements=name'):
+            streamed = self.read_stream(stream_bundle(query=Patient.query, paginate=False, base=Patient))
+        self.assertEqual(streamed['total'], 7)
+        self.assertEqual(len(streamed['entry']), 7)
+        self.assertNotIn('address', streamed['entry'][0]['resource'])
@@ -0,0 +1,31 @@
+import unittest
+from app.utils.demographics import iter_random_demographics, validate_ssn, validate_phone, validate_state, \
+    validate_dob
+
+# Keys of the dicts returned by random_demographics() before it drew values a column at a time
+demographic_keys = {'first_name', 'last_name', 'middle_name', 'dob', 'sex', 'ssn', 'home_phone', 'mobile_phone',
+                    'work_phone', 'email', 'deceased', 'deceased_date', 'suffix', 'marital_status', 'race',
+                    'multiple_birth', 'ethnicity', 'username', 'password', 'preferred_language', 'address1',
+                    'address2', 'zipcode', 'city', 'state', 'use', 'start_date', 'end_date', 'country'}
+
+
+class RandomDemographicsTestCase(unittest.TestCase):
+
+    def test_chunks_yield_number_of_records(self):
+        self.assertEqual(len(list(iter_random_demographics(7, chunk_size=3))), 7)
+        self.assertEqual(len(list(iter_random_demographics(6, chunk_size=3))), 6)
+        self.assertEqual(list(iter_random_demographics(0, chunk_size=3)), [])
+
+    def test_records_are_valid(self):
+        records = list(iter_random_demographics(250, chunk_size=100))
+        for record in records:
+            self.assertEqual(set(record.keys()), demographic_keys)
+            self.assertEqual(validate_ssn(record['ssn']), record['ssn'].replace('-', ''))
+            for key in ('home_phone', 'mobile_phone', 'work_phone'):
+                self.assertEqual(validate_phone(record[key]), record[key])
+            self.assertEqual(validate_state(record['state']), record['state'])
+            self.assertEqual(validate_dob(record['dob']), record['dob'])
+            self.assertIn(record['sex'], ['M', 'F'])
+            self.assertEqual(record['deceased_date'] is not None, record['deceased'])
+            if record['deceased']:
+                self.assertGreaterEqual(record['deceased_date'], record['dob'])
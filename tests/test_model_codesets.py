@@ -0,0 +1,78 @@
+from tests.utils import BaseClientTestCase
+from app.models.fhir.codesets import CodeSystem, ValueSet, terminology_cache
+from app.extensions import db
+
+codesystem_data = {"resourceType": "CodeSystem",
+                   "id": "test-codes",
+                   "url": "http://example.org/CodeSystem/test-codes",
+                   "status": "active",
+                   "content": "complete",
+                   "concept": [{"code": "A", "display": "Alpha",
+                                "concept": [{"code": "A1", "display": "Alpha One"}]},
+                               {"code": "B", "display": "Bravo"}]}
+
+valueset_data = {"resourceType": "ValueSet",
+                 "id": "test-codes",
+                 "url": "http://example.org/ValueSet/test-codes",
+                 "status": "active",
+                 "compose": {"include": [{"system": "http://example.org/CodeSystem/test-codes"}]}}
+
+
+class TerminologyCacheTestCase(BaseClientTestCase):
+
+    def setUp(self):
+        super(TerminologyCacheTestCase, self).setUp()
+        terminology_cache.refresh()
+        self.cs = CodeSystem(data=codesystem_data)
+        self.vs = ValueSet(data=valueset_data)
+        db.session.add_all([self.cs, self.vs])
+        db.session.flush()
+        self.cs.index_concepts()
+        self.vs.index_concepts()
+        db.session.commit()
+
+    def test_concept_index(self):
+        self.assertEqual(self.cs.code_set, {'A', 'A1', 'B'})
+        self.assertEqual(self.vs.code_set, {'A', 'A1', 'B'})
+        concept = self.cs.get_concept('A1')
+        self.assertEqual(concept.display, 'Alpha One')
+        self.assertEqual(concept.parent_code, 'A')
+        self.assertIsNone(self.vs.get_concept('Z'))
+
+    def test_display_lookup_uses_cache(self):
+        url = valueset_data['url']
+        self.assertEqual(ValueSet.get_valueset_display(url, 'A1'), 'Alpha One')
+        misses = terminology_cache.misses
+        self.assertEqual(ValueSet.get_valueset_display(url, 'B'), 'Bravo')
+        self.assertIsNone(ValueSet.get_valueset_display(url, 'Z'))
+        self.assertEqual(terminology_cache.misses, misses)
+
+    def test_changed_codesystem_invalidates_valueset(self):
+        url = valueset_data['url']
+        self.assertEqual(ValueSet.get_valueset_display(url, 'B'), 'Bravo')
+        data = dict(codesystem_data)
+        data['concept'] = [{"code": "B", "display": "Beta"}]
+        self.cs.data = data
+        db.session.flush()
+        self.cs.index_concepts()
+        db.session.commit()
+        terminology_cache.revalidate(force=True)
+        self.assertEqual(ValueSet.get_valueset_display(url, 'B'), 'Beta')
+        self.assertEqual(self.vs.code_set, {'B'})
+
+    def test_unsupported_includes_are_logged(self):
+        data = {"resourceType": "ValueSet",
+                "id": "test-mixed",
+                "url": "http://example.org/ValueSet/test-mixed",
+                "status": "active",
+                "compose": {"include": [{"valueSet": [valueset_data['url']]},
+                                        {"system": codesystem_data['url'],
+                                         "concept": [{"code": "B", "display": "Bravo"}]}]}}
+        vs = ValueSet(data=data)
+        db.session.add(vs)
+        db.session.flush()
+        with self.assertLogs('app.models.fhir.codesets', level='WARNING') as logs:
+            vs.index_concepts()
+        db.session.commit()
+        self.assertIn(valueset_data['url'], logs.output[0])
+        self.assertEqual(vs.code_set, {'B'})
@@ -0,0 +1,187 @@
+from flask import jsonify
+from sqlalchemy import event
+from tests.utils import BaseClientTestCase
+from app.models.fhir.patient import Patient
+from app.models.fhir.codesets import ValueSet, terminology_cache
+from app.api_v1.utils.etag import version_etag, etag_matches
+from app.api_v1.utils.requests import fhir_requested_elements
+from app.api_v1.errors.exceptions import ValidationError
+from app.extensions import db
+from app.models.extensions import refresh_row_hashes
+
+
+class PatientModelTestCase(BaseClientTestCase):
+
+    def create_random_patients(self, number=3):
+        for x in range(number):
+            Patient.create_random_patient()
+        db.session.commit()
+        return Patient.query.order_by(Patient.id).all()
+
+    def count_queries(self, func, *args, **kwargs):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            func(*args, **kwargs)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return len(statements)
+
+    def test_get_fhir_read_preloads_relations(self):
+        pt = self.create_random_patients(number=1)[0]
+        db.session.expunge_all()
+        loaded = Patient.get_fhir_read(patientid=pt.id)
+        self.assertEqual(loaded.id, pt.id)
+        self.assertEqual(loaded.version_number, 1)
+        self.assertEqual(len(loaded.get_fhir_relation('addresses')), 1)
+        self.assertEqual(len(loaded.get_fhir_relation('email_addresses')), 1)
+        self.assertTrue(loaded.get_fhir_relation('phone_numbers'))
+
+    def test_get_fhir_read_missing_patient(self):
+        self.assertIsNone(Patient.get_fhir_read(patientid=12345))
+
+    def test_preloaded_fhir_matches_lazy_fhir(self):
+        pt = self.create_random_patients(number=1)[0]
+        with self.app.test_request_context():
+            lazy_json = pt.dump_fhir_json()
+            pt.preload_fhir_relations()
+            self.assertEqual(pt.dump_fhir_json(), lazy_json)
+
+    def test_bulk_preload_query_count_is_constant(self):
+        few = self.create_random_patients(number=2)
+        self.create_random_patients(number=8)
+        many = Patient.query.order_by(Patient.id).all()
+        self.assertEqual(self.count_queries(Patient.bulk_preload_fhir_relations, few),
+                         self.count_queries(Patient.bulk_preload_fhir_relations, many))
+
+    def test_version_metadata_tracks_children(self):
+        pt = self.create_random_patients(number=1)[0]
+        metadata = Patient.get_fhir_version_metadata(patientid=pt.id)
+        self.assertEqual(metadata['version_number'], 1)
+        self.assertIsNotNone(metadata['last_modified'])
+        etag = version_etag(metadata['version_number'], metadata['transaction_id'])
+        self.assertTrue(etag.startswith('W/"1.'))
+        self.assertTrue(etag_matches(etag, etag[2:]))
+
+        address = pt.addresses.first()
+        address.city = 'Zzyzxville'
+        db.session.commit()
+        changed = Patient.get_fhir_version_metadata(patientid=pt.id)
+        self.assertEqual(changed['version_number'], 1)
+        self.assertFalse(etag_matches(version_etag(changed['version_number'], changed['transaction_id']), etag))
+
+    def test_version_metadata_missing_patient(self):
+        self.assertIsNone(Patient.get_fhir_version_metadata(patientid=12345))
+
+    def test_narrative_can_be_left_out(self):
+        pt = self.create_random_patients(number=1)[0]
+        with self.app.test_request_context():
+            self.assertIn('text', pt.dump_fhir_json())
+            self.assertNotIn('text', pt.dump_fhir_json(include_narrative=False))
+
+    def test_refresh_narratives_does_not_create_versions(self):
+        pt = self.create_random_patients(number=1)[0]
+        with self.app.test_request_context():
+            rendered = pt.dump_fhir_json()['text']['div']
+            Patient.refresh_narratives([pt.id], force=True)
+            db.session.commit()
+            self.assertEqual(Patient.query.get(pt.id).narrative, rendered)
+            loaded = Patient.get_fhir_read(patientid=pt.id)
+            self.assertEqual(loaded.version_number, 1)
+            self.assertEqual(loaded.narrative_hash, loaded.narrative_source_hash())
+            self.assertEqual(loaded.dump_fhir_json()['text']['div'], rendered)
+
+    def test_narrative_render_error_does_not_fail_commit(self):
+        pt = self.create_random_patients(number=1)[0]
+
+        def fail(patient, fhir_pt):
+            raise RuntimeError('template error')
+
+        render_narrative = Patient.render_narrative
+        Patient.render_narrative = fail
+        try:
+            with self.app.test_request_context():
+                pt.last_name = 'Renderless'
+                db.session.commit()
+        finally:
+            Patient.render_narrative = render_narrative
+        self.assertEqual(Patient.query.get(pt.id).last_name, 'Renderless')
+
+    def test_narrative_hash_follows_terminology(self):
+        pt = self.create_random_patients(number=1)[0]
+        url = Patient.narrative_valueset_urls[0]
+        with self.app.test_request_context():
+            terminology_cache.refresh()
+            key = pt.narrative_source_hash()
+            vs = ValueSet(data={'resourceType': 'ValueSet', 'id': 'marital-status', 'url': url, 'status': 'active',
+                                'compose': {'include': [{'system': 'http://hl7.org/fhir/v3/MaritalStatus',
+                                                         'concept': [{'code': 'M', 'display': 'Married'}]}]}})
+            db.session.add(vs)
+            db.session.commit()
+            terminology_cache.refresh(url)
+            self.assertNotEqual(pt.narrative_source_hash(), key)
+
+    def test_row_hash_only_recomputed_for_hashed_changes(self):
+        pt = self.create_random_patients(number=1)[0]
+        self.assertEqual(pt.row_hash, pt.generate_row_hash())
+        # A stale hash is kept while no hashed attribute changes
+        pt.row_hash = 'stale'
+        pt.narrative_hash = 'changed'
+        db.session.commit()
+        self.assertEqual(pt.row_hash, 'stale')
+        pt.last_name = 'Hashington'
+        db.session.commit()
+        self.assertEqual(pt.row_hash, pt.generate_row_hash())
+        self.assertEqual(pt.last_name_search, 'HASHINGTON')
+
+    def test_refresh_row_hashes(self):
+        patients = self.create_random_patients(number=3)
+        patients[0].first_name = 'Batch'
+        self.assertEqual(refresh_row_hashes(patients), 1)
+        self.assertEqual(patients[0].row_hash, patients[0].generate_row_hash())
+        self.assertEqual(patients[0].first_name_search, 'BATCH')
+        self.assertEqual(refresh_row_hashes(patients, force=True), 3)
+
+    def test_requested_elements(self):
+        self.assertIsNone(fhir_requested_elements(Patient, args={}))
+        self.assertIsNone(fhir_requested_elements(Patient, args={'_summary': 'false'}))
+        self.assertEqual(fhir_requested_elements(Patient, args={'_summary': 'text'}), {'text'})
+        self.assertNotIn('text', fhir_requested_elements(Patient, args={'_summary': 'data'}))
+        self.assertEqual(fhir_requested_elements(Patient, args={'_elements': 'name, birthDate,bogus'}),
+                         {'name', 'birthDate'})
+        with self.assertRaises(ValidationError):
+            fhir_requested_elements(Patient, args={'_summary': 'maybe'})
+
+    def test_elements_load_only_requested_data(self):
+        pt = self.create_random_patients(number=1)[0]
+        db.session.expunge_all()
+        elements = {'name', 'birthDate'}
+        result = {}
+
+        def read():
+            loaded = Patient.get_fhir_read(patientid=pt.id, elements=elements)
+            result['json'] = loaded.dump_fhir_json(elements=elements)
+
+        with self.app.test_request_context():
+            self.assertEqual(self.count_queries(read), 1)
+        self.assertEqual(set(result['json']), {'resourceType', 'id', 'meta', 'name', 'birthDate'})
+        self.assertEqual(result['json']['meta']['tag'][0]['code'], 'SUBSETTED')
+
+    def test_fhir_json_matches_fhirclient_serialization(self):
+        patients = self.create_random_patients(number=5)
+        patients[0].marital_status = 'M'
+        patients[1].deceased = True
+        patients[1].deceased_date = patients[1].dob
+        db.session.commit()
+        with self.app.test_request_context():
+            for pt in Patient.query.order_by(Patient.id).all():
+                for child in pt.addresses.all() + pt.phone_numbers.all() + pt.email_addresses.all():
+                    self.assertEqual(jsonify(child.fhir_json()).get_data(),
+                                     jsonify(child.dump_fhir_json()).get_data())
+                for elements in [None, {'name', 'birthDate'}, {'text', 'telecom'}, {'extension', 'address'}]:
+                    self.assertEqual(jsonify(pt.fhir_json(elements=elements)).get_data(),
+                                     jsonify(pt.dump_fhir_json(elements=elements)).get_data())
@@ -2,6 +2,7 @@ import time
 from tests.utils import BaseClientTestCase, user_dict
 from app.models.user import User, Role, load_user
 from app.extensions import db
+from app.models.fhir.email_address import EmailAddress
 
 
 class UserModelTestCase(BaseClientTestCase):
@@ -107,6 +108,43 @@ class UserModelTestCase(BaseClientTestCase):
         self.assertFalse(user.confirmed)
         self.assertEqual(user.role.name, 'User')
 
+    def test_row_hash_ignores_last_seen(self):
+        user = User()
+        user.randomize_user()
+        db.session.add(user)
+        db.session.commit()
+        row_hash = user.row_hash
+        user.ping()
+        db.session.commit()
+        self.assertEqual(user.row_hash, row_hash)
+        user.description = 'Updated'
+        db.session.commit()
+        self.assertNotEqual(user.row_hash, row_hash)
+        self.assertEqual(user.row_hash, user.generate_row_hash())
+
+    def test_row_hash_follows_primary_contact_swap(self):
+        user = User()
+        user.randomize_user()
+        db.session.add(user)
+        db.session.commit()
+        first = user.email
+        user.email_addresses.append(EmailAddress(email='SECOND@EXAMPLE.COM', primary=False, active=False))
+        db.session.commit()
+        row_hash = user.row_hash
+        # Promote the old email to primary in place, without changing any User attribute, as UserAPI.update does
+        second = user.email_addresses.filter(EmailAddress.email == 'SECOND@EXAMPLE.COM').one()
+        first.primary, first.active = False, False
+        second.primary, second.active = True, True
+        db.session.commit()
+        self.assertNotEqual(user.row_hash, row_hash)
+        self.assertEqual(user.row_hash, user.generate_row_hash())
+        # And back to the original address
+        second.primary, second.active = False, False
+        first.primary, first.active = True, True
+        db.session.commit()
+        self.assertEqual(user.row_hash, row_hash)
+        self.assertEqual(User.query.get(user.id).row_hash, row_hash)
+
     def test_initialize_roles_staticmethod(self):
         Role.initialize_roles()
         admin_role = Role.query.filter_by(name='Admin').first()
@@ -0,0 +1,49 @@
+from tests.utils import BaseClientTestCase
+from app.api_v1.utils.cache import ResourceCache
+from app.models.fhir.patient import Patient
+from app.models.fhir.codesets import ValueSet, terminology_cache
+from app.extensions import db
+
+
+class ResourceCacheTestCase(BaseClientTestCase):
+
+    def test_lru_eviction(self):
+        self.app.config['RESOURCE_CACHE_SIZE'] = 2
+        cache = ResourceCache()
+        cache.set('a', b'1')
+        cache.set('b', b'2')
+        self.assertEqual(cache.get('a'), b'1')
+        cache.set('c', b'3')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'1')
+        self.assertEqual(cache.get('c'), b'3')
+        self.assertEqual(cache.stats()['hits'], 3)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_patient_cache_key_tracks_children(self):
+        Patient.create_random_patient()
+        db.session.commit()
+        pt = Patient.get_fhir_read(patientid=Patient.query.first().id)
+        key = pt.fhir_cache_key()
+        self.assertEqual(Patient.get_fhir_read(patientid=pt.id).fhir_cache_key(), key)
+        address = pt.addresses.first()
+        address.city = 'Zzyzxville'
+        db.session.commit()
+        self.assertNotEqual(Patient.get_fhir_read(patientid=pt.id).fhir_cache_key(), key)
+
+    def test_patient_cache_key_tracks_terminology(self):
+        Patient.create_random_patient()
+        db.session.commit()
+        terminology_cache.refresh()
+        cache = ResourceCache()
+        pt = Patient.get_fhir_read(patientid=Patient.query.first().id)
+        cache.set(pt.fhir_cache_key(), b'cached')
+        self.assertEqual(cache.get(Patient.get_fhir_read(patientid=pt.id).fhir_cache_key()), b'cached')
+        url = Patient.narrative_valueset_urls[0]
+        vs = ValueSet(data={'resourceType': 'ValueSet', 'id': 'marital-status', 'url': url, 'status': 'active',
+                            'compose': {'include': [{'system': 'http://hl7.org/fhir/v3/MaritalStatus',
+                                                     'concept': [{'code': 'M', 'display': 'Married'}]}]}})
+        db.session.add(vs)
+        db.session.commit()
+        terminology_cache.refresh(url)
+        self.assertIsNone(cache.get(Patient.get_fhir_read(patientid=pt.id).fhir_cache_key()))
@@ -0,0 +1,96 @@
+from flask import request
+from tests.utils import BaseClientTestCase
+from app.api_v1.utils.search import SearchRegistry, fhir_search
+from app.api_v1.views.Patient import patient_search_registry
+from app.models.fhir.patient import Patient
+from app.models.fhir.address import Address
+from app.extensions import db
+
+search_support = {'family': {'modifier': ['exact', 'contains', 'missing'],
+                             'prefix': [],
+                             'model': Patient,
+                             'column': ['last_name'],
+                             'type': 'string'},
+                  'birthdate': {'modifier': [],
+                                'prefix': ['gt', 'ge', 'lt', 'le', 'eq', 'ne'],
+                                'model': Patient,
+                                'column': ['dob'],
+                                'type': 'date'}}
+
+
+class SearchRegistryTestCase(BaseClientTestCase):
+
+    def setUp(self):
+        super(SearchRegistryTestCase, self).setUp()
+        self.registry = SearchRegistry(base=Patient, model_support=search_support)
+        for x in range(5):
+            Patient.create_random_patient()
+        db.session.commit()
+
+    def test_support_is_read_only(self):
+        with self.assertRaises(TypeError):
+            self.registry.support['family'] = {}
+        with self.assertRaises(ValueError):
+            SearchRegistry(base=Patient, model_support={'family': {'model': Patient}})
+
+    def test_plans_are_cached_by_shape(self):
+        pt = Patient.query.first()
+        with self.app.test_request_context('/?family={}'.format(pt.last_name)):
+            query, spec = self.registry.search(args=request.args)
+            plan = self.registry.get_plan(spec)
+            self.assertIn(pt.id, [x.id for x in query])
+        with self.app.test_request_context('/?family=zzzz'):
+            query, spec = self.registry.search(args=request.args)
+            self.assertIs(self.registry.get_plan(spec), plan)
+            self.assertEqual(query.all(), [])
+        with self.app.test_request_context('/?family:exact=zzzz'):
+            query, spec = self.registry.search(args=request.args)
+            self.assertIsNot(self.registry.get_plan(spec), plan)
+
+    def test_plan_matches_uncached_search(self):
+        qs = '/?birthdate=ge1950-01-01&_sort=-birthdate'
+        with self.app.test_request_context(qs):
+            query, spec = self.registry.search(args=request.args)
+            uncached = fhir_search(args=request.args, model_support=search_support, base=Patient, query=Patient.query)
+            self.assertEqual([x.id for x in query], [x.id for x in uncached])
+
+    def test_string_search_is_case_and_accent_insensitive(self):
+        pt = Patient.query.first()
+        pt.last_name = 'Muñoz-García'
+        db.session.commit()
+        self.assertEqual(pt.last_name_search, 'MUNOZ-GARCIA')
+        for qs in ['/?family=munoz', '/?family:contains=GARCIA']:
+            with self.app.test_request_context(qs):
+                query, spec = self.registry.search(args=request.args)
+                self.assertEqual([x.id for x in query], [pt.id])
+
+    def test_child_parameters_do_not_duplicate_patients(self):
+        registry = SearchRegistry(base=Patient, model_support={
+            'address-city': {'modifier': ['exact', 'contains', 'missing'],
+                             'prefix': [],
+                             'model': Address,
+                             'column': ['city'],
+                             'type': 'string'}})
+        pt = Patient.query.first()
+        pt.addresses.append(Address(address1='1 Main St', city='Zzyzxville', state='IL', zipcode='62701'))
+        pt.addresses.append(Address(address1='2 Main St', city='Zzyzxville', state='IL', zipcode='62701'))
+        db.session.commit()
+        with self.app.test_request_context('/?address-city=zzyzx&_sort=address-city'):
+            query, spec = registry.search(args=request.args)
+            self.assertEqual([x.id for x in query], [pt.id])
+            self.assertEqual(query.count(), 1)
+
+    def test_identifier_without_system(self):
+        pt = Patient.query.first()
+        pt.ssn = '123456789'
+        db.session.commit()
+        # An SSN-shaped value is not compared against the uuid column
+        for value in ['123456789', '123-45-6789']:
+            with self.app.test_request_context('/?identifier={}'.format(value)):
+                query, spec = patient_search_registry.search(args=request.args)
+                self.assertEqual(list(spec['identifier']['column']), ['ssn'])
+                self.assertEqual([x.id for x in query], [pt.id] if value == '123456789' else [])
+        with self.app.test_request_context('/?identifier={}'.format(pt.uuid)):
+            query, spec = patient_search_registry.search(args=request.args)
+            self.assertEqual(sorted(spec['identifier']['column']), ['ssn', 'uuid'])
+            self.assertEqual([x.id for x in query], [pt.id])
@@ -0,0 +1,27 @@
+import os, sys, tempfile, shutil
+from tests.utils import BaseClientTestCase
+from app.utils.synthea import run_synthea_pipeline, synthea_slices
+from app.models.fhir.patient import Patient
+
+stub_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synthea_stub.py')
+
+
+class SyntheaPipelineTestCase(BaseClientTestCase):
+
+    def test_synthea_slices(self):
+        slices = synthea_slices(6, [('Wisconsin', 'Madison', 2), ('Wisconsin', None, 1)])
+        self.assertEqual(slices, [('Wisconsin', 'Madison', 4), ('Wisconsin', None, 2)])
+
+    def test_pipeline_loads_generated_patients(self):
+        output_dir = tempfile.mkdtemp()
+        try:
+            loader = run_synthea_pipeline(total_population=6, command=[sys.executable, stub_script],
+                                          synthea_settings=[('Wisconsin', 'Madison', 2), ('Wisconsin', None, 1)],
+                                          workers=2, batch_size=4, poll_interval=0.05, output_dir=output_dir)
+            self.assertEqual(loader.errors, [])
+            self.assertEqual(loader.loaded, 6)
+            self.assertEqual(Patient.query.filter(Patient.last_name == 'Stub').count(), 6)
+            # An output directory passed in is kept
+            self.assertEqual(len(os.listdir(os.path.join(output_dir, 'slice_0', 'fhir'))), 4)
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
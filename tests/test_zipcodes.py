@@ -0,0 +1,58 @@
+import unittest
+from app.utils.zipcodes import ZipcodeIndex, zipcode_index
+from app.utils.demographics import normalize_address, normalize_addresses, normalize_city_state, validate_state
+
+
+class ZipcodeIndexTestCase(unittest.TestCase):
+
+    def test_state_lookup(self):
+        self.assertEqual(validate_state('WI'), 'WI')
+        self.assertEqual(validate_state('wisconsin'), 'WI')
+        self.assertEqual(validate_state('Wisconson'), 'WI')
+        with self.assertRaises(ValueError):
+            validate_state('XX')
+        with self.assertRaises(ValueError):
+            validate_state(None)
+
+    def test_city_state_lookup(self):
+        self.assertEqual(normalize_city_state(city='Sun Prairie', state='Wisconsin'), ('Sun Prairie', 'WI', '53590'))
+        city, state, zipcode = normalize_city_state(city='madisn', state='WI')
+        self.assertEqual((city, state, zipcode), ('Madison', 'WI', None))
+
+    def test_zipcode_lookup(self):
+        self.assertEqual(zipcode_index().zipcode('53703').City, 'Madison')
+        self.assertIsNone(zipcode_index().zipcode('00000'))
+        address = normalize_address(address1='1 Main St', zipcode='53590')
+        self.assertEqual((address['city'], address['state'], address['country']), ('SUN PRAIRIE', 'WI', 'USA'))
+
+    def test_index_is_shared(self):
+        self.assertIs(zipcode_index(), zipcode_index())
+
+    def test_fuzzy_matches_are_bounded(self):
+        index = ZipcodeIndex(fuzzy_cache_size=4)
+        for x in range(10):
+            with self.assertRaises(ValueError):
+                index.city('Nowhere {}'.format(x), 'WI')
+        self.assertEqual(index._match_city.cache_info().currsize, 4)
+        self.assertEqual(index.city('madisn', 'WI'), 'Madison')
+
+
+class NormalizeAddressesTestCase(unittest.TestCase):
+
+    addresses = [{'address1': '1 main st', 'city': 'Sun Prairie', 'state': 'Wisconsin'},
+                 {'address1': '2 main st', 'zipcode': '53703'},
+                 {'address1': '1 main st', 'city': 'Sun Prairie', 'state': 'Wisconsin'},
+                 {'address1': '3 main st', 'city': 'Nowhere', 'state': 'XX'}]
+
+    def test_matches_normalize_address_in_order(self):
+        result = normalize_addresses(self.addresses)
+        self.assertEqual(len(result), 4)
+        for address, normalized in zip(self.addresses[:3], result):
+            self.assertEqual(normalized, normalize_address(**address))
+        self.assertIsNone(result[3])
+        # Duplicate inputs get separate dicts
+        self.assertIsNot(result[0], result[2])
+
+    def test_process_pool(self):
+        self.assertEqual(normalize_addresses(self.addresses, workers=2, parallel_threshold=1, chunk_size=1),
+                         normalize_addresses(self.addresses))